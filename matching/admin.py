@@ -1,5 +1,6 @@
 from django.contrib import admin
-from .models import Driver, Passenger, Ride
+from .models import Driver, Passenger, Ride, RidePassenger, Zone
+from .signals import driver_updated
 
 @admin.register(Driver)
 class DriverAdmin(admin.ModelAdmin):
@@ -7,6 +8,17 @@ class DriverAdmin(admin.ModelAdmin):
     list_filter = ('available', 'rating')
     search_fields = ('firstname', 'lastname')
 
+    def save_model(self, request, obj, form, change):
+        previous = Driver.objects.filter(pk=obj.pk).values('location', 'available').first() if change else None
+        super().save_model(request, obj, form, change)
+        # Keeps the in-memory indexes and the driver state table in step with admin edits
+        driver_updated.send(
+            sender=Driver,
+            driver=obj,
+            previous_location=previous['location'] if previous else None,
+            previous_available=previous['available'] if previous else None
+        )
+
 @admin.register(Passenger)
 class PassengerAdmin(admin.ModelAdmin):
     list_display = ('firstname', 'lastname')
@@ -19,3 +31,16 @@ class RideAdmin(admin.ModelAdmin):
     search_fields = ('driver__firstname', 'driver__lastname', 
                     'passenger__firstname', 'passenger__lastname')
     readonly_fields = ('created_at',)
+
+@admin.register(RidePassenger)
+class RidePassengerAdmin(admin.ModelAdmin):
+    list_display = ('ride', 'passenger', 'status', 'detour_km', 'joined_at')
+    list_filter = ('status',)
+    readonly_fields = ('joined_at',)
+
+@admin.register(Zone)
+class ZoneAdmin(admin.ModelAdmin):
+    list_display = ('name', 'kind', 'active', 'updated_at')
+    list_filter = ('kind', 'active')
+    search_fields = ('name',)
+    readonly_fields = ('created_at', 'updated_at')
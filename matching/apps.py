@@ -6,7 +6,84 @@ class MatchingConfig(AppConfig):
     name = 'matching'
 
     def ready(self):
-        # Initialize services
-        from .services.traffic_service import TrafficService
-        from .services.matching_service import MatchingService
-        from .services.navigation_service import NavigationService
+        # Register services; each is built on first use, not at import time
+        from django.conf import settings
+        from .services.registry import registry, configure
+        from django.db.models.signals import post_delete, post_save
+        from .models import Zone
+        from .signals import driver_updated, ride_accepted, ride_status_changed
+
+        configure(registry)
+        # Region shards only cache what they would otherwise load from the database
+        driver_updated.connect(
+            registry.receiver('region_router', 'on_driver_updated', build=False),
+            weak=False, dispatch_uid='matching.region_router'
+        )
+        driver_updated.connect(
+            registry.receiver('candidate_cache', 'on_driver_updated', build=False),
+            weak=False, dispatch_uid='matching.candidate_cache'
+        )
+        ride_accepted.connect(
+            registry.receiver('candidate_cache', 'on_ride_accepted', build=False),
+            weak=False, dispatch_uid='matching.candidate_cache'
+        )
+        # Zone memberships are recomputed as drivers move, the index when zones change
+        driver_updated.connect(
+            registry.receiver('zone_index', 'on_driver_updated', build=False),
+            weak=False, dispatch_uid='matching.zone_index'
+        )
+        for signal in (post_save, post_delete):
+            signal.connect(
+                registry.receiver('zone_index', 'on_zones_changed', build=False),
+                sender=Zone, weak=False, dispatch_uid='matching.zone_index'
+            )
+        driver_updated.connect(
+            registry.receiver('nearby_index', 'on_driver_updated', build=False),
+            weak=False, dispatch_uid='matching.nearby_index'
+        )
+        # The heatmap is resynced from the database, so it can start counting lazily too
+        driver_updated.connect(
+            registry.receiver('heatmap', 'on_driver_updated', build=False),
+            weak=False, dispatch_uid='matching.heatmap'
+        )
+        ride_status_changed.connect(
+            registry.receiver('heatmap', 'on_ride_status_changed', build=False),
+            weak=False, dispatch_uid='matching.heatmap'
+        )
+        # Accepted rides get their route planned once, in the background; pings are then tracked along it
+        ride_accepted.connect(
+            registry.receiver('ride_tracker', 'on_ride_accepted'),
+            weak=False, dispatch_uid='matching.ride_tracker'
+        )
+        ride_status_changed.connect(
+            registry.receiver('ride_tracker', 'on_ride_status_changed', build=False),
+            weak=False, dispatch_uid='matching.ride_tracker'
+        )
+        driver_updated.connect(
+            registry.receiver('ride_tracker', 'on_driver_updated', build=False),
+            weak=False, dispatch_uid='matching.ride_tracker'
+        )
+        # Active shared rides are indexed for inserting passengers along the way
+        ride_accepted.connect(
+            registry.receiver('carpool', 'on_ride_accepted', build=False),
+            weak=False, dispatch_uid='matching.carpool'
+        )
+        ride_status_changed.connect(
+            registry.receiver('carpool', 'on_ride_status_changed', build=False),
+            weak=False, dispatch_uid='matching.carpool'
+        )
+        driver_updated.connect(
+            registry.receiver('carpool', 'on_driver_updated', build=False),
+            weak=False, dispatch_uid='matching.carpool'
+        )
+        # Completed rides teach the historical traffic profile their trip speed
+        ride_status_changed.connect(
+            registry.receiver('traffic_profile', 'on_ride_status_changed', build=False),
+            weak=False, dispatch_uid='matching.traffic_profile'
+        )
+        # The shared state table must see every update, whichever process makes it
+        if settings.DRIVER_STATE_PATH:
+            driver_updated.connect(
+                registry.receiver('driver_state', 'on_driver_updated'),
+                weak=False, dispatch_uid='matching.driver_state'
+            )
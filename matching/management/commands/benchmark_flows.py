@@ -0,0 +1,141 @@
+import json
+import random
+import threading
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+
+from matching.models import Passenger, Ride, RideRequest
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the /navigation/ and /match/ endpoints in-process and report latency "
+        "percentiles. Use with TRAFFIC_BACKEND=simulation and NAVIGATION_BACKEND=simulation "
+        "to benchmark offline. Per-user throttles are lifted unless --throttled is given. "
+        "The match flow creates real rides, each worker for its own passenger, and cancels "
+        "every ride before the worker's next request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('flow', choices=['navigation', 'match'])
+        parser.add_argument('--requests', type=int, default=200)
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument(
+            '--username',
+            help='Passenger user for the match flow; worker N uses <username>-N, created if missing'
+        )
+        parser.add_argument(
+            '--throttled', action='store_true',
+            help='Keep the THROTTLE_BUCKETS rate limits (all requests come from one user)'
+        )
+        parser.add_argument('--seed', type=int, default=1, help='Seed for the generated trips')
+        parser.add_argument(
+            '--center', default='6.5244,3.3792',
+            help='lat,lng around which trips are generated'
+        )
+        parser.add_argument('--radius-deg', type=float, default=0.1)
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        users = [None] * concurrency
+        if options['flow'] == 'match':
+            if not options['username']:
+                raise CommandError("The match flow needs --username of a passenger user")
+            try:
+                user = User.objects.get(username=options['username'])
+            except User.DoesNotExist:
+                raise CommandError(f"User {options['username']} not found")
+            # A passenger with an open ride gets it back instead of a new match,
+            # so no two workers share one
+            users = [user] + [self.worker_user(user, n) for n in range(1, concurrency)]
+
+        lat, lng = (float(part) for part in options['center'].split(','))
+        rng = random.Random(options['seed'])
+        radius = options['radius_deg']
+
+        def point():
+            return {
+                'latitude': lat + rng.uniform(-radius, radius),
+                'longitude': lng + rng.uniform(-radius, radius)
+            }
+
+        trips = [(point(), point()) for _ in range(options['requests'])]
+        latencies = []
+        statuses = {}
+        lock = threading.Lock()
+        cursor = iter(trips)
+
+        def run(user):
+            try:
+                drive(user)
+            finally:
+                connection.close()
+
+        def drive(user):
+            client = Client(raise_request_exception=False, HTTP_HOST='localhost')
+            if user is not None:
+                client.force_login(user)
+            while True:
+                with lock:
+                    trip = next(cursor, None)
+                if trip is None:
+                    return
+                origin, destination = trip
+                if options['flow'] == 'navigation':
+                    url, body = '/api/rides/navigation/', {'origin': origin, 'destination': destination}
+                else:
+                    url, body = '/api/rides/match/', {
+                        'passenger_id': user.passenger.id,
+                        'pickup_location': origin,
+                        'destination': destination
+                    }
+                start = time.perf_counter()
+                response = client.post(url, json.dumps(body), content_type='application/json')
+                elapsed = (time.perf_counter() - start) * 1000
+                with lock:
+                    latencies.append(elapsed)
+                    statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+                if options['flow'] == 'match' and response.status_code == 200:
+                    self.cancel(response.json()['ride']['id'])
+
+        # Every request comes from the same few users, so the per-user buckets
+        # would otherwise answer most of them with 429
+        throttles = override_settings() if options['throttled'] else override_settings(THROTTLE_BUCKETS={})
+        with throttles:
+            started = time.perf_counter()
+            threads = [threading.Thread(target=run, args=(user,)) for user in users]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            wall = time.perf_counter() - started
+
+        self.stdout.write(f"{options['flow']}: {len(latencies)} requests in {wall:.2f}s ({len(latencies) / wall:.1f} req/s)")
+        self.stdout.write(f"status codes: {statuses}")
+        for label, fraction in (('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('max', 1.0)):
+            self.stdout.write(f"{label}: {percentile(latencies, fraction):.1f} ms")
+
+    def worker_user(self, user, n):
+        worker, _ = User.objects.get_or_create(username=f"{user.username}-{n}")
+        Passenger.objects.get_or_create(
+            user=worker,
+            defaults={'firstname': user.passenger.firstname, 'lastname': f"{user.passenger.lastname} {n}"}
+        )
+        return worker
+
+    def cancel(self, ride_id):
+        """Withdraw a benchmark ride so its passenger is matched afresh next time"""
+        RideRequest.objects.filter(ride_id=ride_id, status='PENDING').update(status='WITHDRAWN')
+        Ride.objects.filter(id=ride_id, status='PENDING').update(status='CANCELLED')
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from matching.services.local_routing import build_road_graph
+
+
+class Command(BaseCommand):
+    help = "Convert an OSM XML extract into the binary road graph used by the local routing backend"
+
+    def add_arguments(self, parser):
+        parser.add_argument('osm_path', help='OSM XML extract (.osm)')
+        parser.add_argument('output_path', help='Where to write the road graph')
+        parser.add_argument(
+            '--landmarks', type=int, default=8,
+            help='Number of ALT landmarks to precompute (more is faster to query, larger on disk)'
+        )
+
+    def handle(self, *args, **options):
+        try:
+            nodes, edges = build_road_graph(
+                options['osm_path'], options['output_path'], landmark_count=options['landmarks']
+            )
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        self.stdout.write(f"Wrote {options['output_path']}: {nodes} nodes, {edges} edges")
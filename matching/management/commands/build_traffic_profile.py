@@ -0,0 +1,33 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+
+class Command(BaseCommand):
+    help = (
+        "Add the trip speeds of recently completed rides to the historical traffic profile. "
+        "Rides already counted (as they completed, or by an earlier run) are skipped, so "
+        "running it again over the same period does not count them twice"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--hours', type=float, default=24,
+            help='Use rides completed in this many past hours (default: 24)'
+        )
+
+    def handle(self, *args, **options):
+        from matching.models import Ride
+        from matching.services.registry import registry
+
+        profile = registry.traffic_profile
+        if profile is None:
+            raise CommandError("The traffic profile is disabled (TRAFFIC_PROFILE is not set)")
+        rides = Ride.objects.filter(
+            status='COMPLETED',
+            completed_at__gte=timezone.now() - timedelta(hours=options['hours']),
+            traffic_counted=False
+        ).exclude(started_at=None)
+        counted, entries = profile.rebuild(rides.iterator())
+        self.stdout.write(f"Updated {entries} traffic profile entries from {counted} rides")
@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from matching.services.driver_state import DriverStateTable
+
+
+class Command(BaseCommand):
+    help = "Manage the shared driver state table (rebuild, snapshot, restore, stats)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['rebuild', 'snapshot', 'restore', 'stats'])
+        parser.add_argument('path', nargs='?', help='Snapshot file for snapshot/restore')
+
+    def handle(self, *args, **options):
+        if not settings.DRIVER_STATE_PATH:
+            raise CommandError("DRIVER_STATE_PATH is not set")
+        table = DriverStateTable(settings.DRIVER_STATE_PATH, settings.DRIVER_STATE_CAPACITY).open()
+        action = options['action']
+
+        if action in ('snapshot', 'restore') and not options['path']:
+            raise CommandError(f"{action} needs a snapshot path")
+
+        if action == 'rebuild':
+            written = table.rebuild()
+            self.stdout.write(f"Wrote {written} drivers to {table.path}")
+        elif action == 'snapshot':
+            table.snapshot(options['path'])
+            self.stdout.write(f"Saved {table.count} drivers to {options['path']}")
+        elif action == 'restore':
+            try:
+                table.restore(options['path'])
+            except (OSError, ValueError) as e:
+                raise CommandError(str(e))
+            self.stdout.write(f"Restored {table.count} drivers from {options['path']}")
+        else:
+            states = list(table)
+            available = sum(1 for state in states if state.available)
+            self.stdout.write(
+                f"{table.path}: {len(states)}/{table.capacity} slots used, {available} available"
+            )
+        table.close()
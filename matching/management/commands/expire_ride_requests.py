@@ -0,0 +1,27 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+
+class Command(BaseCommand):
+    help = "Expire ride requests whose dispatch wave timed out and offer the rides to the next drivers"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--every', type=float, default=0,
+            help='Keep running, checking at this interval in seconds (default: check once)'
+        )
+
+    def handle(self, *args, **options):
+        from matching.services.registry import registry
+
+        dispatch = registry.dispatch_service
+        while True:
+            expired = dispatch.expire_requests()
+            if expired or not options['every']:
+                self.stdout.write(f"Expired {expired} ride requests")
+            if not options['every']:
+                break
+            close_old_connections()
+            time.sleep(options['every'])
@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from ride_mgn_system.api_docs import write_schema
+
+
+class Command(BaseCommand):
+    help = "Generate the OpenAPI document served by /openapi.json and the Swagger/ReDoc pages"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output', help='Where to write the document (defaults to OPENAPI_SCHEMA_PATH)'
+        )
+
+    def handle(self, *args, **options):
+        path = options['output'] or settings.OPENAPI_SCHEMA_PATH
+        document = write_schema(path)
+        self.stdout.write(
+            f"Wrote {path}: {len(document.content)} bytes "
+            f"({len(document.gzipped)} gzipped), ETag {document.etag}"
+        )
@@ -0,0 +1,83 @@
+import os
+import re
+import subprocess
+import sys
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Cold start as a worker sees it: set up Django and import the URL conf (and
+# with it every view), optionally building the warm-up services too
+STARTUP_SCRIPT = """
+import os, sys, time
+started = time.perf_counter()
+import django
+django.setup()
+from django.conf import settings
+from django.urls import get_resolver
+get_resolver().url_patterns
+ready = time.perf_counter()
+if {warm_up!r}:
+    from matching.services.registry import registry
+    registry.warm_up(settings.SERVICE_WARMUP)
+print(f"{{(ready - started) * 1000:.1f}} {{(time.perf_counter() - ready) * 1000:.1f}}")
+"""
+
+IMPORT_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+class Command(BaseCommand):
+    help = "Profile process startup with python -X importtime and summarize where the time goes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=20, help='Number of modules and packages to list')
+        parser.add_argument(
+            '--warm-up', action='store_true',
+            help='Also build the services listed in SERVICE_WARMUP'
+        )
+        parser.add_argument('--raw', help='Write the raw -X importtime log to this file')
+
+    def handle(self, *args, **options):
+        env = dict(os.environ)
+        env.setdefault('DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE)
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', STARTUP_SCRIPT.format(warm_up=options['warm_up'])],
+            cwd=settings.BASE_DIR, env=env, capture_output=True, text=True
+        )
+        if result.returncode != 0:
+            raise CommandError(f"Startup failed:\n{result.stderr[-2000:]}")
+        if options['raw']:
+            with open(options['raw'], 'w') as f:
+                f.write(result.stderr)
+
+        modules = []
+        for line in result.stderr.splitlines():
+            match = IMPORT_LINE.match(line)
+            if match:
+                self_us, cumulative_us, indent, name = match.groups()
+                modules.append((name, int(self_us), int(cumulative_us), len(indent)))
+        if not modules:
+            raise CommandError("No -X importtime output was captured")
+
+        setup_ms, warm_up_ms = (float(value) for value in result.stdout.split()[-2:])
+        import_ms = sum(self_us for _, self_us, _, _ in modules) / 1000
+        self.stdout.write(
+            f"Django setup and URL conf: {setup_ms:.1f} ms, {len(modules)} modules "
+            f"imported in {import_ms:.1f} ms"
+        )
+        if options['warm_up']:
+            self.stdout.write(f"Service warm-up: {warm_up_ms:.1f} ms")
+
+        packages = defaultdict(int)
+        for name, self_us, _, _ in modules:
+            packages[name.split('.')[0]] += self_us
+        self.stdout.write("\nSlowest packages (own import time of all their modules):")
+        for package, total_us in sorted(packages.items(), key=lambda item: -item[1])[:options['top']]:
+            self.stdout.write(f"  {total_us / 1000:8.1f} ms  {package}")
+
+        # Top-level imports of the startup script, with everything they pulled in
+        self.stdout.write("\nSlowest top-level imports (cumulative):")
+        roots = [module for module in modules if module[3] == 1]
+        for name, _, cumulative_us, _ in sorted(roots, key=lambda module: -module[2])[:options['top']]:
+            self.stdout.write(f"  {cumulative_us / 1000:8.1f} ms  {name}")
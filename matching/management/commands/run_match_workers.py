@@ -0,0 +1,74 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connections
+
+
+def run_worker(index: int, poll_interval: float, drain: bool):
+    """Claim and process match jobs until stopped (or until the queue is empty when draining)"""
+    from matching.services.registry import registry
+
+    registry.warm_up(settings.SERVICE_WARMUP)
+    queue = registry.match_queue
+    name = f"{os.uname().nodename}:{os.getpid()}"
+
+    while True:
+        if index == 0:
+            queue.requeue_stale()
+            registry.dispatch_service.expire_requests()
+        job = queue.claim_next(worker=name)
+        if job is not None:
+            queue.process(job)
+            continue
+        if drain:
+            break
+        time.sleep(poll_interval)
+
+
+class Command(BaseCommand):
+    help = "Run a pool of worker processes that process queued match jobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes (defaults to the number of CPUs)'
+        )
+        parser.add_argument(
+            '--poll-interval', type=float, default=0.5,
+            help='Seconds to wait before polling again when the queue is empty'
+        )
+        parser.add_argument(
+            '--drain', action='store_true',
+            help='Process the jobs currently queued and exit'
+        )
+
+    def handle(self, *args, **options):
+        # Connections must not be shared with forked children
+        connections.close_all()
+
+        workers = [
+            multiprocessing.Process(
+                target=run_worker,
+                args=(index, options['poll_interval'], options['drain']),
+                name=f"match-worker-{index}"
+            )
+            for index in range(max(1, options['workers']))
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Started {len(workers)} match workers")
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                if worker.is_alive():
+                    os.kill(worker.pid, signal.SIGTERM)
+            for worker in workers:
+                worker.join()
+        self.stdout.write("Match workers stopped")
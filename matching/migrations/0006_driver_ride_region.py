@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:17
+
+from django.conf import settings
+from django.db import migrations, models
+
+from matching.services.geohash import encode_location
+
+
+def backfill_regions(apps, schema_editor):
+    precision = getattr(settings, 'MATCHING_REGION_PRECISION', 4)
+    Driver = apps.get_model('matching', 'Driver')
+    Ride = apps.get_model('matching', 'Ride')
+    for driver in Driver.objects.exclude(location=None):
+        driver.region = encode_location(driver.location, precision)
+        driver.save(update_fields=['region'])
+    for ride in Ride.objects.all():
+        ride.region = encode_location(ride.pickup_location, precision)
+        ride.save(update_fields=['region'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0005_matchjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driver',
+            name='region',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=12),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='region',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=12),
+        ),
+        migrations.RunPython(backfill_regions, migrations.RunPython.noop),
+    ]
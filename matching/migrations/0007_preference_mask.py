@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:34
+
+from django.db import migrations, models
+
+from matching.services.preferences import encode
+
+
+def backfill_preference_masks(apps, schema_editor):
+    for model in ('Driver', 'Passenger'):
+        for profile in apps.get_model('matching', model).objects.all():
+            profile.preference_mask, profile.preference_known = encode(profile.preferences)
+            profile.save(update_fields=['preference_mask', 'preference_known'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0006_driver_ride_region'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='driver',
+            name='preference_known',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='driver',
+            name='preference_mask',
+            field=models.PositiveIntegerField(db_index=True, default=0),
+        ),
+        migrations.AddField(
+            model_name='passenger',
+            name='preference_known',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='passenger',
+            name='preference_mask',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_preference_masks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0007_preference_mask'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='dispatch_policy',
+            field=models.CharField(choices=[('broadcast', 'Broadcast'), ('sequential', 'Sequential'), ('wave', 'Wave')], default='broadcast', max_length=20),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='offered',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='ranking',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='wave',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='riderequest',
+            name='expires_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='riderequest',
+            name='wave',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0010_zone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='route',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
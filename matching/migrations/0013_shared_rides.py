@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 23:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0012_traffic_profile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='capacity',
+            field=models.PositiveSmallIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='shared',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='ride',
+            name='stops',
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.CreateModel(
+            name='RidePassenger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('pickup_location', models.JSONField()),
+                ('destination', models.JSONField()),
+                ('status', models.CharField(choices=[('WAITING', 'Waiting'), ('ON_BOARD', 'On board'), ('DROPPED_OFF', 'Dropped off')], default='WAITING', max_length=20)),
+                ('direct_km', models.FloatField()),
+                ('max_detour_km', models.FloatField()),
+                ('detour_km', models.FloatField(default=0)),
+                ('joined_at', models.DateTimeField(auto_now_add=True)),
+                ('passenger', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='shared_rides', to='matching.passenger')),
+                ('ride', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='riders', to='matching.ride')),
+            ],
+            options={
+                'unique_together': {('ride', 'passenger')},
+            },
+        ),
+    ]
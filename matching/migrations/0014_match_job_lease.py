@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-19 00:13
+
+from datetime import timedelta
+
+from django.db import migrations, models
+
+
+def backfill_leases(apps, schema_editor):
+    # Jobs claimed before leases existed keep the old five-minute allowance
+    MatchJob = apps.get_model('matching', 'MatchJob')
+    for job in MatchJob.objects.filter(status='RUNNING').exclude(started_at=None):
+        job.lease_expires_at = job.started_at + timedelta(minutes=5)
+        job.save(update_fields=['lease_expires_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0013_shared_rides'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='matchjob',
+            name='lease_expires_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.RunPython(backfill_leases, migrations.RunPython.noop),
+    ]
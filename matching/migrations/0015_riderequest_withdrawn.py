@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-19 09:40
+
+from django.db import migrations, models
+
+
+def withdraw_siblings(apps, schema_editor):
+    # Accepting a ride used to mark its other pending requests REJECTED, in the
+    # same update as the accepted one, so they share its updated_at
+    RideRequest = apps.get_model('matching', 'RideRequest')
+    for accepted in RideRequest.objects.filter(status='ACCEPTED').only('ride_id', 'updated_at'):
+        RideRequest.objects.filter(
+            ride_id=accepted.ride_id,
+            status='REJECTED',
+            updated_at=accepted.updated_at
+        ).update(status='WITHDRAWN')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0014_match_job_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='riderequest',
+            name='status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('ACCEPTED', 'Accepted'), ('REJECTED', 'Rejected'), ('EXPIRED', 'Expired'), ('WITHDRAWN', 'Withdrawn')], default='PENDING', max_length=20),
+        ),
+        migrations.RunPython(withdraw_siblings, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-19 10:05
+
+from django.db import migrations, models
+
+
+def mark_completed_rides(apps, schema_editor):
+    # Rides completed so far were counted as they completed or by build_traffic_profile
+    Ride = apps.get_model('matching', 'Ride')
+    Ride.objects.filter(status='COMPLETED').update(traffic_counted=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('matching', '0015_riderequest_withdrawn'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ride',
+            name='traffic_counted',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.RunPython(mark_completed_rides, migrations.RunPython.noop),
+    ]
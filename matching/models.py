@@ -1,5 +1,14 @@
+from django.conf import settings
 from django.db import models
 from django.contrib.auth.models import User
+from .services.geohash import encode_location
+from .services import preferences as preference_vocabulary
+
+def region_for(location) -> str:
+    """Region key (coarse geohash prefix) used to shard drivers and rides"""
+    if not location:
+        return ''
+    return encode_location(location, getattr(settings, 'MATCHING_REGION_PRECISION', 4))
 
 # Create your models here.
 class Driver(models.Model):
@@ -10,6 +19,25 @@ class Driver(models.Model):
     rating = models.FloatField(default=5.0)
     preferences = models.JSONField(default=dict)  # { "smoking": False, "music": True, "pets": False }
     available = models.BooleanField(default=True)
+    region = models.CharField(max_length=12, blank=True, default='', db_index=True)
+    # preferences encoded over the fixed vocabulary in services/preferences.py
+    preference_mask = models.PositiveIntegerField(default=0, db_index=True)
+    preference_known = models.PositiveIntegerField(default=0)
+    # Last heartbeat or location ping, written in batches by services/presence.py
+    last_seen = models.DateTimeField(null=True, blank=True, db_index=True)
+    
+    def save(self, *args, **kwargs):
+        self.region = region_for(self.location)
+        self.preference_mask, self.preference_known = preference_vocabulary.encode(self.preferences)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            derived = set()
+            if 'location' in update_fields:
+                derived.add('region')
+            if 'preferences' in update_fields:
+                derived.update(('preference_mask', 'preference_known'))
+            kwargs['update_fields'] = {*update_fields, *derived}
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return f"{self.firstname} {self.lastname}"
@@ -21,6 +49,15 @@ class Passenger(models.Model):
     pickup_location = models.JSONField(null=True, blank=True)  # (latitude, longitude)
     destination = models.JSONField(null=True, blank=True)  # (latitude, longitude)
     preferences = models.JSONField(default=dict)
+    preference_mask = models.PositiveIntegerField(default=0)
+    preference_known = models.PositiveIntegerField(default=0)
+    
+    def save(self, *args, **kwargs):
+        self.preference_mask, self.preference_known = preference_vocabulary.encode(self.preferences)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'preferences' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'preference_mask', 'preference_known'}
+        super().save(*args, **kwargs)
     
     def __str__(self):
         return f"{self.firstname} {self.lastname}"
@@ -31,6 +68,9 @@ class Ride(models.Model):
     pickup_location = models.JSONField()
     destination = models.JSONField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set when the ride moves to IN_PROGRESS and COMPLETED
+    started_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True, db_index=True)
     status = models.CharField(
         max_length=20,
         choices=[
@@ -42,6 +82,74 @@ class Ride(models.Model):
         ],
         default='PENDING'
     )
+    region = models.CharField(max_length=12, blank=True, default='', db_index=True)
+    # Dispatch state: how the ride is offered to drivers, the ranking from the
+    # match ([{'driver': id, 'score': float, 'location': {...}}], best first),
+    # how many ranking entries have been used and the current offer wave
+    dispatch_policy = models.CharField(
+        max_length=20,
+        choices=[
+            ('broadcast', 'Broadcast'),
+            ('sequential', 'Sequential'),
+            ('wave', 'Wave')
+        ],
+        default='broadcast'
+    )
+    ranking = models.JSONField(default=list, blank=True)
+    offered = models.PositiveIntegerField(default=0)
+    wave = models.PositiveIntegerField(default=0)
+    # Route planned at accept time (driver -> pickup -> destination): encoded
+    # polyline, total distance (m) and duration (s), and those of the pickup leg
+    route = models.JSONField(default=dict, blank=True)
+    # Shared rides take further passengers (RidePassenger) up to capacity;
+    # stops is the remaining stop sequence, in order:
+    # [{'passenger': id, 'kind': 'pickup' | 'dropoff', 'location': {...}}]
+    shared = models.BooleanField(default=False)
+    capacity = models.PositiveSmallIntegerField(default=1)
+    stops = models.JSONField(default=list, blank=True)
+    # Whether the trip speed has been counted in the traffic profile, so no ride is counted twice
+    traffic_counted = models.BooleanField(default=False)
+    
+    def save(self, *args, **kwargs):
+        self.region = region_for(self.pickup_location)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'pickup_location' in update_fields:
+            kwargs['update_fields'] = {*update_fields, 'region'}
+        super().save(*args, **kwargs)
+
+class RidePassenger(models.Model):
+    """
+    A passenger on a shared ride. detour_km is how much later (in km driven)
+    they reach their destination because of other passengers' stops, at most
+    max_detour_km.
+    """
+    WAITING = 'WAITING'
+    ON_BOARD = 'ON_BOARD'
+    DROPPED_OFF = 'DROPPED_OFF'
+    
+    ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='riders')
+    passenger = models.ForeignKey(Passenger, on_delete=models.CASCADE, related_name='shared_rides')
+    pickup_location = models.JSONField()
+    destination = models.JSONField()
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            (WAITING, 'Waiting'),
+            (ON_BOARD, 'On board'),
+            (DROPPED_OFF, 'Dropped off')
+        ],
+        default=WAITING
+    )
+    direct_km = models.FloatField()
+    max_detour_km = models.FloatField()
+    detour_km = models.FloatField(default=0)
+    joined_at = models.DateTimeField(auto_now_add=True)
+    
+    class Meta:
+        unique_together = ('ride', 'passenger')
+    
+    def __str__(self):
+        return f"{self.passenger} on ride {self.ride_id} ({self.status})"
     
 class RideRequest(models.Model):
     ride = models.ForeignKey(Ride, on_delete=models.CASCADE, related_name='requests')
@@ -52,16 +160,93 @@ class RideRequest(models.Model):
             ('PENDING', 'Pending'),
             ('ACCEPTED', 'Accepted'),
             ('REJECTED', 'Rejected'),
-            ('EXPIRED', 'Expired')
+            ('EXPIRED', 'Expired'),
+            # Closed without the driver's answer: another driver took the ride, or it was cancelled
+            ('WITHDRAWN', 'Withdrawn')
         ],
         default='PENDING'
     )
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Offer wave of the ride this request belongs to, and when it lapses (None: never)
+    wave = models.PositiveIntegerField(default=1)
+    expires_at = models.DateTimeField(null=True, blank=True, db_index=True)
     
     class Meta:
         unique_together = ('ride', 'driver')
     
     def __str__(self):
         return f"Request for ride {self.ride.id} to driver {self.driver}"
-    
\ No newline at end of file
+    
+class MatchJob(models.Model):
+    """A queued /match/ request, processed by the match worker pool"""
+    passenger = models.ForeignKey(Passenger, on_delete=models.CASCADE, related_name='match_jobs')
+    pickup_location = models.JSONField()
+    destination = models.JSONField()
+    status = models.CharField(
+        max_length=20,
+        choices=[
+            ('QUEUED', 'Queued'),
+            ('RUNNING', 'Running'),
+            ('COMPLETED', 'Completed'),
+            ('FAILED', 'Failed')
+        ],
+        default='QUEUED',
+        db_index=True
+    )
+    ride = models.ForeignKey(Ride, on_delete=models.SET_NULL, null=True, blank=True, related_name='match_jobs')
+    error = models.TextField(blank=True, default='')
+    worker = models.CharField(max_length=100, blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    # Renewed by the worker while it runs the job; requeued once it lapses
+    lease_expires_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    def __str__(self):
+        return f"Match job {self.id} for {self.passenger} ({self.status})"
+
+class Zone(models.Model):
+    """A geofenced area; polygon is a list of {'latitude', 'longitude'} points"""
+    AIRPORT_QUEUE = 'AIRPORT_QUEUE'
+    NO_PICKUP = 'NO_PICKUP'
+    CITY = 'CITY'
+    
+    name = models.CharField(max_length=100)
+    kind = models.CharField(
+        max_length=20,
+        choices=[
+            (AIRPORT_QUEUE, 'Airport queue'),
+            (NO_PICKUP, 'No pickup'),
+            (CITY, 'City')
+        ]
+    )
+    polygon = models.JSONField()
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    def clean(self):
+        from django.core.exceptions import ValidationError
+        if not isinstance(self.polygon, list) or len(self.polygon) < 3:
+            raise ValidationError({'polygon': 'A polygon needs at least 3 points'})
+        for point in self.polygon:
+            if not isinstance(point, dict) or 'latitude' not in point or 'longitude' not in point:
+                raise ValidationError({'polygon': 'Each point needs a latitude and a longitude'})
+    
+    def __str__(self):
+        return f"{self.name} ({self.get_kind_display()})"
+
+class TrafficProfile(models.Model):
+    """Typical traffic score (1 = free flow) of an area in one hour of the week (0 = Monday 00:00 UTC)"""
+    cell = models.CharField(max_length=12)
+    hour = models.PositiveSmallIntegerField()
+    score = models.FloatField()
+    samples = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    
+    class Meta:
+        unique_together = ('cell', 'hour')
+    
+    def __str__(self):
+        return f"Traffic in {self.cell} at hour {self.hour}: {self.score:.2f}"
@@ -1,13 +1,14 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from django.contrib.auth.password_validation import validate_password
-from .models import Driver, Passenger, Ride, RideRequest
+from .models import Driver, Passenger, Ride, RidePassenger, RideRequest, MatchJob
 from .services.distance_calculator import calculate_distance
 
 class DriverSerializer(serializers.ModelSerializer):
     class Meta:
         model = Driver
-        fields = ['id', 'firstname', 'lastname', 'location', 'rating', 'preferences', 'available']
+        fields = ['id', 'firstname', 'lastname', 'location', 'rating', 'preferences', 'available', 'last_seen']
+        read_only_fields = ['last_seen']
 
 class PassengerSerializer(serializers.ModelSerializer):
     class Meta:
@@ -19,21 +20,48 @@ class RideMatchRequestSerializer(serializers.Serializer):
     pickup_location = serializers.JSONField()
     destination = serializers.JSONField()
     preferences = serializers.JSONField(required=False)
+    run_async = serializers.BooleanField(required=False, default=False)
+    shared = serializers.BooleanField(required=False, default=False)
+
+class MatchJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = MatchJob
+        fields = ['id', 'passenger', 'pickup_location', 'destination', 'status',
+                 'ride', 'error', 'created_at', 'started_at', 'finished_at']
 
 class RouteRequestSerializer(serializers.Serializer):
     origin = serializers.JSONField()
     destination = serializers.JSONField()
     waypoints = serializers.JSONField(required=False)
 
+class PointSerializer(serializers.Serializer):
+    latitude = serializers.FloatField(min_value=-90, max_value=90)
+    longitude = serializers.FloatField(min_value=-180, max_value=180)
+
+class TravelMatrixRequestSerializer(serializers.Serializer):
+    origins = serializers.ListField(child=PointSerializer(), min_length=1)
+    destinations = serializers.ListField(child=PointSerializer(), min_length=1)
+    mode = serializers.ChoiceField(choices=['live', 'estimate'], default='live')
+    stream = serializers.BooleanField(required=False, default=True)
+
+class RidePassengerSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = RidePassenger
+        fields = ['id', 'ride', 'passenger', 'pickup_location', 'destination', 'status',
+                 'direct_km', 'max_detour_km', 'detour_km', 'joined_at']
+
 class RideSerializer(serializers.ModelSerializer):
     driver_name = serializers.SerializerMethodField()
     passenger_name = serializers.SerializerMethodField()
     trip_distance = serializers.SerializerMethodField()
+    riders = RidePassengerSerializer(many=True, read_only=True)
     
     class Meta:
         model = Ride
         fields = ['id', 'driver', 'driver_name', 'passenger', 'passenger_name', 
-                 'pickup_location', 'destination', 'trip_distance', 'created_at', 'status']
+                 'pickup_location', 'destination', 'trip_distance', 'created_at', 'status',
+                 'shared', 'capacity', 'stops', 'riders']
+        read_only_fields = ['shared', 'capacity', 'stops']
     
     def get_driver_name(self, obj):
         return f"{obj.driver.firstname} {obj.driver.lastname}" if obj.driver else None
@@ -169,7 +197,7 @@ class RideRequestSerializer(serializers.ModelSerializer):
         model = RideRequest
         fields = ['id', 'ride', 'driver', 'driver_name', 'passenger_name',
                  'pickup_location', 'destination', 'distance_to_pickup', 
-                 'trip_distance', 'status', 'created_at', 'updated_at']
+                 'trip_distance', 'status', 'wave', 'expires_at', 'created_at', 'updated_at']
         read_only_fields = ['created_at', 'updated_at']
     
     def get_driver_name(self, obj):
@@ -0,0 +1,81 @@
+from typing import Hashable
+from collections import OrderedDict
+import threading
+import time
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class TokenBuckets:
+    """
+    Token buckets keyed by (endpoint class, client). Each bucket refills at
+    rate tokens per second up to burst; a request takes one token. Buckets are
+    per process and the least recently used are dropped beyond max_entries.
+    """
+
+    def __init__(self, max_entries: int = 100000):
+        self.max_entries = max_entries
+        self.buckets: 'OrderedDict[Hashable, list]' = OrderedDict()
+        self.lock = threading.Lock()
+        metrics.register_gauge('rate_limit_buckets', lambda: len(self.buckets))
+
+    def take(self, key: Hashable, rate: float, burst: float) -> float:
+        """Take a token; returns 0 if one was available, else seconds until there is one"""
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = [burst, now]
+                while len(self.buckets) > self.max_entries:
+                    self.buckets.popitem(last=False)
+            else:
+                self.buckets.move_to_end(key)
+                bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0
+            return (1 - bucket[0]) / rate
+
+class ConcurrencyLimiter:
+    """
+    Caps how many requests of one kind run at once in this process. A request
+    over the limit waits up to queue_timeout for a slot and is then rejected,
+    so a surge sheds load instead of slowing every request down together.
+    """
+
+    def __init__(self, name: str, limit: int, queue_timeout: float = 0.25, retry_after: int = 1):
+        self.name = name
+        self.limit = limit
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.slots = threading.BoundedSemaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.lock = threading.Lock()
+        metrics.register_gauge('admission_in_flight', lambda: self.in_flight, limiter=name)
+        metrics.register_gauge('admission_waiting', lambda: self.waiting, limiter=name)
+        metrics.set_gauge('admission_limit', limit, limiter=name)
+
+    def acquire(self) -> bool:
+        with self.lock:
+            self.waiting += 1
+        try:
+            acquired = self.slots.acquire(timeout=self.queue_timeout)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if not acquired:
+            metrics.inc('admission_rejected_total', limiter=self.name)
+            logger.warning(f"Shedding {self.name} request: {self.limit} already in flight")
+            return False
+        with self.lock:
+            self.in_flight += 1
+        metrics.inc('admission_admitted_total', limiter=self.name)
+        return True
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
@@ -0,0 +1,120 @@
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from collections import OrderedDict
+import threading
+import time
+from ..models import Driver
+from .metrics import metrics
+from . import geohash
+import logging
+
+logger = logging.getLogger('matching')
+
+# (driver, distance to the pickup in km), nearest first
+Ranking = List[Tuple[Driver, float]]
+
+class CandidateCache:
+    """
+    Short-lived cache of the passenger-independent candidate ranking per pickup cell.
+
+    Entries are keyed by the geohash cell of the pickup and the passenger's hard
+    preference requirements. An entry is dropped when a driver it contains
+    moves, changes availability or gets a ride, and when any driver updates in
+    the entry's cell or a neighbouring one (it may now be a closer candidate).
+    The cache is per process: with the shared driver state table, updates made
+    by other workers only reach it through the TTL.
+    """
+
+    def __init__(self, ttl: float = 5, precision: int = 7, max_entries: int = 10000):
+        self.ttl = ttl
+        self.precision = precision
+        self.max_entries = max_entries
+        self.entries: 'OrderedDict[Tuple[str, int], Tuple[float, Ranking]]' = OrderedDict()
+        self.by_cell: Dict[str, Set[Tuple[str, int]]] = {}
+        self.by_driver: Dict[int, Set[Tuple[str, int]]] = {}
+        self.lock = threading.Lock()
+
+    def cell(self, location: Dict) -> str:
+        return geohash.encode_location(location, self.precision)
+
+    def get(self, pickup_location: Dict, required: int = 0) -> Optional[Ranking]:
+        key = (self.cell(pickup_location), required)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                self._drop(key)
+                entry = None
+        if entry is None:
+            metrics.inc('candidate_cache_misses_total')
+            return None
+        metrics.inc('candidate_cache_hits_total')
+        return entry[1]
+
+    def put(self, pickup_location: Dict, required: int, ranking: Ranking):
+        key = (self.cell(pickup_location), required)
+        with self.lock:
+            self._drop(key)
+            self.entries[key] = (time.monotonic() + self.ttl, ranking)
+            self.by_cell.setdefault(key[0], set()).add(key)
+            for driver, _ in ranking:
+                self.by_driver.setdefault(driver.id, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)))
+
+    def _drop(self, key: Tuple[str, int]):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self.by_cell.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.by_cell[key[0]]
+        for driver, _ in entry[1]:
+            keys = self.by_driver.get(driver.id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_driver[driver.id]
+
+    def invalidate_driver(self, driver_id: int) -> int:
+        """Drop every entry that ranks the driver"""
+        with self.lock:
+            keys = list(self.by_driver.get(driver_id, ()))
+            for key in keys:
+                self._drop(key)
+        if keys:
+            metrics.inc('candidate_cache_invalidations_total', len(keys))
+        return len(keys)
+
+    def invalidate_near(self, locations: Iterable[Optional[Dict]]) -> int:
+        """Drop the entries for the cells of the given locations and their neighbours"""
+        cells = set()
+        for location in locations:
+            if location:
+                cell = self.cell(location)
+                cells.add(cell)
+                cells.update(geohash.neighbours(cell))
+        dropped = 0
+        with self.lock:
+            for cell in cells:
+                for key in list(self.by_cell.get(cell, ())):
+                    self._drop(key)
+                    dropped += 1
+        if dropped:
+            metrics.inc('candidate_cache_invalidations_total', dropped)
+        return dropped
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.by_cell.clear()
+            self.by_driver.clear()
+
+    def on_driver_updated(self, sender, driver: Driver, previous_location=None, **kwargs):
+        """Receiver for driver_updated"""
+        self.invalidate_driver(driver.id)
+        self.invalidate_near((previous_location, driver.location))
+
+    def on_ride_accepted(self, sender, ride, driver: Driver, **kwargs):
+        """Receiver for ride_accepted"""
+        self.invalidate_driver(driver.id)
@@ -0,0 +1,375 @@
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+from math import cos, floor, radians
+import threading
+import time
+from django.db import transaction
+from django.db.models import F
+from ..models import Driver, Passenger, Ride, RidePassenger
+from .distance_calculator import calculate_distance, distances_from, prepare_point
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+KM_PER_DEGREE = 111.32
+
+ACTIVE_STATUSES = ('ACCEPTED', 'IN_PROGRESS')
+
+Cell = Tuple[int, int]
+
+# (passenger id, status, max_detour_km, detour_km)
+RiderRow = Tuple[int, str, float, float]
+
+class Insertion(NamedTuple):
+    ride_id: int
+    # The stop sequence the insertion was planned on, checked again when it is applied
+    stops: List[Dict]
+    # The new pickup and dropoff go after these points of the plan (0 = the driver)
+    pickup_after: int
+    dropoff_after: int
+    added_km: float
+    pickup_km: float
+    ride_km: float
+    # passenger id -> km their arrival is pushed back by
+    delays: Dict[int, float]
+
+class SharedRide:
+    """
+    Planning view of an active shared ride: the driver's position followed by
+    the remaining stops, with the leg lengths, the distance to each point,
+    the passengers on board on each leg and each passenger's detour slack
+    """
+
+    def __init__(self, ride_id: int, driver_id: int, capacity: int, stops: List[Dict], riders: List[RiderRow], driver_location: Optional[Dict]):
+        self.ride_id = ride_id
+        self.driver_id = driver_id
+        self.capacity = capacity
+        self.stops = stops
+        self.rider_rows = riders
+        self.locations = [driver_location or stops[0]['location']] + [stop['location'] for stop in stops]
+        self.points = [prepare_point(location) for location in self.locations]
+        self.legs = [calculate_distance(a, b) for a, b in zip(self.locations, self.locations[1:])]
+        self.prefix = [0.0]
+        for leg in self.legs:
+            self.prefix.append(self.prefix[-1] + leg)
+
+        # Legs run from point k to k + 1; load[k] passengers ride on leg k. Anything
+        # added before a passenger's dropoff point delays their arrival, whether
+        # they are on board yet or still waiting.
+        self.load = [sum(1 for _, status, _, _ in riders if status == RidePassenger.ON_BOARD)]
+        dropoffs = {}
+        for k, stop in enumerate(stops, start=1):
+            if stop['kind'] == 'pickup':
+                self.load.append(self.load[-1] + 1)
+            else:
+                self.load.append(self.load[-1] - 1)
+                dropoffs[stop['passenger']] = k
+        self.riders = [
+            (passenger_id, dropoffs[passenger_id], max_detour_km - detour_km)
+            for passenger_id, status, max_detour_km, detour_km in riders
+            if passenger_id in dropoffs
+        ]
+
+    def moved(self, driver_location: Optional[Dict]) -> 'SharedRide':
+        return SharedRide(self.ride_id, self.driver_id, self.capacity, self.stops, self.rider_rows, driver_location)
+
+    def delays(self, pickup_after: int, pickup_added: float, dropoff_after: int, dropoff_added: float) -> Optional[Dict[int, float]]:
+        """Km each passenger's arrival is pushed back by, or None if that exceeds someone's slack"""
+        delays = {}
+        for passenger_id, dropoff, slack in self.riders:
+            delay = (pickup_added if pickup_after < dropoff else 0) + (dropoff_added if dropoff_after < dropoff else 0)
+            if delay > slack + 1e-9:
+                return None
+            if delay:
+                delays[passenger_id] = delay
+        return delays
+
+class CarpoolService:
+    """
+    Shared rides: pending passengers are inserted into active rides when the
+    detour stays within limits.
+
+    Active shared rides are kept in memory, bucketed on a grid by the cells
+    of the driver's position and of every remaining stop, and kept current
+    from ride and driver events (and a reload every reload_interval seconds
+    for changes made by other processes). A search only looks at rides with
+    a point within max_pickup_km of the pickup and, for each, tries every
+    place for the new pickup and dropoff in the stop sequence (cheapest
+    insertion). The distances from the new pickup and destination to all of
+    a ride's points are computed in one batch, and leg lengths and distances
+    along the plan are precomputed, so a candidate ride costs two batched
+    haversine passes and a few additions per insertion position.
+
+    An insertion is accepted when the car never carries more than capacity
+    passengers, the car covers at most max_pickup_km before the pickup, the
+    new passenger's trip grows by at most max_detour_ratio of its direct
+    length (and max_detour_km), and no rider's arrival is pushed back by
+    more than the same allowance of theirs, less the detours they already
+    took.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 3,
+        max_detour_ratio: float = 0.5,
+        max_detour_km: float = 5,
+        max_pickup_km: float = 4,
+        cell_degrees: float = 0.01,
+        reload_interval: float = 30
+    ):
+        self.capacity = capacity
+        self.max_detour_ratio = max_detour_ratio
+        self.max_detour_km = max_detour_km
+        self.max_pickup_km = max_pickup_km
+        self.cell_degrees = cell_degrees
+        self.reload_interval = reload_interval
+        self.rides: Dict[int, SharedRide] = {}
+        self.cells: Dict[Cell, Set[int]] = {}
+        self.ride_cells: Dict[int, Set[Cell]] = {}
+        self.driver_rides: Dict[int, int] = {}
+        self.loaded_at: Optional[float] = None
+        self.lock = threading.Lock()
+        metrics.register_gauge('carpool_active_rides', lambda: len(self.rides))
+
+    def cell(self, location: Dict) -> Cell:
+        return floor(location['latitude'] / self.cell_degrees), floor(location['longitude'] / self.cell_degrees)
+
+    def allowance(self, direct_km: float) -> float:
+        """How much longer than direct_km a passenger's trip may become"""
+        return min(direct_km * self.max_detour_ratio, self.max_detour_km)
+
+    @staticmethod
+    def build(ride: Ride) -> Optional[SharedRide]:
+        if not ride.shared or ride.status not in ACTIVE_STATUSES or not ride.stops:
+            return None
+        riders = [
+            (rider.passenger_id, rider.status, rider.max_detour_km, rider.detour_km)
+            for rider in ride.riders.all()
+        ]
+        return SharedRide(ride.id, ride.driver_id, ride.capacity, ride.stops, riders, ride.driver.location)
+
+    def _index(self, shared: SharedRide):
+        self._unindex(shared.ride_id)
+        cells = {self.cell(location) for location in shared.locations}
+        self.rides[shared.ride_id] = shared
+        self.ride_cells[shared.ride_id] = cells
+        self.driver_rides[shared.driver_id] = shared.ride_id
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(shared.ride_id)
+
+    def _unindex(self, ride_id: int):
+        shared = self.rides.pop(ride_id, None)
+        if shared is not None and self.driver_rides.get(shared.driver_id) == ride_id:
+            del self.driver_rides[shared.driver_id]
+        for cell in self.ride_cells.pop(ride_id, ()):
+            bucket = self.cells.get(cell)
+            if bucket is not None:
+                bucket.discard(ride_id)
+                if not bucket:
+                    del self.cells[cell]
+
+    def load(self):
+        """(Re)build the index from the active shared rides in the database"""
+        rides = Ride.objects.filter(
+            shared=True, status__in=ACTIVE_STATUSES
+        ).select_related('driver').prefetch_related('riders')
+        built = [shared for shared in (self.build(ride) for ride in rides) if shared is not None]
+        with self.lock:
+            self.rides, self.cells, self.ride_cells, self.driver_rides = {}, {}, {}, {}
+            for shared in built:
+                self._index(shared)
+            self.loaded_at = time.monotonic()
+        logger.debug(f"Carpool index loaded with {len(built)} shared rides")
+
+    def ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.reload_interval:
+            self.load()
+
+    def refresh_ride(self, ride_id: int):
+        """Re-read one ride after its stops or status changed"""
+        ride = Ride.objects.select_related('driver').prefetch_related('riders').filter(id=ride_id).first()
+        shared = self.build(ride) if ride is not None else None
+        with self.lock:
+            if shared is None:
+                self._unindex(ride_id)
+            else:
+                self._index(shared)
+
+    def candidates(self, location: Dict) -> Set[int]:
+        """Ids of the rides with a point in the cells within max_pickup_km of a location"""
+        centre = self.cell(location)
+        reach_lat = int(self.max_pickup_km / (self.cell_degrees * KM_PER_DEGREE)) + 1
+        reach_lng = int(self.max_pickup_km / (self.cell_degrees * KM_PER_DEGREE * max(cos(radians(location['latitude'])), 0.01))) + 1
+        found = set()
+        with self.lock:
+            for i in range(centre[0] - reach_lat, centre[0] + reach_lat + 1):
+                for j in range(centre[1] - reach_lng, centre[1] + reach_lng + 1):
+                    bucket = self.cells.get((i, j))
+                    if bucket:
+                        found |= bucket
+        return found
+
+    def best_insertion(self, shared: SharedRide, pickup: Dict, destination: Dict, direct_km: float, allowance: float) -> Optional[Insertion]:
+        """Cheapest feasible place for a new passenger in one ride's plan"""
+        n = len(shared.points)
+        to_pickup = distances_from(pickup, shared.points)
+        to_destination = distances_from(destination, shared.points)
+        legs, prefix, load = shared.legs, shared.prefix, shared.load
+        best = None
+        for i in range(n):
+            if prefix[i] > self.max_pickup_km:
+                break
+            if load[i] >= shared.capacity or prefix[i] + to_pickup[i] > self.max_pickup_km:
+                continue
+            last = i == n - 1
+            # Pickup and dropoff one after the other, straight after point i
+            added = to_pickup[i] + direct_km + (0 if last else to_destination[i + 1] - legs[i])
+            if best is None or added < best.added_km:
+                delays = shared.delays(i, added, i, 0)
+                if delays is not None:
+                    best = Insertion(shared.ride_id, shared.stops, i, i, added, prefix[i] + to_pickup[i], direct_km, delays)
+            if last:
+                continue
+            pickup_added = to_pickup[i] + to_pickup[i + 1] - legs[i]
+            for j in range(i + 1, n):
+                if load[j] >= shared.capacity:
+                    break
+                # The new passenger's trip only gets longer as the dropoff moves later
+                ride_km = to_pickup[i + 1] + prefix[j] - prefix[i + 1] + to_destination[j]
+                if ride_km - direct_km > allowance:
+                    break
+                dropoff_added = to_destination[j] + (to_destination[j + 1] - legs[j] if j < n - 1 else 0)
+                added = pickup_added + dropoff_added
+                if best is not None and added >= best.added_km:
+                    continue
+                delays = shared.delays(i, pickup_added, j, dropoff_added)
+                if delays is not None:
+                    best = Insertion(shared.ride_id, shared.stops, i, j, added, prefix[i] + to_pickup[i], ride_km, delays)
+        return best
+
+    def find_insertion(self, pickup: Dict, destination: Dict) -> Optional[Insertion]:
+        """The active shared ride a new passenger adds the least distance to, if any can take them"""
+        started = time.monotonic()
+        self.ensure_loaded()
+        direct_km = calculate_distance(pickup, destination)
+        allowance = self.allowance(direct_km)
+        best = None
+        candidates = self.candidates(pickup)
+        for ride_id in candidates:
+            shared = self.rides.get(ride_id)
+            if shared is None:
+                continue
+            insertion = self.best_insertion(shared, pickup, destination, direct_km, allowance)
+            if insertion is not None and (best is None or insertion.added_km < best.added_km):
+                best = insertion
+        metrics.inc('carpool_searches_total')
+        logger.debug(
+            f"Carpool search over {len(candidates)} rides took {(time.monotonic() - started) * 1000:.2f} ms"
+        )
+        return best
+
+    def open(self, ride: Ride) -> RidePassenger:
+        """Make a new ride shared, with its passenger as the first rider"""
+        direct_km = calculate_distance(ride.pickup_location, ride.destination)
+        with transaction.atomic():
+            rider = RidePassenger.objects.create(
+                ride=ride,
+                passenger=ride.passenger,
+                pickup_location=ride.pickup_location,
+                destination=ride.destination,
+                direct_km=direct_km,
+                max_detour_km=self.allowance(direct_km)
+            )
+            ride.shared = True
+            ride.capacity = self.capacity
+            ride.stops = [
+                {'passenger': ride.passenger_id, 'kind': 'pickup', 'location': ride.pickup_location},
+                {'passenger': ride.passenger_id, 'kind': 'dropoff', 'location': ride.destination}
+            ]
+            ride.save(update_fields=['shared', 'capacity', 'stops'])
+        return rider
+
+    def insert(self, insertion: Insertion, passenger: Passenger, pickup: Dict, destination: Dict) -> Optional[Tuple[Ride, RidePassenger]]:
+        """Apply an insertion, unless the ride's plan changed since it was found"""
+        direct_km = calculate_distance(pickup, destination)
+        with transaction.atomic():
+            ride = Ride.objects.select_for_update().filter(id=insertion.ride_id, status__in=ACTIVE_STATUSES).first()
+            if ride is None or ride.stops != insertion.stops:
+                metrics.inc('carpool_conflicts_total')
+                return None
+            i, j = insertion.pickup_after, insertion.dropoff_after
+            ride.stops = (
+                ride.stops[:i]
+                + [{'passenger': passenger.id, 'kind': 'pickup', 'location': pickup}]
+                + ride.stops[i:j]
+                + [{'passenger': passenger.id, 'kind': 'dropoff', 'location': destination}]
+                + ride.stops[j:]
+            )
+            ride.save(update_fields=['stops'])
+            for passenger_id, delay in insertion.delays.items():
+                RidePassenger.objects.filter(ride=ride, passenger_id=passenger_id).update(detour_km=F('detour_km') + delay)
+            rider = RidePassenger.objects.create(
+                ride=ride,
+                passenger=passenger,
+                pickup_location=pickup,
+                destination=destination,
+                direct_km=direct_km,
+                max_detour_km=self.allowance(direct_km),
+                detour_km=max(0.0, insertion.ride_km - direct_km)
+            )
+            transaction.on_commit(lambda: self.refresh_ride(ride.id))
+        return ride, rider
+
+    def join(self, passenger: Passenger, pickup: Dict, destination: Dict, attempts: int = 2) -> Optional[Tuple[Ride, RidePassenger]]:
+        """Put a passenger on the best active shared ride; None if no ride can take them"""
+        for _ in range(attempts):
+            insertion = self.find_insertion(pickup, destination)
+            if insertion is None:
+                return None
+            joined = self.insert(insertion, passenger, pickup, destination)
+            if joined is not None:
+                metrics.inc('carpool_insertions_total')
+                logger.info(
+                    f"Passenger {passenger.id} joined ride {insertion.ride_id}, "
+                    f"adding {insertion.added_km:.2f} km to its route"
+                )
+                return joined
+            # Another process changed the ride first: plan again on its current stops
+            self.refresh_ride(insertion.ride_id)
+        return None
+
+    def complete_stop(self, ride: Ride) -> Optional[Dict]:
+        """Mark the next stop of a shared ride done; returns it, or None if none are left"""
+        with transaction.atomic():
+            ride = Ride.objects.select_for_update().get(id=ride.id)
+            if not ride.stops:
+                return None
+            stop, ride.stops = ride.stops[0], ride.stops[1:]
+            ride.save(update_fields=['stops'])
+            RidePassenger.objects.filter(ride=ride, passenger_id=stop['passenger']).update(
+                status=RidePassenger.ON_BOARD if stop['kind'] == 'pickup' else RidePassenger.DROPPED_OFF
+            )
+            transaction.on_commit(lambda: self.refresh_ride(ride.id))
+        return stop
+
+    def on_ride_accepted(self, sender, ride: Ride, **kwargs):
+        """Receiver for ride_accepted"""
+        if ride.shared:
+            self.refresh_ride(ride.id)
+
+    def on_ride_status_changed(self, sender, ride: Ride, **kwargs):
+        """Receiver for ride_status_changed"""
+        if ride.shared and ride.status not in ACTIVE_STATUSES:
+            with self.lock:
+                self._unindex(ride.id)
+
+    def on_driver_updated(self, sender, driver: Driver, **kwargs):
+        """Receiver for driver_updated: the first leg of their shared ride starts where they are"""
+        ride_id = self.driver_rides.get(driver.id)
+        shared = self.rides.get(ride_id) if ride_id is not None else None
+        if shared is None or not driver.location:
+            return
+        moved = shared.moved(driver.location)
+        with self.lock:
+            if self.rides.get(ride_id) is shared:
+                self._index(moved)
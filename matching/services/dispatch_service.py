@@ -0,0 +1,254 @@
+from typing import Dict, List, Optional, Tuple
+from datetime import timedelta
+from django.db import transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+from ..models import Driver, Passenger, Ride, RideRequest
+from ..signals import ride_status_changed
+from .distance_calculator import calculate_distance
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class DispatchService:
+    """
+    Turns a ranked list of drivers into a PENDING ride and offers it to drivers.
+
+    The ranking from the match is stored on the ride, and the ride is offered
+    according to a dispatch policy:
+
+    - broadcast: the top max_requests drivers at once, without expiry
+    - sequential: one driver at a time
+    - wave: a few drivers at a time, as many as it takes for the estimated
+      chance that at least one of them accepts to reach target_acceptance,
+      using each driver's acceptance rate over the last history_days
+
+    Sequential and wave offers expire after wave_timeout seconds. When every
+    request of the current wave was rejected or expired, the next drivers in the
+    stored ranking get the offer; nothing is rescored. Before that they are
+    revalidated against the database without any upstream calls: a driver who
+    became unavailable or went silent, took another ride or moved more than
+    max_drift_km since the match is skipped. A ride whose ranking runs out is
+    cancelled, so the passenger sees it was not matched and can ask again.
+    """
+
+    BROADCAST = 'broadcast'
+    SEQUENTIAL = 'sequential'
+    WAVE = 'wave'
+    POLICIES = (BROADCAST, SEQUENTIAL, WAVE)
+
+    # Request statuses that say something about the driver. An offer left to
+    # expire counts as not accepted, as a wave is sized for someone accepting
+    # within wave_timeout; withdrawn offers (taken by another driver or
+    # cancelled) were never the driver's to answer.
+    ANSWERED = ('ACCEPTED', 'REJECTED', 'EXPIRED')
+
+    def __init__(
+        self,
+        max_requests: int = 3,
+        policy: str = BROADCAST,
+        wave_timeout: float = 20,
+        max_wave_size: int = 3,
+        target_acceptance: float = 0.8,
+        ranking_size: int = 20,
+        history_days: int = 30,
+        max_drift_km: float = 2.0,
+        presence=None
+    ):
+        if policy not in self.POLICIES:
+            raise ValueError(f"Unknown dispatch policy: {policy}")
+        self.max_requests = max_requests
+        self.policy = policy
+        self.wave_timeout = wave_timeout
+        self.max_wave_size = max_wave_size
+        self.target_acceptance = target_acceptance
+        self.ranking_size = ranking_size
+        self.history_days = history_days
+        self.max_drift_km = max_drift_km
+        self.presence = presence
+
+    def create_ride(
+        self,
+        passenger: Passenger,
+        pickup_location: Dict,
+        destination: Dict,
+        matched_drivers: List[Driver]
+    ) -> Tuple[Ride, List[RideRequest]]:
+        """
+        Create a ride with the first matched driver (required by model) and
+        offer it to the first wave of drivers. The ride remains PENDING until
+        a driver accepts.
+        """
+        scores = getattr(matched_drivers, 'scores', None) or [None] * len(matched_drivers)
+        ranking = [
+            {'driver': driver.id, 'score': score, 'location': driver.location}
+            for driver, score in zip(matched_drivers[:self.ranking_size], scores)
+        ]
+        with transaction.atomic():
+            ride = Ride.objects.create(
+                driver=matched_drivers[0],  # Assign first driver temporarily
+                passenger=passenger,
+                pickup_location=pickup_location,
+                destination=destination,
+                status='PENDING',
+                dispatch_policy=self.policy,
+                ranking=ranking
+            )
+            ride_requests = self.offer(ride, list(matched_drivers[:self.ranking_size]))
+            transaction.on_commit(lambda: ride_status_changed.send(sender=Ride, ride=ride, previous_status=None))
+
+        # Here you would typically send notifications to drivers
+        # This could be implemented with WebSockets, push notifications, etc.
+        logger.info(f"Ride {ride.id} offered to {len(ride_requests)} drivers ({ride.dispatch_policy})")
+        return ride, ride_requests
+
+    def acceptance_rates(self, driver_ids: List[int]) -> Dict[int, float]:
+        """
+        Each driver's share of answered (ANSWERED) ride requests they accepted
+        recently, smoothed towards 1/2 so that drivers with little history are
+        neither trusted nor written off
+        """
+        since = timezone.now() - timedelta(days=self.history_days)
+        rows = RideRequest.objects.filter(
+            driver_id__in=driver_ids,
+            created_at__gte=since,
+            status__in=self.ANSWERED
+        ).values('driver_id').annotate(
+            answered=Count('id'),
+            accepted=Count('id', filter=Q(status='ACCEPTED'))
+        )
+        rates = {driver_id: 0.5 for driver_id in driver_ids}
+        for row in rows:
+            rates[row['driver_id']] = (row['accepted'] + 1) / (row['answered'] + 2)
+        return rates
+
+    def wave_size(self, policy: str, candidates: List[Driver]) -> int:
+        """How many of the next candidates (best first) to offer the ride to at once"""
+        if policy == self.BROADCAST:
+            return min(self.max_requests, len(candidates))
+        if policy == self.SEQUENTIAL or not candidates:
+            return min(1, len(candidates))
+
+        window = candidates[:self.max_wave_size]
+        rates = self.acceptance_rates([driver.id for driver in window])
+        none_accept = 1.0
+        for size, driver in enumerate(window, 1):
+            none_accept *= 1 - rates[driver.id]
+            if 1 - none_accept >= self.target_acceptance:
+                return size
+        return len(window)
+
+    def offer(self, ride: Ride, candidates: List[Driver], consumed: Optional[List[int]] = None) -> List[RideRequest]:
+        """
+        Offer a PENDING ride to the next wave taken from candidates (valid
+        drivers in ranking order). consumed[i] is how far into the ride's
+        ranking candidates[i] sits; it defaults to one entry per candidate.
+        Returns the new requests, or none if another process advanced the
+        ride's wave first. With no candidates left the ride is cancelled.
+        """
+        if consumed is None:
+            consumed = [ride.offered + i + 1 for i in range(len(candidates))]
+        size = self.wave_size(ride.dispatch_policy, candidates)
+        wave = candidates[:size]
+        offered = consumed[size - 1] if size else len(ride.ranking)
+
+        # Compare-and-set on the wave number: only one responder advances it
+        advanced = Ride.objects.filter(
+            id=ride.id,
+            status='PENDING',
+            wave=ride.wave
+        ).update(wave=F('wave') + 1, offered=offered)
+        if not advanced:
+            return []
+        ride.wave += 1
+        ride.offered = offered
+        if not wave:
+            Ride.objects.filter(id=ride.id, status='PENDING').update(status='CANCELLED')
+            ride.status = 'CANCELLED'
+            transaction.on_commit(lambda: ride_status_changed.send(sender=Ride, ride=ride, previous_status='PENDING'))
+            metrics.inc('dispatch_exhausted_total')
+            logger.info(f"Ride {ride.id} has no drivers left to offer it to, cancelled it")
+            return []
+
+        expires_at = None
+        if ride.dispatch_policy != self.BROADCAST:
+            expires_at = timezone.now() + timedelta(seconds=self.wave_timeout)
+        ride_requests = RideRequest.objects.bulk_create([
+            RideRequest(ride=ride, driver=driver, status='PENDING', wave=ride.wave, expires_at=expires_at)
+            for driver in wave
+        ])
+        metrics.inc('dispatch_requests_total', len(ride_requests), policy=ride.dispatch_policy)
+        return ride_requests
+
+    def next_candidates(self, ride: Ride) -> Tuple[List[Driver], List[int]]:
+        """
+        Drivers from the rest of the ride's stored ranking that can still take
+        it, with their positions: available, not offered it before, not on
+        another ride, and still near where they were when they were ranked
+        """
+        remaining = ride.ranking[ride.offered:]
+        ranked_ids = [entry['driver'] for entry in remaining]
+        offered_ids = set(RideRequest.objects.filter(ride=ride).values_list('driver_id', flat=True))
+        busy_ids = set(Ride.objects.filter(
+            driver_id__in=ranked_ids,
+            status__in=['ACCEPTED', 'IN_PROGRESS']
+        ).values_list('driver_id', flat=True))
+        drivers = Driver.objects.in_bulk(ranked_ids)
+        candidates, consumed = [], []
+        for position, entry in enumerate(remaining, ride.offered + 1):
+            driver = drivers.get(entry['driver'])
+            if driver is None or driver.id in offered_ids or driver.id in busy_ids:
+                continue
+            if not driver.available or not driver.location:
+                continue
+            if self.presence is not None and not self.presence.is_present(driver):
+                continue
+            if entry.get('location') and calculate_distance(entry['location'], driver.location) > self.max_drift_km:
+                metrics.inc('dispatch_revalidation_drift_total')
+                continue
+            candidates.append(driver)
+            consumed.append(position)
+        return candidates, consumed
+
+    def advance(self, ride: Ride) -> List[RideRequest]:
+        """
+        Offer a ride to its next wave of drivers once no request of the current
+        wave is pending any more, such as when all of them were rejected or
+        timed out. Timed-out requests are expired here, so dispatch moves on
+        even when no expire_ride_requests sweep is running.
+        """
+        with transaction.atomic():
+            ride = Ride.objects.get(id=ride.id)
+            if ride.status != 'PENDING':
+                return []
+            now = timezone.now()
+            expired = ride.requests.filter(status='PENDING', expires_at__lte=now).update(status='EXPIRED', updated_at=now)
+            if expired:
+                metrics.inc('dispatch_expired_total', expired)
+            if ride.requests.filter(status='PENDING').exists():
+                return []
+            candidates, consumed = self.next_candidates(ride)
+            ride_requests = self.offer(ride, candidates, consumed)
+        if ride_requests:
+            logger.info(f"Ride {ride.id} offered to {len(ride_requests)} more drivers (wave {ride.wave})")
+        return ride_requests
+
+    def expire_requests(self, now=None) -> int:
+        """
+        Expire the pending requests whose wave timed out and offer their rides
+        to the next drivers. Returns the number of requests expired.
+        """
+        now = now or timezone.now()
+        stale = RideRequest.objects.filter(status='PENDING', expires_at__lte=now)
+        ride_ids = set(stale.values_list('ride_id', flat=True))
+        if not ride_ids:
+            return 0
+        expired = stale.filter(ride_id__in=ride_ids).update(status='EXPIRED', updated_at=now)
+        metrics.inc('dispatch_expired_total', expired)
+        for ride in Ride.objects.filter(id__in=ride_ids, status='PENDING'):
+            try:
+                self.advance(ride)
+            except Exception as e:
+                logger.error(f"Error advancing dispatch of ride {ride.id}: {str(e)}")
+        return expired
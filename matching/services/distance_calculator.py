@@ -1,10 +1,16 @@
+from typing import List, Tuple
 from math import radians, sin, cos, sqrt, atan2
 
+EARTH_RADIUS_KM = 6371
+
+# (latitude in radians, longitude in radians, cosine of the latitude)
+PreparedPoint = Tuple[float, float, float]
+
 def calculate_distance(point1: dict, point2: dict) -> float:
     """
     Calculate distance between two points using Haversine formula
     """
-    R = 6371  # Earth's radius in kilometers
+    R = EARTH_RADIUS_KM  # Earth's radius in kilometers
 
     lat1 = radians(point1['latitude'])
     lon1 = radians(point1['longitude'])
@@ -18,4 +24,21 @@ def calculate_distance(point1: dict, point2: dict) -> float:
     c = 2 * atan2(sqrt(a), sqrt(1-a))
     distance = R * c
 
-    return distance 
\ No newline at end of file
+    return distance
+
+def prepare_point(point: dict) -> PreparedPoint:
+    """A point with the trigonometry distances_from needs worked out once"""
+    latitude = radians(point['latitude'])
+    return latitude, radians(point['longitude']), cos(latitude)
+
+def distances_from(point: dict, points: List[PreparedPoint]) -> List[float]:
+    """
+    Haversine distances in km from one point to a batch of prepared points,
+    the same formula as calculate_distance without its per-pair trigonometry
+    """
+    lat1, lon1, cos1 = prepare_point(point)
+    distances = []
+    for lat2, lon2, cos2 in points:
+        a = sin((lat2 - lat1) / 2) ** 2 + cos1 * cos2 * sin((lon2 - lon1) / 2) ** 2
+        distances.append(2 * EARTH_RADIUS_KM * atan2(sqrt(a), sqrt(1 - a)))
+    return distances
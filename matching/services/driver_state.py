@@ -0,0 +1,203 @@
+from typing import Dict, Iterator, List, NamedTuple, Optional
+from contextlib import contextmanager
+import fcntl
+import mmap
+import os
+import shutil
+import struct
+import time
+from ..models import Driver
+import logging
+
+logger = logging.getLogger('matching')
+
+# File layout: a fixed header followed by `capacity` fixed-size records.
+# Slots are appended in order and never reused, so readers only scan [0, count).
+HEADER = struct.Struct('<4sIII48x')   # magic, version, capacity, count
+RECORD = struct.Struct('<I4xqdddfIB7x')   # seq, id, lat, lng, last_seen, rating, preference bits, available
+MAGIC = b'DRVS'
+VERSION = 1
+
+class DriverState(NamedTuple):
+    driver_id: int
+    latitude: float
+    longitude: float
+    last_seen: float
+    rating: float
+    preference_bits: int
+    available: bool
+
+class DriverStateTable:
+    """
+    Fixed-layout driver state table in a memory-mapped file.
+
+    Every web and worker process maps the same file, so driver positions and
+    availability are stored once and are visible to all processes as soon as
+    they are written. Writers serialize on an advisory file lock; readers never
+    lock and use a per-record sequence number to skip records caught mid-write.
+    Point the path at a tmpfs (e.g. /dev/shm) to keep it purely in memory; the
+    file itself survives worker restarts, so a new worker warms up by mapping it.
+    """
+
+    def __init__(self, path: str, capacity: int = 65536):
+        self.path = str(path)
+        self.capacity = capacity
+        self.slots: Dict[int, int] = {}
+        self.indexed = 0
+        self.file = None
+        self.map = None
+        self.pid = None
+
+    def open(self) -> 'DriverStateTable':
+        """Map the table file, creating and sizing it if needed"""
+        if self.map is not None and self.pid == os.getpid():
+            return self
+        # A forked child must not share the parent's file description, or the
+        # flock below would not exclude the parent
+        self.slots = {}
+        self.indexed = 0
+        self.pid = os.getpid()
+        size = HEADER.size + self.capacity * RECORD.size
+        self.file = open(self.path, 'a+b')
+        with self.locked():
+            if os.fstat(self.file.fileno()).st_size < size:
+                self.file.truncate(size)
+            self.map = mmap.mmap(self.file.fileno(), size)
+            magic, version, capacity, _ = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or version != VERSION or capacity != self.capacity:
+                HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.capacity, 0)
+        return self
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.file.close()
+            self.map = None
+            self.file = None
+
+    @contextmanager
+    def locked(self):
+        """Exclusive advisory lock shared by every process writing the table"""
+        fcntl.flock(self.file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+
+    @property
+    def count(self) -> int:
+        return HEADER.unpack_from(self.open().map, 0)[3]
+
+    def _refresh_index(self):
+        """Index slots appended by other processes since the last call"""
+        count = self.count
+        for slot in range(self.indexed, count):
+            driver_id = struct.unpack_from('<q', self.map, HEADER.size + slot * RECORD.size + 8)[0]
+            self.slots[driver_id] = slot
+        self.indexed = count
+
+    def write(self, driver: Driver, last_seen: Optional[float] = None, preference_bits: Optional[int] = None):
+        """Write a driver's current position, availability and preference mask"""
+        self.open()
+        location = driver.location or {}
+        with self.locked():
+            self._refresh_index()
+            slot = self.slots.get(driver.id)
+            if slot is None:
+                if self.indexed >= self.capacity:
+                    logger.error(f"Driver state table is full ({self.capacity} slots), dropping driver {driver.id}")
+                    return
+                slot = self.indexed
+                self.slots[driver.id] = slot
+                self.indexed += 1
+                HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.capacity, self.indexed)
+            
+            offset = HEADER.size + slot * RECORD.size
+            seq = struct.unpack_from('<I', self.map, offset)[0]
+            # An odd sequence number marks the record as being written; readers
+            # retry until they see the same even number before and after reading
+            struct.pack_into('<I', self.map, offset, (seq + 1) & 0xFFFFFFFF)
+            RECORD.pack_into(
+                self.map, offset,
+                (seq + 1) & 0xFFFFFFFF,
+                driver.id,
+                location.get('latitude', 0.0),
+                location.get('longitude', 0.0),
+                last_seen if last_seen is not None else time.time(),
+                driver.rating,
+                driver.preference_mask if preference_bits is None else preference_bits,
+                bool(driver.available and driver.location)
+            )
+            struct.pack_into('<I', self.map, offset, (seq + 2) & 0xFFFFFFFF)
+
+    def _read(self, slot: int) -> Optional[DriverState]:
+        offset = HEADER.size + slot * RECORD.size
+        for _ in range(3):
+            record = RECORD.unpack_from(self.map, offset)
+            if record[0] % 2 == 0 and struct.unpack_from('<I', self.map, offset)[0] == record[0]:
+                return DriverState(*record[1:6], record[6], bool(record[7]))
+        return None
+
+    def get(self, driver_id: int) -> Optional[DriverState]:
+        self.open()
+        if driver_id not in self.slots:
+            self._refresh_index()
+        slot = self.slots.get(driver_id)
+        return self._read(slot) if slot is not None else None
+
+    def __iter__(self) -> Iterator[DriverState]:
+        self.open()
+        for slot in range(self.count):
+            state = self._read(slot)
+            if state is not None:
+                yield state
+
+    def available_in(self, lat_min: float, lat_max: float, lng_min: float, lng_max: float) -> List[DriverState]:
+        """Available drivers inside a bounding box"""
+        return [
+            state for state in self
+            if state.available
+            and lat_min <= state.latitude < lat_max
+            and lng_min <= state.longitude < lng_max
+        ]
+
+    def rebuild(self) -> int:
+        """Load every driver from the database into the table"""
+        drivers = Driver.objects.exclude(location=None)
+        written = 0
+        for driver in drivers.iterator():
+            self.write(driver)
+            written += 1
+        logger.info(f"Driver state table rebuilt with {written} drivers")
+        return written
+
+    def ensure_loaded(self):
+        """Populate an empty table from the database (first worker after a cold start)"""
+        if self.count == 0:
+            self.rebuild()
+
+    def snapshot(self, path: str):
+        """Copy the table to a snapshot file, consistent with respect to writers"""
+        self.open()
+        with self.locked():
+            self.map.flush()
+            tmp_path = f"{path}.tmp"
+            shutil.copyfile(self.path, tmp_path)
+            os.replace(tmp_path, path)
+
+    def restore(self, path: str):
+        """Replace the table contents with a snapshot file"""
+        self.open()
+        with self.locked():
+            with open(path, 'rb') as snapshot:
+                data = snapshot.read(len(self.map))
+            magic, version, capacity, _ = HEADER.unpack_from(data, 0)
+            if magic != MAGIC or version != VERSION or capacity != self.capacity:
+                raise ValueError(f"{path} is not a compatible driver state snapshot")
+            self.map[:len(data)] = data
+            self.slots = {}
+            self.indexed = 0
+
+    def on_driver_updated(self, sender, driver: Driver, **kwargs):
+        """Receiver for driver_updated: write the driver's new state"""
+        self.write(driver)
@@ -0,0 +1,97 @@
+from typing import Dict, List, Tuple
+
+_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+_DECODE = {c: i for i, c in enumerate(_BASE32)}
+
+def encode(latitude: float, longitude: float, precision: int = 5) -> str:
+    """
+    Encode a coordinate as a geohash of the given length.
+    Longer hashes are smaller cells; every prefix of a hash is the cell containing it.
+    """
+    lat_min, lat_max = -90.0, 90.0
+    lng_min, lng_max = -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True
+    
+    while len(chars) < precision:
+        if even:
+            mid = (lng_min + lng_max) / 2
+            if longitude >= mid:
+                value = (value << 1) | 1
+                lng_min = mid
+            else:
+                value <<= 1
+                lng_max = mid
+        else:
+            mid = (lat_min + lat_max) / 2
+            if latitude >= mid:
+                value = (value << 1) | 1
+                lat_min = mid
+            else:
+                value <<= 1
+                lat_max = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(_BASE32[value])
+            bits = 0
+            value = 0
+    
+    return ''.join(chars)
+
+def encode_location(location: Dict, precision: int = 5) -> str:
+    """Geohash of a {'latitude', 'longitude'} dict"""
+    return encode(location['latitude'], location['longitude'], precision)
+
+def bbox(geohash: str) -> Tuple[float, float, float, float]:
+    """Return (lat_min, lat_max, lng_min, lng_max) of a geohash cell"""
+    lat_min, lat_max = -90.0, 90.0
+    lng_min, lng_max = -180.0, 180.0
+    even = True
+    
+    for char in geohash:
+        value = _DECODE[char]
+        for shift in range(4, -1, -1):
+            bit = (value >> shift) & 1
+            if even:
+                mid = (lng_min + lng_max) / 2
+                if bit:
+                    lng_min = mid
+                else:
+                    lng_max = mid
+            else:
+                mid = (lat_min + lat_max) / 2
+                if bit:
+                    lat_min = mid
+                else:
+                    lat_max = mid
+            even = not even
+    
+    return lat_min, lat_max, lng_min, lng_max
+
+def decode(geohash: str) -> Tuple[float, float]:
+    """Return the (latitude, longitude) centre of a geohash cell"""
+    lat_min, lat_max, lng_min, lng_max = bbox(geohash)
+    return (lat_min + lat_max) / 2, (lng_min + lng_max) / 2
+
+def neighbours(geohash: str) -> List[str]:
+    """Return the 8 cells surrounding a geohash cell, at the same precision"""
+    lat_min, lat_max, lng_min, lng_max = bbox(geohash)
+    lat_step = lat_max - lat_min
+    lng_step = lng_max - lng_min
+    latitude, longitude = (lat_min + lat_max) / 2, (lng_min + lng_max) / 2
+    
+    cells = []
+    for dlat in (-1, 0, 1):
+        for dlng in (-1, 0, 1):
+            if dlat == 0 and dlng == 0:
+                continue
+            lat = latitude + dlat * lat_step
+            if lat > 90 or lat < -90:
+                continue
+            # Wrap around the antimeridian
+            lng = (longitude + dlng * lng_step + 180) % 360 - 180
+            cells.append(encode(lat, lng, len(geohash)))
+    return cells
@@ -0,0 +1,122 @@
+from typing import Dict, List, Optional
+import threading
+import time
+from ..models import Driver, Ride
+from . import geohash
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class Heatmap:
+    """
+    Supply and demand per geohash cell, kept up to date from events.
+
+    Available drivers and open (PENDING) rides per cell are counted from
+    driver_updated and ride_status_changed, and new ride requests per cell
+    are kept as exponentially decayed counts, one per half-life in
+    half_lives. Reading the map costs O(cells) and no queries, except for a
+    resync from the database (two queries) every resync_interval seconds,
+    which corrects the counts for events seen only by other processes. The
+    decayed request counts only cover rides created by this process.
+    """
+
+    def __init__(self, precision: int = 6, half_lives: Optional[Dict[str, float]] = None, resync_interval: float = 60):
+        self.precision = precision
+        self.half_lives = half_lives or {'5m': 300, '1h': 3600}
+        self.resync_interval = resync_interval
+        self.drivers: Dict[str, int] = {}
+        self.open_rides: Dict[str, int] = {}
+        self.driver_cells: Dict[int, str] = {}
+        self.ride_cells: Dict[int, str] = {}
+        # cell -> {window: [count, time of last update]}
+        self.requests: Dict[str, Dict[str, List[float]]] = {}
+        self.centres: Dict[str, tuple] = {}
+        self.synced_at: Optional[float] = None
+        self.lock = threading.Lock()
+        metrics.register_gauge('heatmap_cells', lambda: len(self.drivers) + len(self.open_rides))
+
+    def cell(self, location: Optional[Dict]) -> Optional[str]:
+        return geohash.encode_location(location, self.precision) if location else None
+
+    @staticmethod
+    def _move(counts: Dict[str, int], cells: Dict[int, str], key: int, cell: Optional[str]):
+        previous = cells.pop(key, None)
+        if previous is not None:
+            counts[previous] -= 1
+            if not counts[previous]:
+                del counts[previous]
+        if cell is not None:
+            cells[key] = cell
+            counts[cell] = counts.get(cell, 0) + 1
+
+    def resync(self):
+        """Recount available drivers and open rides from the database"""
+        drivers = Driver.objects.filter(available=True).exclude(location=None).values_list('id', 'location')
+        rides = Ride.objects.filter(status='PENDING').values_list('id', 'pickup_location')
+        driver_counts, driver_cells, ride_counts, ride_cells = {}, {}, {}, {}
+        for driver_id, location in drivers:
+            self._move(driver_counts, driver_cells, driver_id, self.cell(location))
+        for ride_id, location in rides:
+            self._move(ride_counts, ride_cells, ride_id, self.cell(location))
+        with self.lock:
+            self.drivers, self.driver_cells = driver_counts, driver_cells
+            self.open_rides, self.ride_cells = ride_counts, ride_cells
+            self.synced_at = time.monotonic()
+
+    def ensure_synced(self):
+        if self.synced_at is None or time.monotonic() - self.synced_at > self.resync_interval:
+            self.resync()
+
+    def record_request(self, cell: str, now: Optional[float] = None):
+        now = now if now is not None else time.time()
+        windows = self.requests.setdefault(cell, {})
+        for name, half_life in self.half_lives.items():
+            count, updated = windows.get(name, (0.0, now))
+            windows[name] = [count * 2 ** ((updated - now) / half_life) + 1, now]
+
+    def on_driver_updated(self, sender, driver: Driver, **kwargs):
+        """Receiver for driver_updated"""
+        with self.lock:
+            cell = self.cell(driver.location) if driver.available else None
+            self._move(self.drivers, self.driver_cells, driver.id, cell)
+
+    def on_ride_status_changed(self, sender, ride: Ride, previous_status=None, **kwargs):
+        """Receiver for ride_status_changed"""
+        with self.lock:
+            cell = self.cell(ride.pickup_location)
+            self._move(self.open_rides, self.ride_cells, ride.id, cell if ride.status == 'PENDING' else None)
+            if previous_status is None and cell is not None:
+                self.record_request(cell)
+
+    def snapshot(self) -> Dict:
+        """Every cell with supply or demand, with its counts"""
+        self.ensure_synced()
+        now = time.time()
+        cells = []
+        with self.lock:
+            for cell in set(self.drivers) | set(self.open_rides) | set(self.requests):
+                requests = {
+                    name: round(count * 2 ** ((updated - now) / self.half_lives[name]), 2)
+                    for name, (count, updated) in self.requests.get(cell, {}).items()
+                }
+                drivers = self.drivers.get(cell, 0)
+                open_rides = self.open_rides.get(cell, 0)
+                if not drivers and not open_rides and all(count < 0.01 for count in requests.values()):
+                    # Demand has decayed away
+                    del self.requests[cell]
+                    continue
+                centre = self.centres.get(cell)
+                if centre is None:
+                    centre = self.centres[cell] = geohash.decode(cell)
+                latitude, longitude = centre
+                cells.append({
+                    'cell': cell,
+                    'latitude': round(latitude, 5),
+                    'longitude': round(longitude, 5),
+                    'drivers': drivers,
+                    'open_rides': open_rides,
+                    'requests': requests,
+                    'demand_ratio': round(open_rides / max(drivers, 1), 2)
+                })
+        return {'precision': self.precision, 'half_lives': self.half_lives, 'cells': cells}
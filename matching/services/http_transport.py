@@ -0,0 +1,145 @@
+from typing import Dict, Optional
+from collections import deque
+from urllib.parse import urlsplit
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+RETRY_STATUSES = {502, 503, 504}
+
+class RetryBudget:
+    """
+    Allows retries up to `ratio` of the requests made in the last `window`
+    seconds (plus a small floor), so retries can't multiply load during an outage.
+    """
+
+    def __init__(self, ratio: float = 0.1, min_retries: int = 3, window: float = 10):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self.requests = deque()
+        self.retries = deque()
+        self.lock = threading.Lock()
+
+    def _trim(self, now: float):
+        for events in (self.requests, self.retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_request(self):
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            self.requests.append(now)
+
+    def try_retry(self) -> bool:
+        now = time.monotonic()
+        with self.lock:
+            self._trim(now)
+            if len(self.retries) >= self.min_retries + self.ratio * len(self.requests):
+                return False
+            self.retries.append(now)
+            return True
+
+class PooledSession(requests.Session):
+    """
+    Keep-alive session shared by every map API client in the process.
+
+    Connections are pooled per host by the adapter; on top of that each host
+    gets a concurrency limit, and idempotent requests that hit a connection error
+    or a 502/503/504 are retried while the retry budget allows it.
+    """
+
+    def __init__(
+        self,
+        pool_maxsize: int = 32,
+        per_host_limit: int = 16,
+        max_retries: int = 2,
+        retry_budget_ratio: float = 0.1,
+        acquire_timeout: float = 5
+    ):
+        super().__init__()
+        self.adapter = HTTPAdapter(pool_connections=8, pool_maxsize=pool_maxsize, pool_block=False)
+        self.mount('https://', self.adapter)
+        self.mount('http://', self.adapter)
+        self.per_host_limit = per_host_limit
+        self.max_retries = max_retries
+        self.acquire_timeout = acquire_timeout
+        self.budget = RetryBudget(ratio=retry_budget_ratio)
+        self.limits: Dict[str, threading.BoundedSemaphore] = {}
+        self.limits_lock = threading.Lock()
+        metrics.register_gauge('http_transport_new_connections', lambda: self.connection_stats()['new_connections'])
+        metrics.register_gauge('http_transport_reused_connections', lambda: self.connection_stats()['reused'])
+
+    def _limit(self, host: str) -> threading.BoundedSemaphore:
+        limit = self.limits.get(host)
+        if limit is None:
+            with self.limits_lock:
+                limit = self.limits.setdefault(host, threading.BoundedSemaphore(self.per_host_limit))
+        return limit
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlsplit(url).netloc
+        limit = self._limit(host)
+        if not limit.acquire(timeout=self.acquire_timeout):
+            metrics.inc('http_transport_limited_total', host=host)
+            raise requests.ConnectionError(f"Too many concurrent requests to {host}")
+        try:
+            retryable = method.upper() in ('GET', 'HEAD', 'OPTIONS')
+            attempt = 0
+            while True:
+                metrics.inc('http_transport_requests_total', host=host)
+                self.budget.record_request()
+                try:
+                    response = super().request(method, url, *args, **kwargs)
+                    if response.status_code not in RETRY_STATUSES:
+                        return response
+                    error = None
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    response, error = None, e
+                
+                attempt += 1
+                if not retryable or attempt > self.max_retries:
+                    break
+                if not self.budget.try_retry():
+                    metrics.inc('http_transport_retries_denied_total', host=host)
+                    break
+                metrics.inc('http_transport_retries_total', host=host)
+                logger.debug(f"Retrying {method} {host} (attempt {attempt + 1})")
+            
+            if error is not None:
+                raise error
+            return response
+        finally:
+            limit.release()
+
+    def connection_stats(self) -> Dict[str, float]:
+        """How many requests reused a pooled connection versus opened a new one"""
+        requests_made = new_connections = 0
+        for pool in list(self.adapter.poolmanager.pools._container.values()):
+            requests_made += pool.num_requests
+            new_connections += pool.num_connections
+        return {
+            'requests': requests_made,
+            'new_connections': new_connections,
+            'reused': max(0, requests_made - new_connections),
+            'reuse_ratio': (requests_made - new_connections) / requests_made if requests_made else 0.0,
+        }
+
+_shared_session: Optional[PooledSession] = None
+_shared_lock = threading.Lock()
+
+def shared_session() -> PooledSession:
+    """The process-wide session, configured from the MAP_TRANSPORT setting"""
+    global _shared_session
+    if _shared_session is None:
+        with _shared_lock:
+            if _shared_session is None:
+                from django.conf import settings
+                _shared_session = PooledSession(**getattr(settings, 'MAP_TRANSPORT', {}))
+    return _shared_session
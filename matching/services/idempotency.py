@@ -0,0 +1,75 @@
+from typing import Dict, Optional, Tuple
+import hashlib
+import json
+from django.core.cache import caches
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class IdempotencyStore:
+    """
+    Records the response to a request made with an Idempotency-Key header, so
+    a client retrying it gets the same response instead of repeating the work.
+
+    Records live in a Django cache (a bounded store that expires entries after
+    the TTL). A key is claimed with an atomic add while its request runs, so a
+    concurrent retry is told to back off rather than starting a second match.
+    """
+
+    NEW = 'new'
+    REPLAY = 'replay'
+    IN_PROGRESS = 'in_progress'
+    MISMATCH = 'mismatch'
+
+    def __init__(self, cache_alias: str = 'default', ttl: float = 86400, lock_ttl: float = 30):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        # How long a claim survives a worker that died before completing it
+        self.lock_ttl = lock_ttl
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def fingerprint(data) -> str:
+        """Hash of a request body, to detect a key reused for a different request"""
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode()).hexdigest()
+
+    @staticmethod
+    def cache_key(scope: str, key: str) -> str:
+        return 'idempotency:' + hashlib.sha256(f"{scope}:{key}".encode()).hexdigest()
+
+    def begin(self, scope: str, key: str, fingerprint: str) -> Tuple[str, Optional[Dict]]:
+        """
+        Claim a key for a request. Returns (NEW, None) if the caller should run
+        the request, (REPLAY, record) with the stored response, or IN_PROGRESS /
+        MISMATCH if another request holds or already used the key.
+        """
+        cache_key = self.cache_key(scope, key)
+        claim = {'state': self.IN_PROGRESS, 'fingerprint': fingerprint}
+        if self.cache.add(cache_key, claim, self.lock_ttl):
+            return self.NEW, None
+        record = self.cache.get(cache_key)
+        if record is None:
+            # Expired between add() and get(); let the client retry
+            return self.IN_PROGRESS, None
+        if record['fingerprint'] != fingerprint:
+            return self.MISMATCH, None
+        if record['state'] == self.IN_PROGRESS:
+            return self.IN_PROGRESS, None
+        metrics.inc('idempotency_replays_total')
+        return self.REPLAY, record
+
+    def complete(self, scope: str, key: str, fingerprint: str, status_code: int, data):
+        """Store the response for the key's TTL"""
+        self.cache.set(
+            self.cache_key(scope, key),
+            {'state': 'complete', 'fingerprint': fingerprint, 'status': status_code, 'data': data},
+            self.ttl
+        )
+
+    def release(self, scope: str, key: str):
+        """Drop a claim whose request failed, so a retry can run it again"""
+        self.cache.delete(self.cache_key(scope, key))
@@ -0,0 +1,446 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from array import array
+from math import cos, radians, inf
+import heapq
+import mmap
+import random
+import struct
+from googlemaps.convert import encode_polyline
+from .distance_calculator import calculate_distance
+import logging
+
+logger = logging.getLogger('matching')
+
+# Compact road graph file: a header followed by 4-byte little-endian arrays
+#   lat[n], lng[n]                              float32 node coordinates
+#   offsets[n+1], targets[m], durations[m], lengths[m]          forward CSR
+#   roffsets[n+1], rsources[m], rdurations[m], rlengths[m]      reverse CSR
+#   for each landmark: from_landmark[n], to_landmark[n]         float32 durations
+# Durations are seconds, lengths are meters.
+HEADER = struct.Struct('<4sIIII12x')   # magic, version, nodes, edges, landmarks
+MAGIC = b'RGRF'
+VERSION = 1
+
+# Free-flow speeds (km/h) for OSM highway types
+SPEEDS_KMH = {
+    'motorway': 100, 'motorway_link': 60,
+    'trunk': 80, 'trunk_link': 50,
+    'primary': 60, 'primary_link': 40,
+    'secondary': 50, 'secondary_link': 35,
+    'tertiary': 40, 'tertiary_link': 30,
+    'unclassified': 30, 'residential': 25,
+    'living_street': 10, 'service': 15,
+}
+
+# Speed assumed between a query point and the nearest graph node
+ACCESS_SPEED_KMH = 20
+GRID_CELL_DEGREES = 0.01
+
+def format_distance(meters: float) -> str:
+    if meters >= 1000:
+        return f"{meters / 1000:.1f} km"
+    return f"{int(round(meters))} m"
+
+def format_duration(seconds: float) -> str:
+    minutes = int(round(seconds / 60))
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return f"{hours} hour{'s' if hours > 1 else ''} {minutes} min{'s' if minutes != 1 else ''}"
+    return f"{max(minutes, 1)} min{'s' if minutes > 1 else ''}"
+
+class RoadGraph:
+    """
+    Road graph memory-mapped from a compact binary file.
+
+    Arrays are read in place through memoryviews, so loading is O(1) apart from
+    the nearest-node grid, and several processes mapping the same file share its
+    pages. Point-to-point queries use A* with ALT (landmark) lower bounds.
+    """
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        with open(self.path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.node_count, self.edge_count, self.landmark_count = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a road graph file")
+
+        view = memoryview(self.map)
+        self._offset = HEADER.size
+
+        def take(fmt: str, count: int):
+            start = self._offset
+            self._offset += 4 * count
+            return view[start:self._offset].cast(fmt)
+
+        n, m = self.node_count, self.edge_count
+        self.lat = take('f', n)
+        self.lng = take('f', n)
+        self.offsets = take('I', n + 1)
+        self.targets = take('I', m)
+        self.durations = take('f', m)
+        self.lengths = take('f', m)
+        self.roffsets = take('I', n + 1)
+        self.rsources = take('I', m)
+        self.rdurations = take('f', m)
+        self.rlengths = take('f', m)
+        self.from_landmark = []
+        self.to_landmark = []
+        for _ in range(self.landmark_count):
+            self.from_landmark.append(take('f', n))
+            self.to_landmark.append(take('f', n))
+
+        self.grid: Dict[Tuple[int, int], List[int]] = {}
+        for node in range(n):
+            self.grid.setdefault(self._cell(self.lat[node], self.lng[node]), []).append(node)
+
+    @staticmethod
+    def _cell(latitude: float, longitude: float) -> Tuple[int, int]:
+        return int(latitude // GRID_CELL_DEGREES), int(longitude // GRID_CELL_DEGREES)
+
+    def location(self, node: int) -> Dict[str, float]:
+        return {'latitude': self.lat[node], 'longitude': self.lng[node]}
+
+    def nearest_node(self, location: Dict, max_rings: int = 5) -> Optional[int]:
+        """Closest graph node to a point, searching outward ring by ring"""
+        latitude, longitude = location['latitude'], location['longitude']
+        row, col = self._cell(latitude, longitude)
+        scale = cos(radians(latitude)) ** 2
+        best, best_distance = None, inf
+        found_at = None
+        for ring in range(max_rings + 1):
+            for r in range(row - ring, row + ring + 1):
+                for c in range(col - ring, col + ring + 1):
+                    if max(abs(r - row), abs(c - col)) != ring:
+                        continue
+                    for node in self.grid.get((r, c), ()):
+                        distance = (self.lat[node] - latitude) ** 2 + scale * (self.lng[node] - longitude) ** 2
+                        if distance < best_distance:
+                            best, best_distance = node, distance
+            # One extra ring catches closer nodes just across a cell edge
+            if best is not None:
+                if found_at is None:
+                    found_at = ring
+                elif ring > found_at:
+                    break
+        return best
+
+    def _heuristic(self, target: int):
+        """ALT lower bound on the duration from any node to target"""
+        bounds = [
+            (self.from_landmark[i], self.to_landmark[i], self.from_landmark[i][target], self.to_landmark[i][target])
+            for i in range(self.landmark_count)
+        ]
+
+        def h(node: int) -> float:
+            best = 0.0
+            for from_l, to_l, from_l_target, to_l_target in bounds:
+                from_l_node, to_l_node = from_l[node], to_l[node]
+                # d(node, t) >= d(L, t) - d(L, node) and d(node, t) >= d(node, L) - d(t, L)
+                if from_l_target != inf and from_l_node != inf:
+                    best = max(best, from_l_target - from_l_node)
+                if to_l_node != inf and to_l_target != inf:
+                    best = max(best, to_l_node - to_l_target)
+            return best
+
+        return h
+
+    def shortest_path(self, source: int, target: int) -> Optional[Tuple[float, float, List[int]]]:
+        """Fastest path as (duration seconds, length meters, nodes), or None if unreachable"""
+        h = self._heuristic(target)
+        durations = {source: 0.0}
+        lengths = {source: 0.0}
+        parents = {source: -1}
+        heap = [(h(source), source)]
+        settled = set()
+
+        while heap:
+            _, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if node == target:
+                path = []
+                while node != -1:
+                    path.append(node)
+                    node = parents[node]
+                return durations[target], lengths[target], path[::-1]
+            settled.add(node)
+            base = durations[node]
+            for edge in range(self.offsets[node], self.offsets[node + 1]):
+                neighbour = self.targets[edge]
+                duration = base + self.durations[edge]
+                if duration < durations.get(neighbour, inf):
+                    durations[neighbour] = duration
+                    lengths[neighbour] = lengths[node] + self.lengths[edge]
+                    parents[neighbour] = node
+                    heapq.heappush(heap, (duration + h(neighbour), neighbour))
+        return None
+
+    def _search(self, source: int, targets: Iterable[int], reverse: bool, limit: float) -> Dict[int, Tuple[float, float]]:
+        """Dijkstra from source until every target is settled (or the duration limit is hit)"""
+        offsets, heads, edge_durations, edge_lengths = (
+            (self.roffsets, self.rsources, self.rdurations, self.rlengths) if reverse
+            else (self.offsets, self.targets, self.durations, self.lengths)
+        )
+        remaining = set(targets)
+        found = {}
+        durations = {source: 0.0}
+        lengths = {source: 0.0}
+        heap = [(0.0, source)]
+        settled = set()
+
+        while heap and remaining:
+            duration, node = heapq.heappop(heap)
+            if node in settled:
+                continue
+            if duration > limit:
+                break
+            settled.add(node)
+            if node in remaining:
+                remaining.discard(node)
+                found[node] = (duration, lengths[node])
+            for edge in range(offsets[node], offsets[node + 1]):
+                neighbour = heads[edge]
+                candidate = duration + edge_durations[edge]
+                if candidate < durations.get(neighbour, inf):
+                    durations[neighbour] = candidate
+                    lengths[neighbour] = lengths[node] + edge_lengths[edge]
+                    heapq.heappush(heap, (candidate, neighbour))
+        return found
+
+    def one_to_many(self, source: int, targets: Iterable[int], limit: float = inf) -> Dict[int, Tuple[float, float]]:
+        """(duration, length) from source to each reachable target"""
+        return self._search(source, targets, reverse=False, limit=limit)
+
+    def many_to_one(self, sources: Iterable[int], target: int, limit: float = inf) -> Dict[int, Tuple[float, float]]:
+        """(duration, length) from each reachable source to target, in one backward search"""
+        return self._search(target, sources, reverse=True, limit=limit)
+
+class LocalRoutingBackend:
+    """Offline routing backend answering Directions-style queries from a RoadGraph"""
+
+    def __init__(self, graph_path: str):
+        self.graph = RoadGraph(graph_path)
+
+    def _access(self, location: Dict, node: int) -> Tuple[float, float]:
+        """(duration, length) to get between a query point and its snapped node"""
+        meters = calculate_distance(location, self.graph.location(node)) * 1000
+        return meters / (ACCESS_SPEED_KMH / 3.6), meters
+
+    def _leg(self, start: Dict, end: Dict) -> Optional[Dict]:
+        graph = self.graph
+        source, target = graph.nearest_node(start), graph.nearest_node(end)
+        if source is None or target is None:
+            return None
+        result = graph.shortest_path(source, target)
+        if result is None:
+            return None
+        duration, length, path = result
+        for location, node in ((start, source), (end, target)):
+            access_duration, access_length = self._access(location, node)
+            duration += access_duration
+            length += access_length
+
+        points = [(start['latitude'], start['longitude'])]
+        points += [(graph.lat[node], graph.lng[node]) for node in path]
+        points.append((end['latitude'], end['longitude']))
+        start_location = {'lat': start['latitude'], 'lng': start['longitude']}
+        end_location = {'lat': end['latitude'], 'lng': end['longitude']}
+        distance = {'text': format_distance(length), 'value': int(round(length))}
+        duration_value = {'text': format_duration(duration), 'value': int(round(duration))}
+        return {
+            'distance': distance,
+            'duration': duration_value,
+            'start_address': '',
+            'end_address': '',
+            'start_location': start_location,
+            'end_location': end_location,
+            'steps': [{
+                'distance': distance,
+                'duration': duration_value,
+                'start_location': start_location,
+                'end_location': end_location,
+                'polyline': {'points': encode_polyline(points)},
+                'travel_mode': 'DRIVING',
+                'html_instructions': '',
+            }],
+            'traffic_speed_entry': [],
+            'via_waypoint': [],
+            '_points': points,
+        }
+
+    def get_optimal_route(
+        self,
+        origin: Dict[str, float],
+        destination: Dict[str, float],
+        waypoints: List[Dict[str, float]] = None
+    ) -> List[Dict]:
+        """Fastest route through the waypoints, in the shape of a Directions API result"""
+        stops = [origin, *(waypoints or []), destination]
+        legs = []
+        for start, end in zip(stops, stops[1:]):
+            leg = self._leg(start, end)
+            if leg is None:
+                return []
+            legs.append(leg)
+
+        points = [point for leg in legs for point in leg.pop('_points')]
+        latitudes = [lat for lat, _ in points]
+        longitudes = [lng for _, lng in points]
+        return [{
+            'bounds': {
+                'northeast': {'lat': max(latitudes), 'lng': max(longitudes)},
+                'southwest': {'lat': min(latitudes), 'lng': min(longitudes)},
+            },
+            'copyrights': 'Map data © OpenStreetMap contributors',
+            'legs': legs,
+            'overview_polyline': {'points': encode_polyline(points)},
+            'summary': 'Local road network',
+            'warnings': [],
+            'waypoint_order': list(range(len(waypoints or []))),
+        }]
+
+    def travel_times_to(self, target_location: Dict, source_locations: List[Dict]) -> List[Optional[Tuple[float, float]]]:
+        """
+        (duration seconds, length meters) from each source to one target, or None
+        where unreachable. Answered by a single backward search, e.g. for scoring
+        every candidate driver against one pickup.
+        """
+        graph = self.graph
+        target = graph.nearest_node(target_location)
+        sources = [graph.nearest_node(location) for location in source_locations]
+        if target is None:
+            return [None] * len(sources)
+        found = graph.many_to_one([node for node in sources if node is not None], target)
+        results = []
+        for location, node in zip(source_locations, sources):
+            if node is None or node not in found:
+                results.append(None)
+                continue
+            duration, length = found[node]
+            for point, snapped in ((location, node), (target_location, target)):
+                access_duration, access_length = self._access(point, snapped)
+                duration += access_duration
+                length += access_length
+            results.append((duration, length))
+        return results
+
+def _csr(node_count: int, edges: List[Tuple[int, int, float, float]]) -> Tuple[array, array, array, array]:
+    """Compressed sparse rows for (tail, head, duration, length) edges sorted by tail"""
+    offsets = array('I', [0] * (node_count + 1))
+    for tail, _, _, _ in edges:
+        offsets[tail + 1] += 1
+    for i in range(node_count):
+        offsets[i + 1] += offsets[i]
+    heads = array('I', (head for _, head, _, _ in edges))
+    durations = array('f', (duration for _, _, duration, _ in edges))
+    lengths = array('f', (length for _, _, _, length in edges))
+    return offsets, heads, durations, lengths
+
+def _dijkstra_all(node_count: int, offsets, heads, durations, source: int) -> array:
+    # Search in double precision; rounding to float32 mid-search would make
+    # popped entries look stale and skip nodes
+    distances = [inf] * node_count
+    distances[source] = 0.0
+    heap = [(0.0, source)]
+    while heap:
+        duration, node = heapq.heappop(heap)
+        if duration > distances[node]:
+            continue
+        for edge in range(offsets[node], offsets[node + 1]):
+            neighbour = heads[edge]
+            candidate = duration + durations[edge]
+            if candidate < distances[neighbour]:
+                distances[neighbour] = candidate
+                heapq.heappush(heap, (candidate, neighbour))
+    return array('f', distances)
+
+def parse_osm(osm_path: str) -> Tuple[List[Tuple[float, float]], List[Tuple[int, int, float, float]]]:
+    """Read drivable ways from an OSM XML extract into (node coordinates, directed edges)"""
+    import xml.etree.ElementTree as ET
+
+    coordinates: Dict[int, Tuple[float, float]] = {}
+    ways = []
+    for _, element in ET.iterparse(osm_path, events=('end',)):
+        if element.tag == 'node':
+            coordinates[int(element.get('id'))] = (float(element.get('lat')), float(element.get('lon')))
+            element.clear()
+        elif element.tag == 'way':
+            tags = {tag.get('k'): tag.get('v') for tag in element.iter('tag')}
+            speed = SPEEDS_KMH.get(tags.get('highway'))
+            if speed is not None:
+                if tags.get('maxspeed', '').isdigit():
+                    speed = int(tags['maxspeed'])
+                nodes = [int(nd.get('ref')) for nd in element.iter('nd')]
+                oneway = tags.get('oneway')
+                if tags.get('junction') == 'roundabout' or tags.get('highway') == 'motorway':
+                    oneway = oneway or 'yes'
+                ways.append((nodes, speed, oneway))
+            element.clear()
+
+    index: Dict[int, int] = {}
+    nodes: List[Tuple[float, float]] = []
+    edges = []
+
+    def node_index(osm_id: int) -> int:
+        if osm_id not in index:
+            index[osm_id] = len(nodes)
+            nodes.append(coordinates[osm_id])
+        return index[osm_id]
+
+    for way_nodes, speed, oneway in ways:
+        way_nodes = [node for node in way_nodes if node in coordinates]
+        if oneway == '-1':
+            way_nodes.reverse()
+        for a, b in zip(way_nodes, way_nodes[1:]):
+            tail, head = node_index(a), node_index(b)
+            (lat1, lng1), (lat2, lng2) = nodes[tail], nodes[head]
+            length = calculate_distance(
+                {'latitude': lat1, 'longitude': lng1}, {'latitude': lat2, 'longitude': lng2}
+            ) * 1000
+            duration = length / (speed / 3.6)
+            edges.append((tail, head, duration, length))
+            if oneway not in ('yes', 'true', '1', '-1'):
+                edges.append((head, tail, duration, length))
+    return nodes, edges
+
+def build_road_graph(osm_path: str, output_path: str, landmark_count: int = 8, seed: int = 0) -> Tuple[int, int]:
+    """Convert an OSM XML extract into the binary graph format, with ALT landmarks"""
+    nodes, edges = parse_osm(osm_path)
+    n = len(nodes)
+    edges.sort(key=lambda edge: edge[0])
+    offsets, targets, durations, lengths = _csr(n, edges)
+    reverse = sorted(((head, tail, duration, length) for tail, head, duration, length in edges), key=lambda edge: edge[0])
+    roffsets, rsources, rdurations, rlengths = _csr(n, reverse)
+
+    # Farthest-point landmark selection: each new landmark is the node farthest
+    # (in travel time) from the ones already chosen
+    landmarks = []
+    tables = []
+    if n:
+        rng = random.Random(seed)
+        nearest = array('f', [inf]) * n
+        candidate = rng.randrange(n)
+        for _ in range(min(landmark_count, n)):
+            from_l = _dijkstra_all(n, offsets, targets, durations, candidate)
+            to_l = _dijkstra_all(n, roffsets, rsources, rdurations, candidate)
+            landmarks.append(candidate)
+            tables.append((from_l, to_l))
+            for node in range(n):
+                if from_l[node] < nearest[node]:
+                    nearest[node] = from_l[node]
+            reachable = [node for node in range(n) if nearest[node] != inf]
+            candidate = max(reachable, key=lambda node: nearest[node])
+
+    with open(output_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, n, len(edges), len(tables)))
+        array('f', (lat for lat, _ in nodes)).tofile(f)
+        array('f', (lng for _, lng in nodes)).tofile(f)
+        for part in (offsets, targets, durations, lengths, roffsets, rsources, rdurations, rlengths):
+            part.tofile(f)
+        for from_l, to_l in tables:
+            from_l.tofile(f)
+            to_l.tofile(f)
+
+    logger.info(f"Built road graph {output_path}: {n} nodes, {len(edges)} edges, {len(tables)} landmarks")
+    return n, len(edges)
@@ -0,0 +1,95 @@
+from typing import Dict
+import atexit
+import os
+import threading
+import time
+from django.db import close_old_connections
+from ..models import Driver, region_for
+from ..signals import driver_updated
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class LocationCoalescer:
+    """
+    Buffers driver location pings and writes them in batches.
+
+    Only the latest ping per driver is kept, and a background thread writes
+    the buffer every interval seconds with one bulk update, then sends
+    driver_updated for each driver. A driver pinging several times per
+    interval costs one row write instead of one per ping; reads of the
+    driver's location lag by at most one interval.
+    """
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.pending: Dict[int, Dict] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        metrics.register_gauge('location_pings_pending', lambda: len(self.pending))
+        atexit.register(self.flush)
+
+    def submit(self, driver_id: int, location: Dict):
+        with self.lock:
+            if driver_id in self.pending:
+                metrics.inc('location_pings_coalesced_total')
+            self.pending[driver_id] = location
+            # Threads do not survive a fork, so each worker process starts its own
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='location-coalescer', daemon=True)
+                self.thread.start()
+        metrics.inc('location_pings_total')
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Error writing driver locations: {str(e)}")
+            finally:
+                close_old_connections()
+
+    def flush(self) -> int:
+        """Write the buffered locations; returns the number of drivers updated"""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+
+        drivers = Driver.objects.in_bulk(list(batch))
+        previous_locations = {}
+        updated = []
+        for driver_id, location in batch.items():
+            driver = drivers.get(driver_id)
+            if driver is None:
+                continue
+            try:
+                # bulk_update skips save(), so derive the region here
+                region = region_for(location)
+            except Exception as e:
+                # One bad ping must not cost every other driver their update
+                logger.error(f"Dropping invalid location of driver {driver_id}: {str(e)}")
+                metrics.inc('location_pings_invalid_total')
+                continue
+            previous_locations[driver_id] = driver.location
+            driver.location = location
+            driver.region = region
+            updated.append(driver)
+        Driver.objects.bulk_update(updated, ['location', 'region'])
+
+        for driver in updated:
+            try:
+                driver_updated.send(
+                    sender=Driver,
+                    driver=driver,
+                    previous_location=previous_locations[driver.id],
+                    previous_available=driver.available
+                )
+            except Exception as e:
+                logger.error(f"Error handling the location update of driver {driver.id}: {str(e)}")
+        metrics.inc('location_flushes_total')
+        return len(updated)
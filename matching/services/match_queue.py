@@ -0,0 +1,133 @@
+from typing import Dict, Optional
+from datetime import timedelta
+import threading
+from django.db import close_old_connections, transaction
+from django.utils import timezone
+from ..models import MatchJob, Passenger
+from .region_router import RegionRouter
+from .dispatch_service import DispatchService
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class MatchQueue:
+    """
+    Database-backed queue of match jobs.
+
+    Jobs are claimed with a conditional UPDATE on status='QUEUED', so any number
+    of worker processes can share the table without an external broker. A
+    claim holds a lease that the worker renews every lease/3 while it runs
+    the job; only jobs whose lease ran out (their worker process died) are
+    requeued. The outcome is recorded in the same transaction as the ride,
+    and only while the job is still claimed by this run, so a job is never
+    turned into two rides.
+    """
+
+    def __init__(
+        self,
+        matching_service: RegionRouter,
+        dispatch_service: DispatchService,
+        lease: timedelta = timedelta(seconds=30)
+    ):
+        self.matching_service = matching_service
+        self.dispatch_service = dispatch_service
+        self.lease = lease
+
+    def enqueue(self, passenger: Passenger, pickup_location: Dict, destination: Dict) -> MatchJob:
+        """Queue a match for a passenger and return the job immediately"""
+        return MatchJob.objects.create(
+            passenger=passenger,
+            pickup_location=pickup_location,
+            destination=destination
+        )
+
+    def claim_next(self, worker: str) -> Optional[MatchJob]:
+        """Claim the oldest queued job for this worker, or None if the queue is empty"""
+        candidates = MatchJob.objects.filter(status='QUEUED').order_by('id').values_list('id', flat=True)[:10]
+        for job_id in candidates:
+            now = timezone.now()
+            claimed = MatchJob.objects.filter(id=job_id, status='QUEUED').update(
+                status='RUNNING',
+                worker=worker,
+                started_at=now,
+                lease_expires_at=now + self.lease
+            )
+            if claimed:
+                return MatchJob.objects.select_related('passenger').get(id=job_id)
+        return None
+
+    def claimed(self, job: MatchJob):
+        """The job's row, as long as it is still claimed by this run of it"""
+        return MatchJob.objects.filter(id=job.id, status='RUNNING', worker=job.worker, started_at=job.started_at)
+
+    def renew(self, job: MatchJob) -> bool:
+        """Extend the lease of a running job; False once it was lost to another worker"""
+        return bool(self.claimed(job).update(lease_expires_at=timezone.now() + self.lease))
+
+    def requeue_stale(self) -> int:
+        """Put back jobs whose worker stopped renewing their lease"""
+        requeued = MatchJob.objects.filter(
+            status='RUNNING',
+            lease_expires_at__lt=timezone.now()
+        ).update(status='QUEUED', worker='', started_at=None, lease_expires_at=None)
+        if requeued:
+            logger.warning(f"Requeued {requeued} stale match jobs")
+            metrics.inc('match_jobs_requeued_total', requeued)
+        return requeued
+
+    def heartbeat(self, job: MatchJob, done: threading.Event):
+        """Renew the job's lease until done is set or the lease is lost"""
+        try:
+            while not done.wait(self.lease.total_seconds() / 3):
+                if not self.renew(job):
+                    return
+        except Exception as e:
+            logger.error(f"Error renewing the lease of match job {job.id}: {str(e)}")
+        finally:
+            close_old_connections()
+
+    def process(self, job: MatchJob) -> MatchJob:
+        """Run the matching for a claimed job and record the outcome on it"""
+        passenger = job.passenger
+        passenger.pickup_location = job.pickup_location
+        passenger.destination = job.destination
+        
+        done = threading.Event()
+        heartbeat = threading.Thread(target=self.heartbeat, args=(job, done), name=f'match-job-{job.id}', daemon=True)
+        heartbeat.start()
+        matched_drivers, error = None, ''
+        try:
+            matched_drivers = self.matching_service.find_best_match(passenger)
+        except Exception as e:
+            logger.error(f"Error processing match job {job.id}: {str(e)}")
+            error = f'Error in matching service: {str(e)}'
+        finally:
+            done.set()
+            heartbeat.join()
+        
+        with transaction.atomic():
+            if not self.claimed(job).select_for_update().exists():
+                # Requeued while this run was stalled; the run holding it now records the outcome
+                logger.warning(f"Lost the lease on match job {job.id}, discarding this run's result")
+                metrics.inc('match_jobs_lease_lost_total')
+                job.refresh_from_db()
+                return job
+            if matched_drivers:
+                try:
+                    ride, _ = self.dispatch_service.create_ride(
+                        passenger, job.pickup_location, job.destination, matched_drivers
+                    )
+                    job.ride = ride
+                    job.status = 'COMPLETED'
+                except Exception as e:
+                    logger.error(f"Error processing match job {job.id}: {str(e)}")
+                    job.status = 'FAILED'
+                    job.error = f'Error in matching service: {str(e)}'
+            else:
+                job.status = 'FAILED'
+                job.error = error or 'No suitable drivers found'
+            job.finished_at = timezone.now()
+            job.lease_expires_at = None
+            job.save(update_fields=['ride', 'status', 'error', 'finished_at', 'lease_expires_at'])
+        return job
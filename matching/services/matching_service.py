@@ -1,16 +1,93 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from ..models import Driver, Passenger, Ride
 from .traffic_service import TrafficService
 from .distance_calculator import calculate_distance
+from .metrics import metrics
+from . import preferences
+from django.db.models import Count, F
 from django.utils import timezone
 from datetime import timedelta
 import logging
+import threading
+import time
 
 logger = logging.getLogger('matching')
 
+_traffic_pool = None
+_traffic_pool_lock = threading.Lock()
+
+def traffic_pool(max_workers: int) -> ThreadPoolExecutor:
+    """Thread pool for live traffic lookups, shared by every matching engine in the process"""
+    global _traffic_pool
+    with _traffic_pool_lock:
+        if _traffic_pool is None:
+            _traffic_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='traffic')
+        return _traffic_pool
+
+class MatchResult(list):
+    """
+    Ranked drivers from a match, best first, with their scores in scores.
+    complete is False when the latency budget ran out before every candidate
+    was scored.
+    """
+
+    def __init__(
+        self,
+        drivers=(),
+        scores=(),
+        complete: bool = True,
+        candidates: int = 0,
+        scored: int = 0,
+        traffic_fallbacks: int = 0,
+        elapsed_ms: float = 0.0
+    ):
+        super().__init__(drivers)
+        self.scores = list(scores)
+        self.complete = complete
+        self.candidates = candidates
+        self.scored = scored
+        self.traffic_fallbacks = traffic_fallbacks
+        self.elapsed_ms = elapsed_ms
+        # Set when the candidate ranking came from the candidate cache
+        self.cached = False
+
+    def summary(self) -> Dict:
+        return {
+            'complete': self.complete,
+            'candidates': self.candidates,
+            'scored': self.scored,
+            'traffic_fallbacks': self.traffic_fallbacks,
+            'elapsed_ms': round(self.elapsed_ms, 1),
+            'cached': self.cached,
+        }
+
 class MatchingService:
-    def __init__(self, traffic_service: TrafficService):
+    def __init__(
+        self,
+        traffic_service: TrafficService,
+        routing=None,
+        traffic_workers: int = 8,
+        traffic_wait_ms: float = 50,
+        zones=None,
+        zone_priority_bonus: float = 0.5,
+        live_traffic_candidates: Optional[int] = 5
+    ):
         self.traffic_service = traffic_service
+        # Optional backend answering one-to-many road travel times (travel_times_to)
+        self.routing = routing
+        # Optional zone index: drivers outside the pickup's airport queue or city
+        # are skipped, and drivers queued at the pickup's airport score a bonus
+        self.zones = zones
+        self.zone_priority_bonus = zone_priority_bonus
+        # Live traffic lookups run this many candidates ahead of scoring, and
+        # under a budget each is waited on for at most traffic_wait_ms
+        self.traffic_workers = traffic_workers
+        self.traffic_wait = traffic_wait_ms / 1000
+        # Beyond the nearest live_traffic_candidates, candidates whose traffic
+        # is already known (recent answer or historical profile) use that
+        # instead of a live lookup; None looks up every candidate live
+        self.live_traffic_candidates = live_traffic_candidates
         self.weights = {
             'distance': 0.25,
             'traffic': 0.2,
@@ -21,14 +98,13 @@ class MatchingService:
 
     def calculate_preference_score(self, driver_prefs: Dict, passenger_prefs: Dict) -> float:
         """Calculate matching score based on preferences"""
-        matches = sum(1 for k in passenger_prefs if k in driver_prefs and driver_prefs[k] == passenger_prefs[k])
-        total = len(passenger_prefs)
-        return matches / total if total > 0 else 0
+        return preferences.score(*preferences.encode(driver_prefs), *preferences.encode(passenger_prefs))
 
-    def calculate_distance_score(self, driver_location: Dict, pickup_location: Dict) -> float:
-        """Calculate score based on distance (closer is better)"""
+    def calculate_distance_score(self, driver_location: Dict, pickup_location: Dict, distance: Optional[float] = None) -> float:
+        """Calculate score based on distance (closer is better), using a known road distance if given"""
         try:
-            distance = calculate_distance(driver_location, pickup_location)
+            if distance is None:
+                distance = calculate_distance(driver_location, pickup_location)
             # Normalize: 1 for very close (0 km), 0 for far (20+ km)
             return max(0, 1 - distance / 20)
         except Exception as e:
@@ -46,58 +122,221 @@ class MatchingService:
         MAX_DAILY_RIDES = 10
         return max(0, min(1, 1 - (recent_rides / MAX_DAILY_RIDES)))
 
-    def find_best_match(self, passenger: Passenger) -> List[Driver]:
-        """Find best matching drivers for a passenger"""
-        available_drivers = Driver.objects.filter(available=True).exclude(location=None)
-        
-        if not available_drivers:
-            return []
-            
+    def road_distances(self, drivers, pickup_location: Dict) -> Dict[int, float]:
+        """Road distances (km) from every driver to the pickup in one query, if a routing backend is set"""
+        if self.routing is None:
+            return {}
+        drivers = list(drivers)
+        try:
+            travel_times = self.routing.travel_times_to(
+                pickup_location, [driver.location for driver in drivers]
+            )
+        except Exception as e:
+            logger.error(f"Error getting road distances: {str(e)}")
+            return {}
+        distances = {}
+        for driver, result in zip(drivers, travel_times):
+            if result is not None:
+                distances[driver.id] = result[1] / 1000
+        return distances
+
+    def recent_ride_counts(self, drivers) -> Dict[int, int]:
+        """Rides per driver over the last day, for all given drivers in one query"""
+        return dict(
+            Ride.objects.filter(
+                driver_id__in=[driver.id for driver in drivers],
+                created_at__gte=timezone.now() - timedelta(days=1)
+            ).values('driver').annotate(count=Count('id')).values_list('driver', 'count')
+        )
+
+    def traffic_score(self, lookup: Future, driver_location: Dict, pickup_location: Dict, deadline: Optional[float], wait: bool = True):
+        """
+        Wait for a live traffic lookup, but no longer than the per-candidate wait
+        or the deadline (not at all unless wait). Returns (score, live).
+        """
+        timeout = None
+        if deadline is not None:
+            timeout = max(0, min(deadline - time.monotonic(), self.traffic_wait)) if wait else 0
+        try:
+            return lookup.result(timeout=timeout), True
+        except FutureTimeoutError:
+            pass
+        except Exception as e:
+            logger.error(f"Error getting traffic conditions: {str(e)}")
+        return self.traffic_service.fallback_traffic_conditions(driver_location, pickup_location), False
+
+    def rank_candidates(self, drivers: List[Driver], pickup_location: Dict) -> List[Tuple[Driver, Optional[float]]]:
+        """
+        Passenger-independent part of a match: the candidates with their distance
+        to the pickup in km (None if unknown), nearest first
+        """
+        road_distances = self.road_distances(drivers, pickup_location)
+        ranking = []
+        for driver in drivers:
+            distance = road_distances.get(driver.id)
+            if distance is None:
+                try:
+                    distance = calculate_distance(driver.location, pickup_location)
+                except Exception:
+                    distance = None
+            ranking.append((driver, distance))
+        ranking.sort(key=lambda item: float('inf') if item[1] is None else item[1])
+        return ranking
+
+    def find_best_match(
+        self,
+        passenger: Passenger,
+        drivers: Optional[List[Driver]] = None,
+        budget_ms: Optional[float] = None,
+        ranking: Optional[List[Tuple[Driver, Optional[float]]]] = None
+    ) -> MatchResult:
+        """
+        Find best matching drivers for a passenger.
+        Scores the given candidate drivers, or every available driver if none are given.
+        A ranking from rank_candidates() (e.g. a cached one) can be passed instead.
+        Drivers missing one of the passenger's hard requirements (e.g. pets) are skipped,
+        as are drivers whose zone rules (airport queues, cities) bar them from the pickup.
+
+        With a latency budget, candidates are scored nearest first and the ranking
+        found so far is returned when the budget runs out. Traffic lookups that
+        are not back in time use cached scores instead.
+        """
+        started = time.monotonic()
+        deadline = None if budget_ms is None else started + budget_ms / 1000
         pickup_location = passenger.pickup_location
-        passenger_prefs = passenger.preferences
+
+        required = preferences.required_mask(passenger.preference_mask)
+        if ranking is None:
+            if drivers is None:
+                available_drivers = Driver.objects.filter(available=True).exclude(location=None)
+                if required:
+                    available_drivers = available_drivers.annotate(
+                        required_bits=F('preference_mask').bitand(required)
+                    ).filter(required_bits=required)
+                available_drivers = list(available_drivers)
+            else:
+                available_drivers = list(drivers)
+            ranking = self.rank_candidates(available_drivers, pickup_location)
+        # Nearest first, so a truncated ranking still covers the closest drivers
+        ranking = [
+            (driver, distance) for driver, distance in ranking
+            if driver.available and driver.location and preferences.compatible(driver.preference_mask, required)
+        ]
+        pickup_zones = None
+        if self.zones is not None:
+            pickup_zones = self.zones.zones_at(pickup_location)
+            ranking = [
+                (driver, distance) for driver, distance in ranking
+                if self.zones.can_serve(self.zones.driver_zones(driver), pickup_zones)
+            ]
+        
+        if not ranking:
+            return MatchResult()
+        
+        available_drivers = [driver for driver, _ in ranking]
+        recent_rides = self.recent_ride_counts(available_drivers)
+        preference_scores = preferences.scores(
+            [driver.preference_mask for driver in available_drivers],
+            [driver.preference_known for driver in available_drivers],
+            passenger.preference_mask, passenger.preference_known
+        )
         
         scored_drivers = []
+        lookups = []
+        traffic_fallbacks = 0
+        traffic_known = 0
+        complete = True
+        pool = traffic_pool(self.traffic_workers)
         
-        for driver in available_drivers:
-            try:
-                # Calculate distance score
-                distance_score = self.calculate_distance_score(driver.location, pickup_location)
-                
-                # Calculate traffic score
-                traffic_score = self.traffic_service.get_traffic_conditions(
-                    driver.location, pickup_location
-                )
-                
-                # Calculate preference score
-                preference_score = self.calculate_preference_score(
-                    driver.preferences, passenger_prefs
-                )
-                
-                # Calculate rating score (normalize to 0-1)
-                rating_score = driver.rating / 5.0
-                
-                # Calculate fairness score (drivers with fewer rides get priority)
-                recent_rides = Ride.objects.filter(
-                    driver=driver, 
-                    created_at__gte=timezone.now() - timedelta(days=1)
-                ).count()
-                fairness_score = max(0, 1 - (recent_rides / 10))  # 0 rides = 1, 10+ rides = 0
-                
-                # Calculate total score
-                total_score = (
-                    self.weights['distance'] * distance_score +
-                    self.weights['traffic'] * traffic_score +
-                    self.weights['rating'] * rating_score +
-                    self.weights['preferences'] * preference_score +
-                    self.weights['fairness'] * fairness_score
-                )
+        try:
+            for index, driver in enumerate(available_drivers):
+                if deadline is not None and time.monotonic() >= deadline:
+                    complete = False
+                    break
                 
-                scored_drivers.append((driver, total_score))
+                # Keep live traffic lookups running a few candidates ahead
+                while len(lookups) < min(len(available_drivers), index + self.traffic_workers):
+                    ahead = available_drivers[len(lookups)]
+                    known = None
+                    if self.live_traffic_candidates is not None and len(lookups) >= self.live_traffic_candidates:
+                        known = self.traffic_service.known_traffic_conditions(ahead.location, pickup_location)
+                    if known is not None:
+                        lookups.append(known)
+                        traffic_known += 1
+                    else:
+                        lookups.append(pool.submit(
+                            self.traffic_service.get_traffic_conditions, ahead.location, pickup_location
+                        ))
                 
-            except Exception as e:
-                logger.error(f"Error scoring driver {driver.id}: {str(e)}")
-                continue
+                try:
+                    # Calculate distance score
+                    distance_score = self.calculate_distance_score(
+                        driver.location, pickup_location, ranking[index][1]
+                    )
+                    
+                    # Calculate traffic score
+                    # Once one lookup has missed its wait the upstream is slow,
+                    # so later candidates only take answers already back
+                    if isinstance(lookups[index], Future):
+                        traffic_score, live = self.traffic_score(
+                            lookups[index], driver.location, pickup_location, deadline,
+                            wait=not traffic_fallbacks
+                        )
+                        if not live:
+                            traffic_fallbacks += 1
+                    else:
+                        traffic_score = lookups[index]
+                    
+                    # Preference score (from the passenger's and driver's bitmasks)
+                    preference_score = preference_scores[index]
+                    
+                    # Calculate rating score (normalize to 0-1)
+                    rating_score = driver.rating / 5.0
+                    
+                    # Calculate fairness score (drivers with fewer rides get priority)
+                    fairness_score = max(0, 1 - (recent_rides.get(driver.id, 0) / 10))  # 0 rides = 1, 10+ rides = 0
+                    
+                    # Calculate total score
+                    total_score = (
+                        self.weights['distance'] * distance_score +
+                        self.weights['traffic'] * traffic_score +
+                        self.weights['rating'] * rating_score +
+                        self.weights['preferences'] * preference_score +
+                        self.weights['fairness'] * fairness_score
+                    )
+                    if pickup_zones and self.zones.has_priority(self.zones.driver_zones(driver), pickup_zones):
+                        total_score += self.zone_priority_bonus
+                    
+                    scored_drivers.append((driver, total_score))
+                    
+                except Exception as e:
+                    logger.error(f"Error scoring driver {driver.id}: {str(e)}")
+                    continue
+        finally:
+            for lookup in lookups:
+                if isinstance(lookup, Future):
+                    lookup.cancel()
+        
+        elapsed_ms = (time.monotonic() - started) * 1000
+        if not complete:
+            metrics.inc('matching_truncated_total')
+            logger.warning(
+                f"Matching for passenger {passenger.id} hit its {budget_ms} ms budget after "
+                f"scoring {len(scored_drivers)} of {len(available_drivers)} candidates"
+            )
+        if traffic_fallbacks:
+            metrics.inc('matching_traffic_fallbacks_total', traffic_fallbacks)
+        if traffic_known:
+            metrics.inc('matching_traffic_known_total', traffic_known)
         
         # Sort by score (highest first) and return just the drivers
         scored_drivers.sort(key=lambda x: x[1], reverse=True)
-        return [driver for driver, _ in scored_drivers] 
\ No newline at end of file
+        return MatchResult(
+            [driver for driver, _ in scored_drivers],
+            scores=[score for _, score in scored_drivers],
+            complete=complete,
+            candidates=len(available_drivers),
+            scored=len(scored_drivers),
+            traffic_fallbacks=traffic_fallbacks,
+            elapsed_ms=elapsed_ms
+        )
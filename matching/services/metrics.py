@@ -0,0 +1,55 @@
+from typing import Callable, Dict, Tuple
+import threading
+
+class MetricsRegistry:
+    """
+    Process-local counters and gauges, served as JSON by the metrics endpoint.
+    Gauges can be set directly or computed on read from a callback.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[Tuple[str, Tuple], float] = {}
+        self.gauges: Dict[Tuple[str, Tuple], float] = {}
+        self.callbacks: Dict[Tuple[str, Tuple], Callable[[], float]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict) -> Tuple[str, Tuple]:
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def register_gauge(self, name: str, callback: Callable[[], float], **labels):
+        with self.lock:
+            self.callbacks[self._key(name, labels)] = callback
+
+    def value(self, name: str, **labels) -> float:
+        key = self._key(name, labels)
+        with self.lock:
+            if key in self.callbacks:
+                return self.callbacks[key]()
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def snapshot(self) -> Dict[str, float]:
+        """All metrics as {'name{label=value,...}': value}"""
+        with self.lock:
+            values = {**self.counters, **self.gauges}
+            callbacks = dict(self.callbacks)
+        for key, callback in callbacks.items():
+            try:
+                values[key] = callback()
+            except Exception:
+                continue
+        return {
+            (f"{name}{{{','.join(f'{k}={v}' for k, v in labels)}}}" if labels else name): value
+            for (name, labels), value in sorted(values.items())
+        }
+
+metrics = MetricsRegistry()
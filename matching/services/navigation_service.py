@@ -1,20 +1,76 @@
 import googlemaps
 from typing import Dict, List
+from googlemaps.convert import encode_polyline
+from .distance_calculator import calculate_distance
+from .http_transport import shared_session
+from .resilience import ResilientCaller
 
-class NavigationService:
-    def __init__(self, api_key: str):
-        self.client = googlemaps.Client(key="AIzaSyCf32K4RI5")
+# Haversine fallback: straight-line distance times a typical road detour, at city speed
+ESTIMATE_DETOUR_FACTOR = 1.3
+ESTIMATE_SPEED_KMH = 30
+
+def estimate_route(
+    origin: Dict[str, float],
+    destination: Dict[str, float],
+    waypoints: List[Dict[str, float]] = None
+) -> List[Dict]:
+    """Directions-shaped route estimated from haversine distances, used when routing is unavailable"""
+    from .local_routing import format_distance, format_duration
+    
+    stops = [origin, *(waypoints or []), destination]
+    legs = []
+    for start, end in zip(stops, stops[1:]):
+        meters = calculate_distance(start, end) * 1000 * ESTIMATE_DETOUR_FACTOR
+        seconds = meters / (ESTIMATE_SPEED_KMH / 3.6)
+        start_location = {'lat': start['latitude'], 'lng': start['longitude']}
+        end_location = {'lat': end['latitude'], 'lng': end['longitude']}
+        legs.append({
+            'distance': {'text': format_distance(meters), 'value': int(round(meters))},
+            'duration': {'text': format_duration(seconds), 'value': int(round(seconds))},
+            'start_location': start_location,
+            'end_location': end_location,
+            'steps': [],
+        })
+    return [{
+        'legs': legs,
+        'overview_polyline': {
+            'points': encode_polyline([(stop['latitude'], stop['longitude']) for stop in stops])
+        },
+        'summary': 'Estimated route',
+        'warnings': ['Live routing is unavailable; distance and duration are estimates'],
+        'waypoint_order': list(range(len(waypoints or []))),
+    }]
+
+class GoogleDirectionsBackend:
+    """Routes from the Google Maps Directions API"""
+
+    def __init__(self, api_key: str, timeout: float = None, session=None):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = session
+        self._client = None
+
+    @property
+    def client(self) -> googlemaps.Client:
+        # Built on first use: the client rejects malformed keys on construction,
+        # which would otherwise break every process that merely imports the views
+        if self._client is None:
+            self._client = googlemaps.Client(
+                key=self.api_key,
+                timeout=self.timeout,
+                # The client retries failures for up to a minute by default
+                retry_timeout=self.timeout or 60,
+                # Share the pooled keep-alive connections with the traffic client
+                requests_session=self.session or shared_session()
+            )
+        return self._client
 
     def get_optimal_route(
         self, 
         origin: Dict[str, float], 
         destination: Dict[str, float],
         waypoints: List[Dict[str, float]] = None
-    ) -> Dict:
-        """
-        Get optimal route using Google Maps Directions API
-        Returns route information including waypoints, distance, and duration
-        """
+    ) -> List[Dict]:
         # Convert origin and destination to the format expected by the library
         origin_str = f"{origin['latitude']},{origin['longitude']}"
         destination_str = f"{destination['latitude']},{destination['longitude']}"
@@ -36,4 +92,66 @@ class NavigationService:
             mode="driving"
         )
         
-        return directions_result 
\ No newline at end of file
+        return directions_result
+
+class ResilientRoutingBackend:
+    """Wraps a routing backend with deadlines, a circuit breaker and hedging"""
+
+    def __init__(self, backend, caller: ResilientCaller):
+        self.backend = backend
+        self.caller = caller
+
+    def get_optimal_route(
+        self, 
+        origin: Dict[str, float], 
+        destination: Dict[str, float],
+        waypoints: List[Dict[str, float]] = None
+    ) -> List[Dict]:
+        return self.caller.call(
+            self.backend.get_optimal_route, origin, destination, waypoints,
+            fallback=lambda: estimate_route(origin, destination, waypoints)
+        )
+
+class NavigationService:
+    def __init__(self, api_key: str, backend=None):
+        self.backend = backend or GoogleDirectionsBackend(api_key)
+
+    def get_optimal_route(
+        self, 
+        origin: Dict[str, float], 
+        destination: Dict[str, float],
+        waypoints: List[Dict[str, float]] = None
+    ) -> List[Dict]:
+        """
+        Get optimal route from the configured routing backend
+        Returns route information including waypoints, distance, and duration
+        """
+        return self.backend.get_optimal_route(origin, destination, waypoints)
+
+def create_routing_backend(
+    name: str,
+    api_key: str,
+    graph_path: str = None,
+    simulation: Dict = None,
+    upstream: Dict = None
+):
+    """
+    Build the routing backend selected by the NAVIGATION_BACKEND setting. Remote
+    backends are wrapped in a ResilientCaller configured from MAP_UPSTREAM when given.
+    """
+    upstream = upstream or {}
+    if name == 'local':
+        from .local_routing import LocalRoutingBackend
+        if not graph_path:
+            raise ValueError("NAVIGATION_BACKEND 'local' needs ROAD_GRAPH_PATH")
+        return LocalRoutingBackend(graph_path)
+    if name == 'google':
+        backend = GoogleDirectionsBackend(api_key, timeout=upstream.get('timeout'))
+    elif name == 'simulation':
+        from .simulation import SimulatedDirectionsBackend, SimulationModel
+        backend = SimulatedDirectionsBackend(SimulationModel(**(simulation or {})))
+    else:
+        raise ValueError(f"Unknown navigation backend: {name}")
+    if not upstream:
+        return backend
+    return ResilientRoutingBackend(backend, ResilientCaller('directions', **upstream))
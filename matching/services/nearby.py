@@ -0,0 +1,196 @@
+from typing import Dict, List, Optional, Tuple
+from math import cos, floor, pi, radians, sqrt
+import hashlib
+import random
+import threading
+import time
+from ..models import Driver
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+KM_PER_DEGREE = 111.32
+
+Cell = Tuple[int, int]
+
+class NearbyIndex:
+    """
+    In-memory grid of available drivers for the passenger map.
+
+    Drivers are bucketed into cells of cell_degrees and kept current by
+    driver_updated; the whole grid is reloaded from the database every
+    reload_interval seconds to pick up changes made by other processes. Each
+    driver's position is stored with a random offset of up to jitter_m metres,
+    and only that offset position is ever returned. The offset is derived from
+    the driver id, the current jitter_period and jitter_key, so it stays the
+    same across updates (and processes) for the whole period: a parked driver
+    cannot be located by averaging many answers, and without the key the
+    offset cannot be recomputed.
+
+    Queries wider than aggregate_radius_km return driver counts per block of
+    aggregate_cells x aggregate_cells cells instead of positions. Answers are
+    computed for the centre of the query's cell and cached for cache_ttl
+    seconds, so the many passengers looking at the same area share them.
+    """
+
+    def __init__(
+        self,
+        cell_degrees: float = 0.01,
+        reload_interval: float = 30,
+        cache_ttl: float = 1.5,
+        jitter_m: float = 150,
+        jitter_period: float = 900,
+        jitter_key: str = '',
+        aggregate_radius_km: float = 3,
+        aggregate_cells: int = 5,
+        max_radius_km: float = 20,
+        max_drivers: int = 100,
+        cache_size: int = 10000
+    ):
+        self.cell_degrees = cell_degrees
+        self.reload_interval = reload_interval
+        self.cache_ttl = cache_ttl
+        self.jitter_m = jitter_m
+        self.jitter_period = jitter_period
+        self.jitter_key = jitter_key.encode()[:64]
+        self.aggregate_radius_km = aggregate_radius_km
+        self.aggregate_cells = aggregate_cells
+        self.max_radius_km = max_radius_km
+        self.max_drivers = max_drivers
+        self.cache_size = cache_size
+        # cell -> {driver id: (lat, lng, shown lat, shown lng)}
+        self.cells: Dict[Cell, Dict[int, Tuple[float, float, float, float]]] = {}
+        self.driver_cells: Dict[int, Cell] = {}
+        self.loaded_at: Optional[float] = None
+        self.responses: Dict[Tuple, Tuple[float, Dict]] = {}
+        self.lock = threading.Lock()
+        metrics.register_gauge('nearby_indexed_drivers', lambda: len(self.driver_cells))
+
+    def cell(self, latitude: float, longitude: float) -> Cell:
+        return floor(latitude / self.cell_degrees), floor(longitude / self.cell_degrees)
+
+    def jitter(self, driver_id: int, latitude: float, longitude: float) -> Tuple[float, float]:
+        """A point uniformly distributed within jitter_m metres of the given one, fixed per driver and period"""
+        if not self.jitter_m:
+            return latitude, longitude
+        period = int(time.time() // self.jitter_period)
+        digest = hashlib.blake2b(f"{driver_id}:{period}".encode(), key=self.jitter_key, digest_size=8).digest()
+        rng = random.Random(int.from_bytes(digest, 'big'))
+        distance = self.jitter_m * sqrt(rng.random()) / 1000 / KM_PER_DEGREE
+        angle = rng.random() * 2 * pi
+        dlat = distance * cos(angle)
+        dlng = distance * cos(angle - pi / 2) / max(cos(radians(latitude)), 0.01)
+        return round(latitude + dlat, 5), round(longitude + dlng, 5)
+
+    def _place(self, cells, driver_cells, driver_id: int, location: Optional[Dict], available: bool):
+        previous = driver_cells.pop(driver_id, None)
+        if previous is not None:
+            bucket = cells.get(previous)
+            if bucket is not None:
+                bucket.pop(driver_id, None)
+                if not bucket:
+                    del cells[previous]
+        if not available or not location:
+            return
+        latitude, longitude = location['latitude'], location['longitude']
+        cell = self.cell(latitude, longitude)
+        cells.setdefault(cell, {})[driver_id] = (latitude, longitude, *self.jitter(driver_id, latitude, longitude))
+        driver_cells[driver_id] = cell
+
+    def load(self):
+        """(Re)build the grid from the database"""
+        cells, driver_cells = {}, {}
+        for driver_id, location in Driver.objects.filter(available=True).exclude(location=None).values_list('id', 'location'):
+            self._place(cells, driver_cells, driver_id, location, True)
+        with self.lock:
+            self.cells, self.driver_cells = cells, driver_cells
+            self.loaded_at = time.monotonic()
+        logger.debug(f"Nearby index loaded with {len(driver_cells)} drivers")
+
+    def ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.reload_interval:
+            self.load()
+
+    def on_driver_updated(self, sender, driver: Driver, **kwargs):
+        """Receiver for driver_updated"""
+        with self.lock:
+            self._place(self.cells, self.driver_cells, driver.id, driver.location, driver.available)
+
+    def nearby(self, latitude: float, longitude: float, radius_km: float) -> Dict:
+        """
+        Available drivers within radius_km: jittered positions for a close-up
+        view, counts per block of cells for a wide one
+        """
+        radius_km = min(max(radius_km, 0.1), self.max_radius_km)
+        centre = self.cell(latitude, longitude)
+        key = (centre, round(radius_km * 2) / 2)
+        now = time.monotonic()
+        cached = self.responses.get(key)
+        if cached is not None and cached[0] > now:
+            metrics.inc('nearby_cache_hits_total')
+            return cached[1]
+
+        self.ensure_loaded()
+        if radius_km > self.aggregate_radius_km:
+            response = self._counts(centre, key[1])
+        else:
+            response = self._drivers(centre, key[1])
+        with self.lock:
+            if len(self.responses) >= self.cache_size:
+                self.responses = {k: v for k, v in self.responses.items() if v[0] > now}
+                if len(self.responses) >= self.cache_size:
+                    self.responses.clear()
+            self.responses[key] = (now + self.cache_ttl, response)
+        metrics.inc('nearby_cache_misses_total')
+        return response
+
+    def _cells_within(self, centre: Cell, radius_km: float):
+        """Yield (cell, distance of its centre in km) for the cells within radius_km of centre's centre"""
+        size = self.cell_degrees
+        lat0 = (centre[0] + 0.5) * size
+        lng_scale = KM_PER_DEGREE * max(cos(radians(lat0)), 0.01)
+        reach_lat = int(radius_km / (size * KM_PER_DEGREE)) + 1
+        reach_lng = int(radius_km / (size * lng_scale)) + 1
+        cells = self.cells
+        for i in range(centre[0] - reach_lat, centre[0] + reach_lat + 1):
+            dy = (i - centre[0]) * size * KM_PER_DEGREE
+            for j in range(centre[1] - reach_lng, centre[1] + reach_lng + 1):
+                if (i, j) not in cells:
+                    continue
+                dx = (j - centre[1]) * size * lng_scale
+                distance = sqrt(dx * dx + dy * dy)
+                if distance <= radius_km:
+                    yield (i, j), distance
+
+    def _drivers(self, centre: Cell, radius_km: float) -> Dict:
+        within = sorted(self._cells_within(centre, radius_km), key=lambda item: item[1])
+        drivers = []
+        with self.lock:
+            for cell, _ in within:
+                for _, _, shown_lat, shown_lng in self.cells.get(cell, {}).values():
+                    drivers.append({'latitude': shown_lat, 'longitude': shown_lng})
+                if len(drivers) >= self.max_drivers:
+                    break
+        return {'mode': 'drivers', 'radius_km': radius_km, 'drivers': drivers[:self.max_drivers]}
+
+    def _counts(self, centre: Cell, radius_km: float) -> Dict:
+        blocks: Dict[Cell, int] = {}
+        factor = self.aggregate_cells
+        with self.lock:
+            for cell, _ in self._cells_within(centre, radius_km):
+                block = (cell[0] // factor, cell[1] // factor)
+                blocks[block] = blocks.get(block, 0) + len(self.cells.get(cell, ()))
+        size = self.cell_degrees * factor
+        return {
+            'mode': 'cells',
+            'radius_km': radius_km,
+            'cells': [
+                {
+                    'latitude': round((block[0] + 0.5) * size, 5),
+                    'longitude': round((block[1] + 0.5) * size, 5),
+                    'count': count
+                }
+                for block, count in blocks.items() if count
+            ]
+        }
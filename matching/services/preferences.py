@@ -0,0 +1,121 @@
+from typing import Dict, Iterable, Iterator, List, Sequence, Tuple
+import threading
+
+# Fixed preference vocabulary; a preference's bit is its position here, so
+# only append to this list (reordering would change stored masks)
+VOCABULARY = (
+    'smoking',
+    'music',
+    'pets',
+    'quiet',
+    'air_conditioning',
+    'luggage',
+    'child_seat',
+    'wheelchair',
+)
+BITS = {name: 1 << index for index, name in enumerate(VOCABULARY)}
+ALL_BITS = (1 << len(VOCABULARY)) - 1
+
+# A passenger asking for one of these rules out drivers who do not offer it
+HARD_REQUIREMENTS = ('pets', 'child_seat', 'wheelchair')
+HARD_MASK = sum(BITS[name] for name in HARD_REQUIREMENTS)
+
+def encode(preferences: Dict) -> Tuple[int, int]:
+    """
+    Encode a preferences dict as (mask, known): mask has the bits of the
+    preferences that are on, known the bits of those stated at all.
+    Keys outside the vocabulary are ignored.
+    """
+    mask = known = 0
+    for name, value in (preferences or {}).items():
+        bit = BITS.get(name)
+        if bit is None:
+            continue
+        known |= bit
+        if value:
+            mask |= bit
+    return mask, known
+
+def decode(mask: int, known: int) -> Dict[str, bool]:
+    return {name: bool(mask & bit) for name, bit in BITS.items() if known & bit}
+
+def required_mask(mask: int) -> int:
+    """Bits a driver must have to serve a passenger with this preference mask"""
+    return mask & HARD_MASK
+
+def compatible(driver_mask: int, required: int) -> bool:
+    return driver_mask & required == required
+
+def score(driver_mask: int, driver_known: int, passenger_mask: int, passenger_known: int) -> float:
+    """Share of the passenger's stated preferences the driver states the same way"""
+    if not passenger_known:
+        return 0
+    agree = ~(driver_mask ^ passenger_mask) & driver_known & passenger_known
+    return agree.bit_count() / passenger_known.bit_count()
+
+def scores(driver_masks: Sequence[int], driver_knowns: Sequence[int], passenger_mask: int, passenger_known: int) -> List[float]:
+    """score() for many drivers at once, e.g. over array('I') columns"""
+    if not passenger_known:
+        return [0] * len(driver_masks)
+    total = passenger_known.bit_count()
+    # Popcounts of the 256 possible agreement patterns within the passenger's known bits
+    agree_bits = [(pattern & passenger_known).bit_count() / total for pattern in range(ALL_BITS + 1)]
+    flipped = ~passenger_mask & ALL_BITS
+    return [
+        agree_bits[(mask ^ flipped) & known]
+        for mask, known in zip(driver_masks, driver_knowns)
+    ]
+
+class PreferenceBuckets:
+    """
+    Items grouped by preference mask, so a lookup with hard requirements only
+    visits the buckets of compatible masks instead of every item.
+    """
+
+    def __init__(self):
+        self.buckets: Dict[int, Dict[int, object]] = {}
+        self.masks: Dict[int, int] = {}
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.masks)
+
+    def add(self, key: int, mask: int, item):
+        with self.lock:
+            previous = self.masks.get(key)
+            if previous is not None and previous != mask:
+                self._discard(key, previous)
+            self.masks[key] = mask
+            self.buckets.setdefault(mask, {})[key] = item
+
+    def remove(self, key: int):
+        with self.lock:
+            mask = self.masks.pop(key, None)
+            if mask is not None:
+                self._discard(key, mask)
+
+    def _discard(self, key: int, mask: int):
+        bucket = self.buckets.get(mask)
+        if bucket is not None:
+            bucket.pop(key, None)
+            if not bucket:
+                del self.buckets[mask]
+
+    def replace(self, items: Iterable[Tuple[int, int, object]]):
+        """Replace the contents with (key, mask, item) triples"""
+        buckets, masks = {}, {}
+        for key, mask, item in items:
+            masks[key] = mask
+            buckets.setdefault(mask, {})[key] = item
+        with self.lock:
+            self.buckets, self.masks = buckets, masks
+
+    def compatible(self, required: int = 0) -> Iterator:
+        """Items whose mask has every bit in required"""
+        with self.lock:
+            matching = [
+                list(bucket.values()) for mask, bucket in self.buckets.items()
+                if mask & required == required
+            ]
+        for bucket in matching:
+            yield from bucket
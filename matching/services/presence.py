@@ -0,0 +1,113 @@
+from typing import Dict, List, Optional
+from datetime import datetime, timezone as dt_timezone
+import os
+import threading
+import time
+from django.db import close_old_connections
+from ..models import Driver
+from ..signals import driver_updated
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class PresenceTracker:
+    """
+    Tracks when each driver was last heard from and takes drivers who went
+    quiet offline.
+
+    Heartbeats (and location pings) are recorded in memory. A background
+    thread writes them to Driver.last_seen with one bulk update every interval
+    seconds, then marks the available drivers not seen for ttl seconds
+    unavailable and sends driver_updated for them. Matching asks is_present
+    directly, so a silent driver stops being a candidate as soon as the TTL
+    passes rather than at the next sweep. Drivers that never sent a heartbeat
+    are not tracked.
+    """
+
+    def __init__(self, ttl: float = 60, interval: float = 5):
+        self.ttl = ttl
+        self.interval = interval
+        self.seen: Dict[int, float] = {}
+        self.pending: Dict[int, float] = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        metrics.register_gauge('presence_tracked_drivers', lambda: len(self.seen))
+
+    def beat(self, driver_id: int, at: Optional[float] = None):
+        at = at if at is not None else time.time()
+        with self.lock:
+            self.seen[driver_id] = at
+            self.pending[driver_id] = at
+            # Threads do not survive a fork, so each worker process starts its own
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='presence', daemon=True)
+                self.thread.start()
+        metrics.inc('presence_heartbeats_total')
+
+    def last_seen(self, driver: Driver) -> Optional[float]:
+        """When the driver was last heard from by this process or, as persisted, by any"""
+        seen = self.seen.get(driver.id)
+        stored = driver.last_seen.timestamp() if getattr(driver, 'last_seen', None) else None
+        if seen is None or stored is None:
+            return seen if stored is None else stored
+        return max(seen, stored)
+
+    def is_present(self, driver: Driver, now: Optional[float] = None) -> bool:
+        last_seen = self.last_seen(driver)
+        if last_seen is None:
+            return True
+        return (now if now is not None else time.time()) - last_seen <= self.ttl
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+                self.sweep()
+            except Exception as e:
+                logger.error(f"Error updating driver presence: {str(e)}")
+            finally:
+                close_old_connections()
+
+    def flush(self) -> int:
+        """Write the buffered heartbeats to last_seen; returns the number of drivers written"""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        Driver.objects.bulk_update([
+            Driver(id=driver_id, last_seen=datetime.fromtimestamp(at, tz=dt_timezone.utc))
+            for driver_id, at in batch.items()
+        ], ['last_seen'])
+        return len(batch)
+
+    def sweep(self, now: Optional[float] = None) -> List[int]:
+        """Mark available drivers whose last heartbeat is older than the TTL unavailable"""
+        now = now if now is not None else time.time()
+        cutoff = datetime.fromtimestamp(now - self.ttl, tz=dt_timezone.utc)
+        stale = [
+            driver for driver in Driver.objects.filter(available=True, last_seen__lt=cutoff)
+            # Skips drivers heard from by this process since the last flush
+            if not self.is_present(driver, now)
+        ]
+        if not stale:
+            return []
+        Driver.objects.filter(
+            id__in=[driver.id for driver in stale],
+            available=True,
+            last_seen__lt=cutoff
+        ).update(available=False)
+        for driver in stale:
+            driver.available = False
+            driver_updated.send(
+                sender=Driver,
+                driver=driver,
+                previous_location=driver.location,
+                previous_available=True
+            )
+        metrics.inc('presence_expired_total', len(stale))
+        logger.info(f"Marked {len(stale)} silent drivers unavailable")
+        return [driver.id for driver in stale]
@@ -0,0 +1,223 @@
+from typing import Dict, List, Optional
+from math import cos, radians
+import threading
+import time
+from ..models import Driver, Passenger, region_for
+from .matching_service import MatchingService, MatchResult
+from .traffic_service import TrafficService
+from .driver_state import DriverStateTable
+from .candidate_cache import CandidateCache
+from .preferences import PreferenceBuckets, compatible, required_mask
+from . import geohash
+import logging
+
+logger = logging.getLogger('matching')
+
+KM_PER_DEGREE = 111.32
+
+class RegionShard:
+    """
+    In-memory candidate set and matching engine for one region.
+
+    Without a driver state table the candidate set is loaded from the database
+    and kept current by driver_updated. With one, positions and availability are
+    read from the shared table and only driver profiles are cached here.
+    Either way candidates are grouped by preference mask, so hard requirements
+    skip incompatible drivers without looking at them.
+    """
+
+    def __init__(self, key: str, engine: MatchingService, ttl: float, driver_state: Optional[DriverStateTable] = None):
+        self.key = key
+        self.engine = engine
+        self.ttl = ttl
+        self.driver_state = driver_state
+        self.drivers: Dict[int, Driver] = {}
+        self.buckets = PreferenceBuckets()
+        self.loaded_at: Optional[float] = None
+        self.lock = threading.Lock()
+
+    def load(self):
+        """(Re)load the region's available drivers from the database"""
+        drivers = Driver.objects.filter(available=True, region=self.key).exclude(location=None)
+        with self.lock:
+            self.drivers = {driver.id: driver for driver in drivers}
+            self.buckets.replace((driver.id, driver.preference_mask, driver) for driver in self.drivers.values())
+            self.loaded_at = time.monotonic()
+
+    def candidates(self, required: int = 0) -> List[Driver]:
+        """Available drivers in the region that have every preference bit in required"""
+        if self.driver_state is not None:
+            return self.candidates_from_state(required)
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+            self.load()
+        # Copied under the shard lock, so a concurrent upsert or remove is seen whole or not at all
+        with self.lock:
+            return list(self.buckets.compatible(required))
+
+    def candidates_from_state(self, required: int = 0) -> List[Driver]:
+        """Candidates positioned by the shared driver state table"""
+        states = [
+            state for state in self.driver_state.available_in(*geohash.bbox(self.key))
+            if compatible(state.preference_bits, required)
+        ]
+        with self.lock:
+            if self.loaded_at is None or time.monotonic() - self.loaded_at > self.ttl:
+                self.drivers = {}
+                self.loaded_at = time.monotonic()
+            missing = [state.driver_id for state in states if state.driver_id not in self.drivers]
+        if missing:
+            profiles = Driver.objects.in_bulk(missing)
+            with self.lock:
+                self.drivers.update(profiles)
+        
+        drivers = []
+        with self.lock:
+            for state in states:
+                driver = self.drivers.get(state.driver_id)
+                if driver is None:
+                    continue
+                driver.location = {'latitude': state.latitude, 'longitude': state.longitude}
+                driver.available = True
+                drivers.append(driver)
+        return drivers
+
+    def upsert(self, driver: Driver):
+        with self.lock:
+            if driver.available and driver.location:
+                self.drivers[driver.id] = driver
+                self.buckets.add(driver.id, driver.preference_mask, driver)
+            else:
+                self.drivers.pop(driver.id, None)
+                self.buckets.remove(driver.id)
+
+    def remove(self, driver_id: int):
+        with self.lock:
+            self.drivers.pop(driver_id, None)
+            self.buckets.remove(driver_id)
+
+class RegionRouter:
+    """
+    Routes match requests to the region shard of the pickup location.
+
+    Each shard only scores the drivers in its own region, so the cost of a match
+    depends on local density rather than fleet size. Pickups close to a region
+    edge also pull in candidates from the neighbouring regions.
+    """
+
+    def __init__(
+        self,
+        traffic_service: TrafficService,
+        border_km: float = 5,
+        min_candidates: int = 3,
+        shard_ttl: float = 30,
+        driver_state: Optional[DriverStateTable] = None,
+        routing=None,
+        candidate_cache: Optional[CandidateCache] = None,
+        presence=None,
+        zones=None,
+        live_traffic_candidates: Optional[int] = 5
+    ):
+        self.traffic_service = traffic_service
+        self.routing = routing
+        self.driver_state = driver_state
+        self.candidate_cache = candidate_cache
+        self.presence = presence
+        self.zones = zones
+        self.live_traffic_candidates = live_traffic_candidates
+        self.border_km = border_km
+        self.min_candidates = min_candidates
+        self.shard_ttl = shard_ttl
+        self.shards: Dict[str, RegionShard] = {}
+        self.lock = threading.Lock()
+
+    def shard(self, key: str) -> RegionShard:
+        """Return the shard for a region key, creating it on first use"""
+        shard = self.shards.get(key)
+        if shard is None:
+            with self.lock:
+                shard = self.shards.get(key)
+                if shard is None:
+                    shard = RegionShard(
+                        key,
+                        MatchingService(
+                            traffic_service=self.traffic_service,
+                            routing=self.routing,
+                            zones=self.zones,
+                            live_traffic_candidates=self.live_traffic_candidates
+                        ),
+                        self.shard_ttl,
+                        self.driver_state
+                    )
+                    self.shards[key] = shard
+        return shard
+
+    def distance_to_cell_km(self, location: Dict, key: str) -> float:
+        """Approximate distance from a point to the closest edge of a region cell"""
+        lat_min, lat_max, lng_min, lng_max = geohash.bbox(key)
+        latitude, longitude = location['latitude'], location['longitude']
+        dlat = max(lat_min - latitude, 0, latitude - lat_max)
+        dlng = max(lng_min - longitude, 0, longitude - lng_max)
+        dy = dlat * KM_PER_DEGREE
+        dx = dlng * KM_PER_DEGREE * cos(radians(latitude))
+        return (dx * dx + dy * dy) ** 0.5
+
+    def candidates_for(self, pickup_location: Dict, required: int = 0) -> List[Driver]:
+        """Collect candidates from the pickup's region and nearby neighbouring regions"""
+        home = region_for(pickup_location)
+        candidates = self.shard(home).candidates(required)
+        
+        neighbours = geohash.neighbours(home)
+        near_border = [
+            key for key in neighbours
+            if self.distance_to_cell_km(pickup_location, key) <= self.border_km
+        ]
+        for key in near_border:
+            candidates.extend(self.shard(key).candidates(required))
+        
+        # Sparse region: fall back to every neighbouring region
+        if len(candidates) < self.min_candidates:
+            for key in neighbours:
+                if key not in near_border:
+                    candidates.extend(self.shard(key).candidates(required))
+        
+        return candidates
+
+    def find_best_match(self, passenger: Passenger, budget_ms: Optional[float] = None) -> MatchResult:
+        """Find best matching drivers using the shard of the passenger's pickup region"""
+        pickup_location = passenger.pickup_location
+        required = required_mask(passenger.preference_mask)
+        engine = self.shard(region_for(pickup_location)).engine
+        
+        # Requests from the same block share the candidate ranking; only the
+        # passenger's preference, fairness and traffic scores are computed fresh
+        ranking = None
+        if self.candidate_cache is not None:
+            ranking = self.candidate_cache.get(pickup_location, required)
+        cached = ranking is not None
+        if ranking is None:
+            if self.driver_state is not None:
+                self.driver_state.ensure_loaded()
+            candidates = self.candidates_for(pickup_location, required)
+            logger.debug(
+                f"Matching passenger {passenger.id} in region {region_for(pickup_location)} "
+                f"against {len(candidates)} candidates"
+            )
+            ranking = engine.rank_candidates(candidates, pickup_location)
+            if self.candidate_cache is not None:
+                self.candidate_cache.put(pickup_location, required, ranking)
+        
+        # Drivers whose app went silent drop out before the presence sweep catches up
+        if self.presence is not None:
+            ranking = [(driver, km) for driver, km in ranking if self.presence.is_present(driver)]
+        
+        result = engine.find_best_match(passenger, budget_ms=budget_ms, ranking=ranking)
+        result.cached = cached
+        return result
+
+    def on_driver_updated(self, sender, driver: Driver, previous_location=None, **kwargs):
+        """Move a driver between shards when their location or availability changes"""
+        previous_region = region_for(previous_location)
+        if previous_region and previous_region != driver.region and previous_region in self.shards:
+            self.shards[previous_region].remove(driver.id)
+        if driver.region in self.shards:
+            self.shards[driver.region].upsert(driver)
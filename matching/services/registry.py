@@ -0,0 +1,254 @@
+from typing import Callable, Dict, Iterable, List
+from datetime import timedelta
+import logging
+import threading
+import time
+
+logger = logging.getLogger('matching')
+
+class ServiceRegistry:
+    """
+    Process-wide services, each built on first use from a registered factory.
+
+    Importing the views or running a management command no longer constructs
+    HTTP clients, routing graphs or shared-memory tables it may never touch.
+    Factories can depend on other services through the registry itself.
+    """
+
+    def __init__(self):
+        self.factories: Dict[str, Callable[['ServiceRegistry'], object]] = {}
+        self.instances: Dict[str, object] = {}
+        self.warmup_hooks: List[Callable[['ServiceRegistry'], None]] = []
+        self.lock = threading.RLock()
+
+    def register(self, name: str, factory: Callable[['ServiceRegistry'], object]):
+        """Register (or replace) the factory for a service; it is called with the registry"""
+        with self.lock:
+            self.factories[name] = factory
+            self.instances.pop(name, None)
+
+    def get(self, name: str):
+        instance = self.instances.get(name)
+        if instance is not None or name in self.instances:
+            return instance
+        with self.lock:
+            if name not in self.instances:
+                try:
+                    factory = self.factories[name]
+                except KeyError:
+                    raise LookupError(f"Unknown service: {name}") from None
+                started = time.monotonic()
+                self.instances[name] = factory(self)
+                logger.debug(f"Built service {name} in {(time.monotonic() - started) * 1000:.1f} ms")
+            return self.instances[name]
+
+    def __getattr__(self, name: str):
+        if name.startswith('_') or name in ('factories', 'instances', 'warmup_hooks', 'lock'):
+            raise AttributeError(name)
+        try:
+            return self.get(name)
+        except LookupError:
+            raise AttributeError(name) from None
+
+    def is_built(self, name: str) -> bool:
+        return name in self.instances
+
+    def reset(self, *names: str):
+        """Drop built instances (all of them by default) so they are rebuilt on next use"""
+        with self.lock:
+            for name in names or list(self.instances):
+                self.instances.pop(name, None)
+
+    def receiver(self, name: str, method: str, build: bool = True) -> Callable:
+        """
+        Signal receiver forwarding to a method of a service. With build=False the
+        signal is ignored until something else has built the service, for
+        services that only cache state they would otherwise load fresh.
+        """
+        def receive(sender, **kwargs):
+            if not build and name not in self.instances:
+                return
+            service = self.get(name)
+            # Optional services are None when disabled in settings
+            if service is not None:
+                getattr(service, method)(sender, **kwargs)
+        return receive
+
+    def on_warm_up(self, hook: Callable[['ServiceRegistry'], None]):
+        """Register a callable to run by warm_up(), after the named services are built"""
+        self.warmup_hooks.append(hook)
+        return hook
+
+    def warm_up(self, names: Iterable[str] = ()):
+        """Build the given services and run the warm-up hooks, e.g. before a worker takes traffic"""
+        names = list(names)
+        if not names and not self.warmup_hooks:
+            return
+        started = time.monotonic()
+        for name in names:
+            self.get(name)
+        for hook in self.warmup_hooks:
+            try:
+                hook(self)
+            except Exception as e:
+                logger.error(f"Service warm-up hook {getattr(hook, '__name__', hook)} failed: {str(e)}")
+        logger.info(f"Warmed up services in {(time.monotonic() - started) * 1000:.1f} ms")
+
+registry = ServiceRegistry()
+
+def configure(registry: ServiceRegistry):
+    """Register the matching services, built from settings on first use"""
+    from django.conf import settings
+
+    def traffic_service(registry):
+        from .traffic_service import TrafficService, create_traffic_backend
+        return TrafficService(
+            api_key=settings.GOOGLE_MAPS_API_KEY,
+            backend=create_traffic_backend(
+                settings.TRAFFIC_BACKEND, settings.GOOGLE_MAPS_API_KEY,
+                settings.MAP_SIMULATION, settings.MAP_UPSTREAM
+            ),
+            profile=registry.traffic_profile
+        )
+
+    def traffic_profile(registry):
+        if not settings.TRAFFIC_PROFILE:
+            return None
+        from .traffic_profile import HistoricalTraffic
+        return HistoricalTraffic(**settings.TRAFFIC_PROFILE)
+
+    def routing_backend(registry):
+        from .navigation_service import create_routing_backend
+        return create_routing_backend(
+            settings.NAVIGATION_BACKEND, settings.GOOGLE_MAPS_API_KEY,
+            settings.ROAD_GRAPH_PATH, settings.MAP_SIMULATION, settings.MAP_UPSTREAM
+        )
+
+    def matching_routing(registry):
+        # Only offline backends are cheap enough to answer travel times for every candidate
+        backend = registry.routing_backend
+        return backend if hasattr(backend, 'travel_times_to') else None
+
+    def matching_service(registry):
+        from .matching_service import MatchingService
+        return MatchingService(
+            traffic_service=registry.traffic_service,
+            routing=registry.matching_routing,
+            zones=registry.zone_index,
+            live_traffic_candidates=settings.MATCHING_LIVE_TRAFFIC_CANDIDATES
+        )
+
+    def driver_state(registry):
+        if not settings.DRIVER_STATE_PATH:
+            return None
+        from .driver_state import DriverStateTable
+        return DriverStateTable(settings.DRIVER_STATE_PATH, settings.DRIVER_STATE_CAPACITY)
+
+    def candidate_cache(registry):
+        if not settings.MATCHING_CANDIDATE_CACHE_TTL:
+            return None
+        from .candidate_cache import CandidateCache
+        return CandidateCache(
+            ttl=settings.MATCHING_CANDIDATE_CACHE_TTL,
+            precision=settings.MATCHING_CANDIDATE_CACHE_PRECISION
+        )
+
+    def region_router(registry):
+        from .region_router import RegionRouter
+        return RegionRouter(
+            traffic_service=registry.traffic_service,
+            border_km=settings.MATCHING_REGION_BORDER_KM,
+            min_candidates=settings.MATCHING_REGION_MIN_CANDIDATES,
+            shard_ttl=settings.MATCHING_REGION_SHARD_TTL,
+            driver_state=registry.driver_state,
+            routing=registry.matching_routing,
+            candidate_cache=registry.candidate_cache,
+            presence=registry.presence,
+            zones=registry.zone_index,
+            live_traffic_candidates=settings.MATCHING_LIVE_TRAFFIC_CANDIDATES
+        )
+
+    def navigation_service(registry):
+        from .navigation_service import NavigationService
+        return NavigationService(api_key=settings.GOOGLE_MAPS_API_KEY, backend=registry.routing_backend)
+
+    def dispatch_service(registry):
+        from .dispatch_service import DispatchService
+        return DispatchService(presence=registry.presence, **settings.DISPATCH)
+
+    def idempotency_store(registry):
+        from .idempotency import IdempotencyStore
+        return IdempotencyStore(cache_alias='idempotency', ttl=settings.IDEMPOTENCY_KEY_TTL)
+
+    def rate_limiter(registry):
+        from .admission import TokenBuckets
+        return TokenBuckets()
+
+    def match_limiter(registry):
+        from .admission import ConcurrencyLimiter
+        return ConcurrencyLimiter(
+            'match',
+            limit=settings.MATCHING_CONCURRENCY_LIMIT,
+            queue_timeout=settings.MATCHING_QUEUE_TIMEOUT_MS / 1000
+        )
+
+    def location_coalescer(registry):
+        if not settings.LOCATION_FLUSH_INTERVAL_MS:
+            return None
+        from .location_coalescer import LocationCoalescer
+        return LocationCoalescer(interval=settings.LOCATION_FLUSH_INTERVAL_MS / 1000)
+
+    def presence(registry):
+        if not settings.PRESENCE_TTL_SECONDS:
+            return None
+        from .presence import PresenceTracker
+        return PresenceTracker(ttl=settings.PRESENCE_TTL_SECONDS, interval=settings.PRESENCE_FLUSH_INTERVAL_SECONDS)
+
+    def zone_index(registry):
+        from .zones import ZoneIndex
+        return ZoneIndex(cell_degrees=settings.ZONE_CELL_DEGREES, reload_interval=settings.ZONE_RELOAD_INTERVAL)
+
+    def travel_matrix(registry):
+        from .travel_matrix import GoogleDistanceMatrixBackend, GraphMatrixBackend, TravelTimeMatrix
+        backend, caller = None, None
+        if settings.NAVIGATION_BACKEND == 'google':
+            backend = GoogleDistanceMatrixBackend(settings.GOOGLE_MAPS_API_KEY, timeout=settings.MAP_UPSTREAM.get('timeout'))
+            if settings.MAP_UPSTREAM:
+                from .resilience import ResilientCaller
+                caller = ResilientCaller('distance_matrix', **settings.MAP_UPSTREAM)
+        elif registry.matching_routing is not None:
+            backend = GraphMatrixBackend(registry.matching_routing)
+        # Other backends (simulation) answer with estimates only
+        return TravelTimeMatrix(backend=backend, caller=caller)
+
+    def ride_tracker(registry):
+        from .ride_tracking import RideTracker
+        return RideTracker(navigation_service=registry.navigation_service, **settings.RIDE_TRACKING)
+
+    def heatmap(registry):
+        from .heatmap import Heatmap
+        return Heatmap(**settings.HEATMAP)
+
+    def nearby_index(registry):
+        from .nearby import NearbyIndex
+        return NearbyIndex(jitter_key=settings.SECRET_KEY, **settings.NEARBY_DRIVERS)
+
+    def carpool(registry):
+        from .carpool import CarpoolService
+        return CarpoolService(**settings.CARPOOL)
+
+    def match_queue(registry):
+        from .match_queue import MatchQueue
+        return MatchQueue(
+            matching_service=registry.region_router,
+            dispatch_service=registry.dispatch_service,
+            lease=timedelta(seconds=settings.MATCH_JOB_LEASE_SECONDS)
+        )
+
+    for factory in (
+        traffic_service, traffic_profile, routing_backend, matching_routing, matching_service, driver_state,
+        candidate_cache, region_router, navigation_service, dispatch_service, idempotency_store,
+        rate_limiter, match_limiter, location_coalescer, presence, zone_index, nearby_index, heatmap, ride_tracker, travel_matrix, carpool,
+        match_queue
+    ):
+        registry.register(factory.__name__, factory)
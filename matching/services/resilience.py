@@ -0,0 +1,151 @@
+from typing import Callable, Optional
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import threading
+import time
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+class CircuitBreaker:
+    """
+    Classic three-state breaker. After `failure_threshold` consecutive failures it
+    opens and rejects calls for `reset_timeout` seconds, then lets a single trial
+    call through (half-open) to decide whether to close again.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = 0, 1, 2
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trial_running = False
+        self.lock = threading.Lock()
+        metrics.register_gauge('circuit_breaker_state', lambda: self.state, upstream=name)
+
+    def allow(self) -> bool:
+        with self.lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self.opened_at < self.reset_timeout:
+                    return False
+                self.state = self.HALF_OPEN
+                self.trial_running = False
+            if self.state == self.HALF_OPEN:
+                if self.trial_running:
+                    return False
+                self.trial_running = True
+            return True
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.trial_running = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning(f"Circuit breaker for {self.name} opened after {self.failures} failures")
+                    metrics.inc('circuit_breaker_opened_total', upstream=self.name)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+class LatencyTracker:
+    """Sliding window of recent call latencies (seconds)"""
+
+    def __init__(self, window: int = 200):
+        self.samples = deque(maxlen=window)
+        self.lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, fraction: float, min_samples: int = 1) -> Optional[float]:
+        with self.lock:
+            if len(self.samples) < min_samples:
+                return None
+            ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class ResilientCaller:
+    """
+    Runs upstream calls with a deadline, a circuit breaker and optional hedging.
+
+    A call that does not finish within `timeout` seconds, raises, or is refused
+    by the open breaker is answered by its fallback instead. With hedging on, a
+    duplicate request is started once the first has been running longer than the
+    `hedge_percentile` latency of recent calls, and whichever finishes first wins.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        timeout: float = 2.0,
+        breaker_failures: int = 5,
+        breaker_reset_seconds: float = 30,
+        hedge_percentile: Optional[float] = None,
+        hedge_min_samples: int = 20,
+        max_workers: int = 16
+    ):
+        self.name = name
+        self.timeout = timeout
+        self.breaker = CircuitBreaker(name, breaker_failures, breaker_reset_seconds)
+        self.latency = LatencyTracker()
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"upstream-{name}")
+
+    def _fallback(self, fallback: Callable, reason: str):
+        metrics.inc('upstream_fallbacks_total', upstream=self.name, reason=reason)
+        return fallback()
+
+    def call(self, fn: Callable, *args, fallback: Callable, **kwargs):
+        metrics.inc('upstream_calls_total', upstream=self.name)
+        if not self.breaker.allow():
+            return self._fallback(fallback, 'circuit_open')
+
+        started = time.monotonic()
+        deadline = started + self.timeout
+        futures = {self.executor.submit(fn, *args, **kwargs)}
+
+        hedge_after = None
+        if self.hedge_percentile is not None:
+            hedge_after = self.latency.percentile(self.hedge_percentile, self.hedge_min_samples)
+
+        if hedge_after is not None and hedge_after < self.timeout:
+            done, _ = wait(futures, timeout=hedge_after)
+            if not done:
+                metrics.inc('upstream_hedged_total', upstream=self.name)
+                futures.add(self.executor.submit(fn, *args, **kwargs))
+
+        error = None
+        pending = futures
+        while pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    self.latency.record(time.monotonic() - started)
+                    self.breaker.record_success()
+                    return future.result()
+                error = future.exception()
+
+        self.breaker.record_failure()
+        if error is not None and not pending:
+            metrics.inc('upstream_failures_total', upstream=self.name)
+            logger.error(f"{self.name} upstream call failed: {str(error)}")
+            return self._fallback(fallback, 'error')
+        metrics.inc('upstream_timeouts_total', upstream=self.name)
+        logger.warning(f"{self.name} upstream call timed out after {self.timeout}s")
+        return self._fallback(fallback, 'timeout')
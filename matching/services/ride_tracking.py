@@ -0,0 +1,256 @@
+from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import timedelta
+from math import cos, radians, sqrt
+import os
+import queue
+import threading
+from django.db import close_old_connections
+from django.utils import timezone
+from googlemaps.convert import decode_polyline
+from ..models import Driver, Ride
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+METERS_PER_DEGREE = 111320
+
+class RouteGeometry:
+    """A decoded route polyline with the distance along it at each vertex"""
+
+    def __init__(self, polyline: str):
+        self.points: List[Tuple[float, float]] = [(p['lat'], p['lng']) for p in decode_polyline(polyline)]
+        self.scale = cos(radians(self.points[0][0])) if self.points else 1.0
+        self.cumulative = [0.0]
+        for a, b in zip(self.points, self.points[1:]):
+            self.cumulative.append(self.cumulative[-1] + self.meters(a, b))
+
+    @property
+    def length(self) -> float:
+        return self.cumulative[-1]
+
+    def meters(self, a: Tuple[float, float], b: Tuple[float, float]) -> float:
+        dy = (b[0] - a[0]) * METERS_PER_DEGREE
+        dx = (b[1] - a[1]) * METERS_PER_DEGREE * self.scale
+        return sqrt(dx * dx + dy * dy)
+
+    def snap(self, point: Tuple[float, float], start: int = 0, end: Optional[int] = None) -> Tuple[int, float, float]:
+        """
+        Project a point onto segments [start, end) of the route; returns the
+        segment index, the distance along the route and the point's distance
+        from it, in metres
+        """
+        end = len(self.points) - 1 if end is None else min(end, len(self.points) - 1)
+        best = (0, 0.0, float('inf'))
+        px = point[1] * METERS_PER_DEGREE * self.scale
+        py = point[0] * METERS_PER_DEGREE
+        for index in range(max(0, start), end):
+            (lat1, lng1), (lat2, lng2) = self.points[index], self.points[index + 1]
+            ax, ay = lng1 * METERS_PER_DEGREE * self.scale, lat1 * METERS_PER_DEGREE
+            bx, by = lng2 * METERS_PER_DEGREE * self.scale, lat2 * METERS_PER_DEGREE
+            dx, dy = bx - ax, by - ay
+            length_sq = dx * dx + dy * dy
+            t = 0.0 if not length_sq else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_sq))
+            ex, ey = ax + t * dx - px, ay + t * dy - py
+            off = sqrt(ex * ex + ey * ey)
+            if off < best[2]:
+                best = (index, self.cumulative[index] + t * sqrt(length_sq), off)
+        return best
+
+class RideTracker:
+    """
+    Live progress of accepted rides without further routing calls.
+
+    When a ride is accepted, one route is fetched (driver -> pickup ->
+    destination) and stored on the ride as an encoded polyline with its
+    distances and durations. Driver location pings are then snapped to that
+    route locally: each ping is first searched a few segments ahead of the
+    previous one, and the whole route only when it is off that window.
+    Remaining distance and ETAs are scaled from the route's own durations.
+
+    Routes are planned by a background thread (with plan_in_background), so
+    accepting a ride never waits on the routing upstream.
+    """
+
+    FINISHED = ('COMPLETED', 'CANCELLED')
+
+    def __init__(
+        self,
+        navigation_service,
+        off_route_m: float = 100,
+        window: int = 50,
+        cache_size: int = 1000,
+        plan_in_background: bool = True
+    ):
+        self.navigation_service = navigation_service
+        self.plan_in_background = plan_in_background
+        self.planning: 'queue.Queue[Tuple[Ride, Driver]]' = queue.Queue()
+        self.thread = None
+        self.pid = None
+        self.off_route_m = off_route_m
+        self.window = window
+        self.cache_size = cache_size
+        self.geometries: 'OrderedDict[int, RouteGeometry]' = OrderedDict()
+        # ride id -> latest progress; driver id -> their active ride (with its route). Both are
+        # bounded like the geometries: a ride whose end this process never hears about ages out
+        self.progress: 'OrderedDict[int, Dict]' = OrderedDict()
+        self.active: 'OrderedDict[int, Ride]' = OrderedDict()
+        self.lock = threading.Lock()
+        metrics.register_gauge('ride_routes_pending', lambda: self.planning.qsize())
+
+    def plan_route(self, ride: Ride, driver: Driver) -> Dict:
+        """Fetch and store the route of an accepted ride"""
+        routes = self.navigation_service.get_optimal_route(
+            origin=driver.location or ride.pickup_location,
+            destination=ride.destination,
+            waypoints=[ride.pickup_location]
+        )
+        if not routes:
+            return {}
+        legs = routes[0].get('legs', [])
+        route = {
+            'polyline': routes[0]['overview_polyline']['points'],
+            'distance': sum(leg['distance']['value'] for leg in legs),
+            'duration': sum(leg['duration']['value'] for leg in legs),
+            'pickup_distance': legs[0]['distance']['value'] if len(legs) > 1 else 0,
+            'pickup_duration': legs[0]['duration']['value'] if len(legs) > 1 else 0,
+        }
+        Ride.objects.filter(id=ride.id).update(route=route)
+        ride.route = route
+        return route
+
+    def geometry(self, ride: Ride) -> Optional[RouteGeometry]:
+        if not ride.route:
+            return None
+        with self.lock:
+            geometry = self.geometries.get(ride.id)
+            if geometry is not None:
+                self.geometries.move_to_end(ride.id)
+                return geometry
+        geometry = RouteGeometry(ride.route['polyline'])
+        with self.lock:
+            self._remember(self.geometries, ride.id, geometry)
+        return geometry
+
+    def _remember(self, cache: OrderedDict, key: int, value):
+        """Store a value in one of the LRU caches; the caller holds the lock"""
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.cache_size:
+            cache.popitem(last=False)
+
+    def track(self, ride: Ride, location: Optional[Dict]) -> Optional[Dict]:
+        """Snap the driver's location to the ride's route and work out the progress and ETAs"""
+        geometry = self.geometry(ride)
+        if geometry is None or len(geometry.points) < 2 or not location:
+            return None
+        point = (location['latitude'], location['longitude'])
+        with self.lock:
+            previous = self.progress.get(ride.id)
+        start = previous['segment'] if previous else 0
+        segment, along, off = geometry.snap(point, start, start + self.window)
+        if off > self.off_route_m:
+            segment, along, off = geometry.snap(point)
+
+        route = ride.route
+        # The polyline's length differs a little from the routed distances; work in fractions of it
+        fraction = along / geometry.length if geometry.length else 1.0
+        pickup_fraction = route['pickup_distance'] / route['distance'] if route['distance'] else 0.0
+        remaining = max(0.0, route['distance'] * (1 - fraction))
+        trip_duration = route['duration'] - route['pickup_duration']
+        if fraction < pickup_fraction:
+            phase = 'to_pickup'
+            to_pickup = (pickup_fraction - fraction) / pickup_fraction * route['pickup_duration']
+            eta_pickup, eta_destination = to_pickup, to_pickup + trip_duration
+        else:
+            phase = 'to_destination'
+            trip_fraction = (1 - fraction) / (1 - pickup_fraction) if pickup_fraction < 1 else 0.0
+            eta_pickup, eta_destination = 0.0, trip_fraction * trip_duration
+
+        now = timezone.now()
+        progress = {
+            'ride': ride.id,
+            'status': ride.status,
+            'phase': phase,
+            'segment': segment,
+            'progress': round(fraction, 4),
+            'distance_remaining_m': int(round(remaining)),
+            'eta_pickup_seconds': int(round(eta_pickup)),
+            'eta_seconds': int(round(eta_destination)),
+            'estimated_arrival_time': (now + timedelta(seconds=eta_destination)).isoformat(),
+            'off_route': off > self.off_route_m,
+            'snapped_location': self._point_at(geometry, segment, along),
+            'updated_at': now.isoformat(),
+        }
+        with self.lock:
+            self._remember(self.progress, ride.id, progress)
+        metrics.inc('ride_tracking_snaps_total')
+        return progress
+
+    @staticmethod
+    def _point_at(geometry: RouteGeometry, segment: int, along: float) -> Dict:
+        (lat1, lng1), (lat2, lng2) = geometry.points[segment], geometry.points[segment + 1]
+        length = geometry.cumulative[segment + 1] - geometry.cumulative[segment]
+        t = (along - geometry.cumulative[segment]) / length if length else 0.0
+        return {'latitude': round(lat1 + (lat2 - lat1) * t, 6), 'longitude': round(lng1 + (lng2 - lng1) * t, 6)}
+
+    def forget(self, ride_id: int):
+        with self.lock:
+            self.geometries.pop(ride_id, None)
+            self.progress.pop(ride_id, None)
+            for driver_id, active_ride in list(self.active.items()):
+                if active_ride.id == ride_id:
+                    self.active.pop(driver_id, None)
+
+    def plan(self, ride: Ride, driver: Driver):
+        """Plan an accepted ride's route and start tracking its driver"""
+        try:
+            self.plan_route(ride, driver)
+        except Exception as e:
+            logger.error(f"Error planning the route of ride {ride.id}: {str(e)}")
+            return
+        with self.lock:
+            self._remember(self.active, driver.id, ride)
+
+    def run(self):
+        while True:
+            ride, driver = self.planning.get()
+            try:
+                self.plan(ride, driver)
+            finally:
+                close_old_connections()
+
+    def on_ride_accepted(self, sender, ride: Ride, driver: Driver, **kwargs):
+        """Receiver for ride_accepted: queue the route for the planning thread"""
+        if not self.plan_in_background:
+            self.plan(ride, driver)
+            return
+        self.planning.put((ride, driver))
+        with self.lock:
+            # Threads do not survive a fork, so each worker process starts its own
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='ride-routes', daemon=True)
+                self.thread.start()
+
+    def on_ride_status_changed(self, sender, ride: Ride, **kwargs):
+        """Receiver for ride_status_changed"""
+        if ride.status in self.FINISHED:
+            self.forget(ride.id)
+            return
+        with self.lock:
+            active_ride = self.active.get(ride.driver_id)
+            if active_ride is not None and active_ride.id == ride.id:
+                active_ride.status = ride.status
+
+    def on_driver_updated(self, sender, driver: Driver, **kwargs):
+        """Receiver for driver_updated: snap pings of drivers on an active ride"""
+        with self.lock:
+            ride = self.active.get(driver.id)
+        if ride is None:
+            return
+        if ride.status in self.FINISHED:
+            self.forget(ride.id)
+        else:
+            self.track(ride, driver.location)
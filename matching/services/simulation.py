@@ -0,0 +1,179 @@
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime
+from math import exp
+import hashlib
+import random
+import threading
+import time
+from googlemaps.convert import encode_polyline
+from .distance_calculator import calculate_distance
+from .local_routing import format_distance, format_duration
+
+class SimulatedUpstreamError(Exception):
+    """Injected failure standing in for an upstream API error"""
+
+class SimulationModel:
+    """
+    Seeded model of road conditions and upstream behaviour.
+
+    Answers are a pure function of (seed, query, hour), so the same inputs give
+    the same traffic scores and routes on every run. Latency and failures are
+    drawn from a separate seeded stream, reproducible for a given call order.
+    """
+
+    def __init__(
+        self,
+        seed: int = 42,
+        latency_ms: float = 0,
+        latency_sigma: float = 0.5,
+        failure_rate: float = 0.0,
+        hour: Optional[int] = None,
+        cell_degrees: float = 0.01
+    ):
+        self.seed = seed
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.failure_rate = failure_rate
+        self.hour = hour
+        self.cell_degrees = cell_degrees
+        self.upstream = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def rng(self, *key) -> random.Random:
+        """Random stream determined by the seed and the given key"""
+        digest = hashlib.blake2b(repr((self.seed, *key)).encode(), digest_size=8).digest()
+        return random.Random(int.from_bytes(digest, 'little'))
+
+    def cell(self, location: Dict) -> tuple:
+        return (
+            int(location['latitude'] // self.cell_degrees),
+            int(location['longitude'] // self.cell_degrees)
+        )
+
+    def current_hour(self) -> int:
+        return self.hour if self.hour is not None else datetime.now().hour
+
+    def congestion(self, origin: Dict, destination: Dict) -> float:
+        """Travel-time multiplier (>= 1) for a trip, peaking at the morning and evening rush"""
+        hour = self.current_hour()
+        rush = 0.6 * exp(-((hour - 8) ** 2) / 2) + 0.7 * exp(-((hour - 18) ** 2) / 2.5)
+        # Some areas are busier than others, consistently
+        busy = self.rng('area', self.cell(origin)).uniform(0.0, 0.5)
+        noise = self.rng('trip', self.cell(origin), self.cell(destination), hour).uniform(-0.1, 0.1)
+        return max(1.0, 1.0 + rush * (0.5 + busy) + busy * 0.3 + noise)
+
+    def call_upstream(self):
+        """Sleep for a simulated network latency and maybe fail, like a remote call"""
+        with self.lock:
+            latency = self.latency_ms * self.upstream.lognormvariate(0, self.latency_sigma) if self.latency_ms else 0
+            failed = self.upstream.random() < self.failure_rate
+        if latency:
+            time.sleep(latency / 1000)
+        if failed:
+            raise SimulatedUpstreamError("Simulated upstream failure")
+
+class SimulatedTrafficBackend:
+    """Traffic scores from the simulation model instead of the Distance Matrix API"""
+
+    def __init__(self, model: SimulationModel):
+        self.model = model
+
+    def get_traffic_conditions(self, origin: Dict, destination: Dict) -> float:
+        self.model.call_upstream()
+        # Same definition as the live score: free-flow duration / duration in traffic
+        return max(0, min(1, 1 / self.model.congestion(origin, destination)))
+
+class SimulatedDirectionsBackend:
+    """Directions-shaped routes from the simulation model"""
+
+    FREE_FLOW_KMH = 40
+
+    def __init__(self, model: SimulationModel):
+        self.model = model
+
+    def _path(self, start: Dict, end: Dict, variant: int) -> List[tuple]:
+        """A wiggly path between two points, fixed for a given (start, end, variant)"""
+        rng = self.model.rng('path', self.model.cell(start), self.model.cell(end), variant)
+        steps = 8
+        spread = 0.02 * (variant + 1)
+        dlat = end['latitude'] - start['latitude']
+        dlng = end['longitude'] - start['longitude']
+        points = [(start['latitude'], start['longitude'])]
+        for i in range(1, steps):
+            t = i / steps
+            offset = rng.uniform(-spread, spread)
+            points.append((
+                start['latitude'] + dlat * t - dlng * offset,
+                start['longitude'] + dlng * t + dlat * offset
+            ))
+        points.append((end['latitude'], end['longitude']))
+        return points
+
+    def _leg(self, start: Dict, end: Dict, variant: int) -> Tuple[Dict, List[tuple]]:
+        points = self._path(start, end, variant)
+        meters = sum(
+            calculate_distance(
+                {'latitude': a[0], 'longitude': a[1]}, {'latitude': b[0], 'longitude': b[1]}
+            )
+            for a, b in zip(points, points[1:])
+        ) * 1000
+        seconds = meters / (self.FREE_FLOW_KMH / 3.6) * self.model.congestion(start, end)
+        start_location = {'lat': start['latitude'], 'lng': start['longitude']}
+        end_location = {'lat': end['latitude'], 'lng': end['longitude']}
+        distance = {'text': format_distance(meters), 'value': int(round(meters))}
+        duration = {'text': format_duration(seconds), 'value': int(round(seconds))}
+        return {
+            'distance': distance,
+            'duration': duration,
+            'start_address': '',
+            'end_address': '',
+            'start_location': start_location,
+            'end_location': end_location,
+            'steps': [{
+                'distance': distance,
+                'duration': duration,
+                'start_location': start_location,
+                'end_location': end_location,
+                'polyline': {'points': encode_polyline(points)},
+                'travel_mode': 'DRIVING',
+                'html_instructions': '',
+            }],
+            'traffic_speed_entry': [],
+            'via_waypoint': [],
+        }, points
+
+    def get_optimal_route(
+        self,
+        origin: Dict[str, float],
+        destination: Dict[str, float],
+        waypoints: List[Dict[str, float]] = None
+    ) -> List[Dict]:
+        self.model.call_upstream()
+        stops = [origin, *(waypoints or []), destination]
+        alternatives = 1 + self.model.rng('alternatives', self.model.cell(origin), self.model.cell(destination)).randrange(3)
+
+        routes = []
+        for variant in range(alternatives):
+            legs, points = [], []
+            for start, end in zip(stops, stops[1:]):
+                leg, leg_points = self._leg(start, end, variant)
+                legs.append(leg)
+                points.extend(leg_points)
+            latitudes = [lat for lat, _ in points]
+            longitudes = [lng for _, lng in points]
+            routes.append({
+                'bounds': {
+                    'northeast': {'lat': max(latitudes), 'lng': max(longitudes)},
+                    'southwest': {'lat': min(latitudes), 'lng': min(longitudes)},
+                },
+                'copyrights': 'Simulated',
+                'legs': legs,
+                'overview_polyline': {'points': encode_polyline(points)},
+                'summary': f'Simulated route {variant + 1}',
+                'warnings': [],
+                'waypoint_order': list(range(len(waypoints or []))),
+            })
+
+        # Like the Directions API, the recommended route comes first
+        routes.sort(key=lambda route: sum(leg['duration']['value'] for leg in route['legs']))
+        return routes
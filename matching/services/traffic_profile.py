@@ -0,0 +1,279 @@
+from typing import Dict, Iterable, List, Optional, Tuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+import atexit
+import os
+import random
+import threading
+import time
+from django.db import IntegrityError, close_old_connections, transaction
+from django.utils import timezone
+from ..models import Ride, TrafficProfile
+from . import geohash
+from .distance_calculator import calculate_distance
+from .metrics import metrics
+from .navigation_service import ESTIMATE_DETOUR_FACTOR
+import logging
+
+logger = logging.getLogger('matching')
+
+def hour_of_week(when: datetime) -> int:
+    """0 for Monday 00:00-01:00 UTC, up to 167 for Sunday 23:00-24:00"""
+    when = when.astimezone(dt_timezone.utc) if timezone.is_aware(when) else when
+    return when.weekday() * 24 + when.hour
+
+class HistoricalTraffic:
+    """
+    Typical traffic score per geohash cell and hour of the week.
+
+    Scores (1 = free flow, as the live traffic backend reports them) are
+    learned from completed rides, whose trip speed is compared with
+    free_flow_kmh, and from a sample_rate share of live traffic answers. Both
+    endpoints' cells get each sample. Samples are buffered in memory and
+    merged into the TrafficProfile table every refresh_interval seconds, as a
+    mean over at most max_samples samples so the profile keeps following
+    changes. A ride's sample is merged only if the ride is not marked
+    traffic_counted yet, and the mark is set in the same transaction, so
+    rides added again by rebuild are never counted twice. The same refresh
+    loads the rows other processes updated since the last one. Refreshes run
+    on a background thread of their own, started on first use, so lookups
+    and samples (taken on the traffic lookup threads) are dictionary
+    operations and never query.
+    """
+
+    def __init__(
+        self,
+        precision: int = 5,
+        refresh_interval: float = 300,
+        sample_rate: float = 0.1,
+        max_samples: int = 1000,
+        min_samples: int = 3,
+        free_flow_kmh: float = 45,
+        write_attempts: int = 3
+    ):
+        self.precision = precision
+        self.refresh_interval = refresh_interval
+        self.sample_rate = sample_rate
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.free_flow_kmh = free_flow_kmh
+        self.write_attempts = write_attempts
+        # (cell, hour of week) -> (score, samples)
+        self.scores: Dict[Tuple[str, int], Tuple[float, int]] = {}
+        # (cell, hour of week) -> [sum of scores, count] not yet written
+        self.pending: Dict[Tuple[str, int], List[float]] = {}
+        # ride id -> ((cell, hour of week) keys, score) not yet written
+        self.pending_rides: Dict[int, Tuple[List[Tuple[str, int]], float]] = {}
+        self.loaded_until: Optional[datetime] = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.pid = None
+        metrics.register_gauge('traffic_profile_entries', lambda: len(self.scores))
+        atexit.register(self.flush)
+
+    def cell(self, location: Dict) -> str:
+        return geohash.encode_location(location, self.precision)
+
+    def refresh(self):
+        """Write the buffered samples, then load the rows updated since the last refresh"""
+        self.flush()
+        since = self.loaded_until
+        started = timezone.now()
+        rows = TrafficProfile.objects.all()
+        if since is not None:
+            # A little overlap, for rows written while the last refresh ran
+            rows = rows.filter(updated_at__gte=since - timedelta(seconds=5))
+        loaded = {(cell, hour): (score, samples) for cell, hour, score, samples in rows.values_list('cell', 'hour', 'score', 'samples')}
+        with self.lock:
+            self.scores.update(loaded)
+            self.loaded_until = started
+        logger.debug(f"Traffic profile refreshed with {len(loaded)} updated entries")
+
+    def ensure_fresh(self):
+        """Start the refresh thread unless this process already runs it"""
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            # Threads do not survive a fork, so each worker process starts its own
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.run, name='traffic-profile', daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                logger.error(f"Error refreshing the traffic profile: {str(e)}")
+            finally:
+                close_old_connections()
+            time.sleep(self.refresh_interval)
+
+    def lookup(self, origin: Dict, destination: Dict, when: Optional[datetime] = None) -> Optional[float]:
+        """Typical score for a trip starting at when (now by default), or None without enough samples"""
+        self.ensure_fresh()
+        hour = hour_of_week(when or timezone.now())
+        known = [
+            entry[0] for entry in (
+                self.scores.get((self.cell(origin), hour)),
+                self.scores.get((self.cell(destination), hour))
+            )
+            if entry is not None and entry[1] >= self.min_samples
+        ]
+        if not known:
+            return None
+        return sum(known) / len(known)
+
+    def add(self, origin: Dict, destination: Dict, score: float, when: Optional[datetime] = None):
+        """Buffer one observed score for both endpoints' cells"""
+        hour = hour_of_week(when or timezone.now())
+        with self.lock:
+            for cell in {self.cell(origin), self.cell(destination)}:
+                entry = self.pending.setdefault((cell, hour), [0.0, 0])
+                entry[0] += score
+                entry[1] += 1
+        self.ensure_fresh()
+
+    def record(self, origin: Dict, destination: Dict, score: float):
+        """Sample a live traffic answer into the profile"""
+        if random.random() < self.sample_rate:
+            self.add(origin, destination, score)
+            metrics.inc('traffic_profile_samples_total')
+
+    def ride_score(self, ride: Ride) -> Optional[float]:
+        """Score implied by a completed ride's trip speed, or None if it cannot be told"""
+        if not ride.started_at or not ride.completed_at:
+            return None
+        duration = (ride.completed_at - ride.started_at).total_seconds()
+        if ride.route:
+            meters = ride.route['distance'] - ride.route['pickup_distance']
+        else:
+            meters = calculate_distance(ride.pickup_location, ride.destination) * 1000 * ESTIMATE_DETOUR_FACTOR
+        # Very short trips are dominated by stops, not traffic
+        if duration < 60 or meters < 500:
+            return None
+        speed_kmh = meters / 1000 / (duration / 3600)
+        return max(0.05, min(1.0, speed_kmh / self.free_flow_kmh))
+
+    def ride_keys(self, ride: Ride) -> List[Tuple[str, int]]:
+        hour = hour_of_week(ride.started_at)
+        return [(cell, hour) for cell in {self.cell(ride.pickup_location), self.cell(ride.destination)}]
+
+    def observe_ride(self, ride: Ride) -> bool:
+        score = self.ride_score(ride)
+        if score is None:
+            return False
+        with self.lock:
+            self.pending_rides[ride.id] = (self.ride_keys(ride), score)
+        self.ensure_fresh()
+        return True
+
+    def flush(self) -> int:
+        """Merge the buffered samples into the table; returns the number of entries written"""
+        with self.lock:
+            batch, self.pending = self.pending, {}
+            rides, self.pending_rides = self.pending_rides, {}
+        if not batch and not rides:
+            return 0
+        try:
+            return self.write(batch, rides)[1]
+        except Exception:
+            # Keep the samples for the next refresh
+            with self.lock:
+                for key, (total, count) in batch.items():
+                    entry = self.pending.setdefault(key, [0.0, 0])
+                    entry[0] += total
+                    entry[1] += count
+                for ride_id, sample in rides.items():
+                    self.pending_rides.setdefault(ride_id, sample)
+            raise
+
+    def rebuild(self, rides: Iterable[Ride]) -> Tuple[int, int]:
+        """
+        Merge the given completed rides into the profile, skipping those
+        already counted; returns (rides counted, entries written). Running it
+        again over the same rides changes nothing.
+        """
+        samples = {}
+        for ride in rides:
+            score = self.ride_score(ride)
+            if score is not None:
+                samples[ride.id] = (self.ride_keys(ride), score)
+        if not samples:
+            return 0, 0
+        return self.write({}, samples)
+
+    def write(
+        self,
+        batch: Dict[Tuple[str, int], List[float]],
+        rides: Dict[int, Tuple[List[Tuple[str, int]], float]]
+    ) -> Tuple[int, int]:
+        """
+        Merge (cell, hour) -> [sum of scores, count] and the samples of rides
+        not counted yet into the table; returns (rides counted, entries
+        written). A row another process inserted meanwhile makes the attempt
+        fail as a whole; the next one merges into that row.
+        """
+        for attempt in range(1, self.write_attempts + 1):
+            try:
+                return self._write(batch, rides)
+            except IntegrityError:
+                metrics.inc('traffic_profile_write_conflicts_total')
+                if attempt == self.write_attempts:
+                    raise
+                logger.debug(f"Traffic profile write conflicted with another writer (attempt {attempt})")
+
+    def locked_rows(self, keys: Iterable[Tuple[str, int]]) -> Dict[Tuple[str, int], TrafficProfile]:
+        keys = list(keys)
+        return {
+            (row.cell, row.hour): row
+            for row in TrafficProfile.objects.select_for_update().filter(
+                cell__in={cell for cell, _ in keys},
+                hour__in={hour for _, hour in keys}
+            )
+        }
+
+    def _write(self, batch, rides) -> Tuple[int, int]:
+        batch = {key: list(entry) for key, entry in batch.items()}
+        written = {}
+        with transaction.atomic():
+            counted = []
+            if rides:
+                counted = list(Ride.objects.select_for_update().filter(
+                    id__in=list(rides),
+                    traffic_counted=False
+                ).values_list('id', flat=True))
+                Ride.objects.filter(id__in=counted).update(traffic_counted=True)
+                for ride_id in counted:
+                    keys, score = rides[ride_id]
+                    for key in keys:
+                        entry = batch.setdefault(key, [0.0, 0])
+                        entry[0] += score
+                        entry[1] += 1
+            if not batch:
+                return 0, 0
+            existing = self.locked_rows(batch)
+            created, updated = [], []
+            for key, (total, count) in batch.items():
+                row = existing.get(key)
+                if row is None:
+                    score, samples = total / count, min(count, self.max_samples)
+                    created.append(TrafficProfile(cell=key[0], hour=key[1], score=score, samples=samples))
+                else:
+                    score = (row.score * row.samples + total) / (row.samples + count)
+                    samples = min(row.samples + count, self.max_samples)
+                    row.score, row.samples, row.updated_at = score, samples, timezone.now()
+                    updated.append(row)
+                written[key] = (score, samples)
+            TrafficProfile.objects.bulk_create(created)
+            TrafficProfile.objects.bulk_update(updated, ['score', 'samples', 'updated_at'])
+        if counted:
+            metrics.inc('traffic_profile_rides_total', len(counted))
+        with self.lock:
+            self.scores.update(written)
+        return len(counted), len(written)
+
+    def on_ride_status_changed(self, sender, ride: Ride, **kwargs):
+        """Receiver for ride_status_changed"""
+        if ride.status == 'COMPLETED':
+            self.observe_ride(ride)
@@ -1,16 +1,21 @@
-import requests
-from typing import Dict
+from typing import Dict, Optional
+from collections import OrderedDict
+import threading
+import time
+from .http_transport import shared_session
+from .resilience import ResilientCaller
 
-class TrafficService:
-    def __init__(self, api_key: str):
+class GoogleTrafficBackend:
+    """Traffic scores from the Google Maps Distance Matrix API"""
+
+    def __init__(self, api_key: str, timeout: float = None, session=None):
         self.api_key = api_key
+        self.timeout = timeout
+        # Pooled keep-alive session, so repeated lookups skip the TCP/TLS handshake
+        self.session = session or shared_session()
         self.base_url = "https://maps.googleapis.com/maps/api/distancematrix/json"
 
     def get_traffic_conditions(self, origin: Dict, destination: Dict) -> float:
-        """
-        Get traffic conditions using Google Maps Distance Matrix API
-        Returns a normalized score between 0 and 1
-        """
         params = {
             'origins': f"{origin['latitude']},{origin['longitude']}",
             'destinations': f"{destination['latitude']},{destination['longitude']}",
@@ -18,7 +23,7 @@ class TrafficService:
             'departure_time': 'now'
         }
 
-        response = requests.get(self.base_url, params=params)
+        response = self.session.get(self.base_url, params=params, timeout=self.timeout)
         data = response.json()
 
         if data['status'] == 'OK':
@@ -29,4 +34,109 @@ class TrafficService:
             traffic_score = base_duration / duration if duration > 0 else 1
             return max(0, min(1, traffic_score))
         
-        return 0.5  # Default score if API fails 
\ No newline at end of file
+        return None  # No score if API fails; TrafficService falls back to cached values
+
+class ResilientTrafficBackend:
+    """
+    Wraps a traffic backend with deadlines, a circuit breaker and hedging.
+    Returns None when the upstream gives no answer, so callers can fall back.
+    """
+
+    def __init__(self, backend, caller: ResilientCaller):
+        self.backend = backend
+        self.caller = caller
+
+    def get_traffic_conditions(self, origin: Dict, destination: Dict) -> float:
+        return self.caller.call(
+            self.backend.get_traffic_conditions, origin, destination,
+            fallback=lambda: None
+        )
+
+class TrafficService:
+    DEFAULT_SCORE = 0.5
+
+    def __init__(
+        self,
+        api_key: str,
+        backend=None,
+        cache_ttl: float = 600,
+        cache_size: int = 10000,
+        cell_degrees: float = 0.01,
+        profile=None
+    ):
+        self.api_key = api_key
+        self.backend = backend or GoogleTrafficBackend(api_key)
+        # Recent scores per (origin cell, destination cell), used when a live
+        # lookup fails or is too slow
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cell_degrees = cell_degrees
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        # Optional HistoricalTraffic: typical scores by hour of the week, fed
+        # with a sample of the live answers
+        self.profile = profile
+
+    def cache_key(self, origin: Dict, destination: Dict) -> tuple:
+        return (
+            int(origin['latitude'] // self.cell_degrees),
+            int(origin['longitude'] // self.cell_degrees),
+            int(destination['latitude'] // self.cell_degrees),
+            int(destination['longitude'] // self.cell_degrees)
+        )
+
+    def cached_traffic_conditions(self, origin: Dict, destination: Dict) -> Optional[float]:
+        """Last known score for a nearby trip, or None if there is none within the TTL"""
+        key = self.cache_key(origin, destination)
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.cache_ttl:
+            return None
+        return entry[0]
+
+    def known_traffic_conditions(self, origin: Dict, destination: Dict) -> Optional[float]:
+        """Score known without a live lookup: a recent live answer, else the historical profile"""
+        score = self.cached_traffic_conditions(origin, destination)
+        if score is None and self.profile is not None:
+            score = self.profile.lookup(origin, destination)
+        return score
+
+    def fallback_traffic_conditions(self, origin: Dict, destination: Dict) -> float:
+        """Score to use without a live answer: known if possible, otherwise the default"""
+        score = self.known_traffic_conditions(origin, destination)
+        return self.DEFAULT_SCORE if score is None else score
+
+    def get_traffic_conditions(self, origin: Dict, destination: Dict) -> float:
+        """
+        Get traffic conditions from the configured traffic backend
+        Returns a normalized score between 0 and 1
+        """
+        score = self.backend.get_traffic_conditions(origin, destination)
+        if score is None:
+            return self.fallback_traffic_conditions(origin, destination)
+        key = self.cache_key(origin, destination)
+        with self.lock:
+            self.cache[key] = (score, time.monotonic())
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        if self.profile is not None:
+            self.profile.record(origin, destination, score)
+        return score
+
+def create_traffic_backend(name: str, api_key: str, simulation: Dict = None, upstream: Dict = None):
+    """
+    Build the traffic backend selected by the TRAFFIC_BACKEND setting, wrapped
+    in a ResilientCaller configured from MAP_UPSTREAM when given
+    """
+    upstream = upstream or {}
+    if name == 'google':
+        backend = GoogleTrafficBackend(api_key, timeout=upstream.get('timeout'))
+    elif name == 'simulation':
+        from .simulation import SimulatedTrafficBackend, SimulationModel
+        backend = SimulatedTrafficBackend(SimulationModel(**(simulation or {})))
+    else:
+        raise ValueError(f"Unknown traffic backend: {name}")
+    if not upstream:
+        return backend
+    return ResilientTrafficBackend(backend, ResilientCaller('traffic', **upstream))
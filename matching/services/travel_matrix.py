@@ -0,0 +1,214 @@
+from typing import Dict, Iterator, List, Optional, Tuple
+from collections import OrderedDict
+from datetime import datetime
+import threading
+import time
+import googlemaps
+from .distance_calculator import calculate_distance
+from .http_transport import shared_session
+from .metrics import metrics
+from .navigation_service import ESTIMATE_DETOUR_FACTOR
+import logging
+
+logger = logging.getLogger('matching')
+
+# (duration seconds, distance meters), or None where there is no route
+TravelTime = Optional[Tuple[float, float]]
+
+# Typical city driving speed (km/h) for each hour of the day, used by estimates
+SPEED_PROFILE_KMH = [
+    40, 42, 42, 42, 40, 36, 28, 22, 20, 24, 28, 28,
+    27, 27, 27, 26, 22, 20, 21, 25, 30, 33, 36, 38,
+]
+
+class GoogleDistanceMatrixBackend:
+    """Travel times from the Google Maps Distance Matrix API, within its per-request limits"""
+
+    max_origins = 25
+    max_destinations = 25
+    max_elements = 100
+
+    def __init__(self, api_key: str, timeout: float = None, session=None):
+        self.api_key = api_key
+        self.timeout = timeout
+        self.session = session
+        self._client = None
+
+    @property
+    def client(self) -> googlemaps.Client:
+        # Built on first use, like the Directions client
+        if self._client is None:
+            self._client = googlemaps.Client(
+                key=self.api_key,
+                timeout=self.timeout,
+                retry_timeout=self.timeout or 60,
+                requests_session=self.session or shared_session()
+            )
+        return self._client
+
+    def travel_times(self, origins: List[Dict], destinations: List[Dict]) -> List[List[TravelTime]]:
+        result = self.client.distance_matrix(
+            origins=[(point['latitude'], point['longitude']) for point in origins],
+            destinations=[(point['latitude'], point['longitude']) for point in destinations],
+            mode='driving',
+            departure_time='now'
+        )
+        rows = []
+        for row in result['rows']:
+            elements = []
+            for element in row['elements']:
+                if element.get('status') != 'OK':
+                    elements.append(None)
+                    continue
+                duration = element.get('duration_in_traffic', element['duration'])['value']
+                elements.append((duration, element['distance']['value']))
+            rows.append(elements)
+        return rows
+
+class GraphMatrixBackend:
+    """Travel times from an offline road graph, one backward search per destination"""
+
+    max_origins = 1000
+    max_destinations = 1000
+    max_elements = 1000000
+
+    def __init__(self, routing):
+        self.routing = routing
+
+    def travel_times(self, origins: List[Dict], destinations: List[Dict]) -> List[List[TravelTime]]:
+        columns = [self.routing.travel_times_to(destination, origins) for destination in destinations]
+        return [[column[i] for column in columns] for i in range(len(origins))]
+
+class TravelTimeMatrix:
+    """
+    Travel times between many origins and destinations.
+
+    Points are snapped to cells of cell_degrees, so duplicate and nearby
+    points share one element, and answers are cached per cell pair for
+    cache_ttl seconds. The missing pairs are requested from the backend in as
+    few requests as its limits allow, a block of origins at a time, and rows
+    are yielded as soon as each block is done. Pairs the backend cannot
+    answer, or every pair in estimate mode (or without a backend), use the
+    haversine distance with a typical detour and the speed for the hour.
+    """
+
+    LIVE = 'live'
+    ESTIMATE = 'estimate'
+
+    def __init__(
+        self,
+        backend=None,
+        caller=None,
+        cache_ttl: float = 300,
+        cache_size: int = 100000,
+        cell_degrees: float = 0.002
+    ):
+        self.backend = backend
+        # Optional ResilientCaller for the backend's requests
+        self.caller = caller
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.cell_degrees = cell_degrees
+        self.cache: 'OrderedDict[tuple, Tuple[TravelTime, float]]' = OrderedDict()
+        self.lock = threading.Lock()
+
+    def cell(self, point: Dict) -> Tuple[int, int]:
+        return int(point['latitude'] // self.cell_degrees), int(point['longitude'] // self.cell_degrees)
+
+    @staticmethod
+    def estimate(origin: Dict, destination: Dict, hour: Optional[int] = None) -> Tuple[float, float]:
+        meters = calculate_distance(origin, destination) * 1000 * ESTIMATE_DETOUR_FACTOR
+        speed = SPEED_PROFILE_KMH[datetime.now().hour if hour is None else hour]
+        return meters / (speed / 3.6), meters
+
+    def cached(self, key: tuple) -> Tuple[bool, TravelTime]:
+        with self.lock:
+            entry = self.cache.get(key)
+        if entry is None or time.monotonic() - entry[1] > self.cache_ttl:
+            return False, None
+        return True, entry[0]
+
+    def store(self, key: tuple, value: TravelTime):
+        with self.lock:
+            self.cache[key] = (value, time.monotonic())
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def fetch(self, origins: List[Dict], destinations: List[Dict]) -> Optional[List[List[TravelTime]]]:
+        """One backend request; None if it failed"""
+        metrics.inc('travel_matrix_upstream_requests_total')
+        if self.caller is not None:
+            return self.caller.call(self.backend.travel_times, origins, destinations, fallback=lambda: None)
+        try:
+            return self.backend.travel_times(origins, destinations)
+        except Exception as e:
+            logger.error(f"Travel time matrix request failed: {str(e)}")
+            return None
+
+    def rows(self, origins: List[Dict], destinations: List[Dict], mode: str = LIVE) -> Iterator[Tuple[int, List[Dict]]]:
+        """Yield (origin index, elements) for every origin, as soon as its row is complete"""
+        hour = datetime.now().hour
+        origin_cells = [self.cell(point) for point in origins]
+        destination_cells = [self.cell(point) for point in destinations]
+        # The first point in each cell stands for the whole cell
+        origin_points, destination_points = {}, {}
+        for cell, point in zip(origin_cells, origins):
+            origin_points.setdefault(cell, point)
+        for cell, point in zip(destination_cells, destinations):
+            destination_points.setdefault(cell, point)
+        rows_by_cell: Dict[tuple, List[int]] = {}
+        for index, cell in enumerate(origin_cells):
+            rows_by_cell.setdefault(cell, []).append(index)
+
+        live = mode == self.LIVE and self.backend is not None
+        unique_destinations = list(destination_points)
+        if live:
+            backend = self.backend
+            block_destinations = min(len(unique_destinations), backend.max_destinations)
+            block_origins = max(1, min(backend.max_origins, backend.max_elements // block_destinations))
+        else:
+            block_origins = len(rows_by_cell)
+        unique_origins = list(rows_by_cell)
+
+        for start in range(0, len(unique_origins), block_origins):
+            block = unique_origins[start:start + block_origins]
+            answers: Dict[tuple, Tuple[TravelTime, str]] = {}
+            if live:
+                missing_destinations = []
+                for destination in unique_destinations:
+                    for origin in block:
+                        found, value = self.cached((origin, destination))
+                        if found:
+                            answers[(origin, destination)] = (value, 'cache')
+                        elif destination not in missing_destinations:
+                            missing_destinations.append(destination)
+                metrics.inc('travel_matrix_cache_hits_total', len(answers))
+                for offset in range(0, len(missing_destinations), block_destinations):
+                    chunk = missing_destinations[offset:offset + block_destinations]
+                    result = self.fetch([origin_points[cell] for cell in block], [destination_points[cell] for cell in chunk])
+                    if result is None:
+                        continue
+                    for origin, row in zip(block, result):
+                        for destination, value in zip(chunk, row):
+                            self.store((origin, destination), value)
+                            answers.setdefault((origin, destination), (value, 'live'))
+
+            for origin in block:
+                elements = []
+                for destination in destination_cells:
+                    value, source = answers.get((origin, destination), (None, None))
+                    if source is None:
+                        value = self.estimate(origin_points[origin], destination_points[destination], hour)
+                        source = self.ESTIMATE
+                    if value is None:
+                        elements.append({'status': 'ZERO_RESULTS', 'source': source})
+                    else:
+                        elements.append({
+                            'status': 'OK',
+                            'duration': int(round(value[0])),
+                            'distance': int(round(value[1])),
+                            'source': source
+                        })
+                for index in rows_by_cell[origin]:
+                    yield index, elements
@@ -0,0 +1,195 @@
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Tuple
+from math import ceil, floor
+import threading
+import time
+from ..models import Driver, Zone
+from .metrics import metrics
+import logging
+
+logger = logging.getLogger('matching')
+
+Cell = Tuple[int, int]
+Point = Tuple[float, float]   # (latitude, longitude)
+
+NO_ZONES: FrozenSet[int] = frozenset()
+
+class ZoneShape(NamedTuple):
+    id: int
+    name: str
+    kind: str
+    points: List[Point]
+
+def points_in_polygon(polygon: Sequence[Point], points: Sequence[Point]) -> List[bool]:
+    """
+    Even-odd ray casting for a batch of points: the loop runs over the
+    polygon's edges once, testing every point against each edge
+    """
+    inside = [False] * len(points)
+    count = len(polygon)
+    for k in range(count):
+        lat1, lng1 = polygon[k]
+        lat2, lng2 = polygon[k - 1]
+        if lat1 == lat2:
+            continue
+        slope = (lng2 - lng1) / (lat2 - lat1)
+        low, high = min(lat1, lat2), max(lat1, lat2)
+        for i, (lat, lng) in enumerate(points):
+            if low <= lat < high and lng < lng1 + (lat - lat1) * slope:
+                inside[i] = not inside[i]
+    return inside
+
+class ZoneIndex:
+    """
+    Grid index of geofenced zones (airport queues, no-pickup areas, cities).
+
+    Each zone polygon is rasterised onto cells of cell_degrees when the index
+    loads: cells wholly inside a zone list it in inside, cells its edge passes
+    through list it in boundary. Finding the zones of a point is then one
+    cell lookup plus an exact polygon test only for the zones whose edge
+    crosses that cell.
+
+    Drivers' memberships are kept per driver and recomputed only when their
+    location moves them into another cell, or moves them within a cell on a
+    zone's edge, so matching reads them with a dictionary lookup. Zones are
+    reloaded when they change and every reload_interval seconds (for changes
+    made by other processes).
+    """
+
+    def __init__(self, cell_degrees: float = 0.01, reload_interval: float = 60):
+        self.cell_degrees = cell_degrees
+        self.reload_interval = reload_interval
+        self.zones: Dict[int, ZoneShape] = {}
+        self.inside: Dict[Cell, FrozenSet[int]] = {}
+        self.boundary: Dict[Cell, FrozenSet[int]] = {}
+        # driver id -> (cell, location, zone ids)
+        self.members: Dict[int, Tuple[Cell, Point, FrozenSet[int]]] = {}
+        self.loaded_at: Optional[float] = None
+        self.lock = threading.Lock()
+        metrics.register_gauge('zones_loaded', lambda: len(self.zones))
+
+    def cell(self, latitude: float, longitude: float) -> Cell:
+        return floor(latitude / self.cell_degrees), floor(longitude / self.cell_degrees)
+
+    def load(self):
+        """(Re)build the index from the active zones in the database"""
+        zones, inside, boundary = {}, {}, {}
+        for zone in Zone.objects.filter(active=True):
+            points = [(point['latitude'], point['longitude']) for point in zone.polygon]
+            if len(points) < 3:
+                logger.warning(f"Skipping zone {zone.id} ({zone.name}): fewer than 3 points")
+                continue
+            zones[zone.id] = ZoneShape(zone.id, zone.name, zone.kind, points)
+            zone_inside, zone_boundary = self.rasterise(points)
+            for cell in zone_inside:
+                inside.setdefault(cell, set()).add(zone.id)
+            for cell in zone_boundary:
+                boundary.setdefault(cell, set()).add(zone.id)
+        with self.lock:
+            self.zones = zones
+            self.inside = {cell: frozenset(ids) for cell, ids in inside.items()}
+            self.boundary = {cell: frozenset(ids) for cell, ids in boundary.items()}
+            self.members = {}
+            self.loaded_at = time.monotonic()
+        logger.info(f"Zone index loaded with {len(zones)} zones")
+
+    def rasterise(self, points: List[Point]) -> Tuple[List[Cell], List[Cell]]:
+        """Cells wholly inside a polygon, and cells its edge may pass through"""
+        size = self.cell_degrees
+        edge_cells = set()
+        for k in range(len(points)):
+            (lat1, lng1), (lat2, lng2) = points[k - 1], points[k]
+            # Walk the edge in steps shorter than a cell, marking every cell each step's box touches
+            steps = max(1, ceil(max(abs(lat2 - lat1), abs(lng2 - lng1)) / size))
+            for step in range(steps):
+                a, b = step / steps, (step + 1) / steps
+                lat_a, lng_a = lat1 + (lat2 - lat1) * a, lng1 + (lng2 - lng1) * a
+                lat_b, lng_b = lat1 + (lat2 - lat1) * b, lng1 + (lng2 - lng1) * b
+                low, high = self.cell(min(lat_a, lat_b), min(lng_a, lng_b)), self.cell(max(lat_a, lat_b), max(lng_a, lng_b))
+                for i in range(low[0], high[0] + 1):
+                    for j in range(low[1], high[1] + 1):
+                        edge_cells.add((i, j))
+
+        # Cells no edge touches are wholly inside or outside: test their centres in one batch
+        low = self.cell(min(lat for lat, _ in points), min(lng for _, lng in points))
+        high = self.cell(max(lat for lat, _ in points), max(lng for _, lng in points))
+        interior = [
+            (i, j) for i in range(low[0], high[0] + 1) for j in range(low[1], high[1] + 1)
+            if (i, j) not in edge_cells
+        ]
+        centres = [((i + 0.5) * size, (j + 0.5) * size) for i, j in interior]
+        flags = points_in_polygon(points, centres)
+        return [cell for cell, flag in zip(interior, flags) if flag], list(edge_cells)
+
+    def ensure_loaded(self):
+        if self.loaded_at is None or time.monotonic() - self.loaded_at > self.reload_interval:
+            self.load()
+
+    def zones_at(self, location: Optional[Dict]) -> FrozenSet[int]:
+        """Ids of the zones containing a location"""
+        if not location:
+            return NO_ZONES
+        self.ensure_loaded()
+        point = (location['latitude'], location['longitude'])
+        return self._zones_at(self.cell(*point), point)
+
+    def _zones_at(self, cell: Cell, point: Point) -> FrozenSet[int]:
+        zones = self.inside.get(cell, NO_ZONES)
+        edge = self.boundary.get(cell)
+        if edge:
+            hits = [zone_id for zone_id in edge if points_in_polygon(self.zones[zone_id].points, [point])[0]]
+            if hits:
+                zones = zones | frozenset(hits)
+        return zones
+
+    def driver_zones(self, driver: Driver) -> FrozenSet[int]:
+        """Ids of the zones a driver is in, recomputed only when they changed cell or moved on a zone edge"""
+        if not driver.location:
+            return NO_ZONES
+        self.ensure_loaded()
+        point = (driver.location['latitude'], driver.location['longitude'])
+        cell = self.cell(*point)
+        member = self.members.get(driver.id)
+        if member is not None and member[0] == cell and (member[1] == point or cell not in self.boundary):
+            return member[2]
+        zones = self._zones_at(cell, point)
+        self.members[driver.id] = (cell, point, zones)
+        return zones
+
+    def kinds(self, zone_ids: FrozenSet[int], kind: str) -> FrozenSet[int]:
+        return frozenset(zone_id for zone_id in zone_ids if self.zones[zone_id].kind == kind)
+
+    def no_pickup_zone(self, location: Dict) -> Optional[ZoneShape]:
+        """The no-pickup zone a location is in, if any"""
+        for zone_id in self.zones_at(location):
+            if self.zones[zone_id].kind == Zone.NO_PICKUP:
+                return self.zones[zone_id]
+        return None
+
+    def can_serve(self, driver_zones: FrozenSet[int], pickup_zones: FrozenSet[int]) -> bool:
+        """
+        Whether a driver may take a pickup: drivers waiting in an airport queue
+        only serve pickups from that airport, and drivers inside a city only
+        serve pickups from that city when the pickup is inside a city too
+        """
+        if not driver_zones:
+            return True
+        queues = self.kinds(driver_zones, Zone.AIRPORT_QUEUE)
+        if queues and not queues & pickup_zones:
+            return False
+        driver_cities = self.kinds(driver_zones, Zone.CITY)
+        pickup_cities = self.kinds(pickup_zones, Zone.CITY)
+        if driver_cities and pickup_cities and not driver_cities & pickup_cities:
+            return False
+        return True
+
+    def has_priority(self, driver_zones: FrozenSet[int], pickup_zones: FrozenSet[int]) -> bool:
+        """Whether a driver is waiting in the airport queue the pickup is in"""
+        return bool(driver_zones and self.kinds(driver_zones & pickup_zones, Zone.AIRPORT_QUEUE))
+
+    def on_driver_updated(self, sender, driver: Driver, **kwargs):
+        """Receiver for driver_updated"""
+        self.driver_zones(driver)
+
+    def on_zones_changed(self, sender, **kwargs):
+        """Receiver for post_save / post_delete of Zone"""
+        self.loaded_at = None
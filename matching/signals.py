@@ -0,0 +1,13 @@
+from django.dispatch import Signal
+
+# Sent when a driver's location or availability changes.
+# Arguments: driver, previous_location, previous_available
+driver_updated = Signal()
+
+# Sent after a driver has accepted a ride and the acceptance is committed.
+# Arguments: ride, driver
+ride_accepted = Signal()
+
+# Sent after a ride was created or its status changed, once committed.
+# Arguments: ride, previous_status (None for a new ride)
+ride_status_changed = Signal()
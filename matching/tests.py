@@ -1,3 +1,1893 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
 
-# Create your tests here.
+import requests
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+from requests.adapters import BaseAdapter
+from rest_framework.test import APIClient
+
+from ride_mgn_system import api_docs
+
+from .admin import DriverAdmin
+from .models import Driver, MatchJob, Passenger, Ride, RideRequest, TrafficProfile, Zone, region_for
+from .services import preferences
+from .services.admission import ConcurrencyLimiter, TokenBuckets
+from .services.candidate_cache import CandidateCache
+from .services.dispatch_service import DispatchService
+from .services.distance_calculator import calculate_distance
+from .services.driver_state import DriverStateTable
+from .services.heatmap import Heatmap
+from .services.http_transport import PooledSession, RetryBudget
+from .services.local_routing import LocalRoutingBackend, build_road_graph
+from .services.location_coalescer import LocationCoalescer
+from .services.match_queue import MatchQueue
+from .services.matching_service import MatchingService
+from .services.nearby import NearbyIndex
+from .services.presence import PresenceTracker
+from .services.registry import ServiceRegistry, registry
+from .services.resilience import CircuitBreaker, ResilientCaller
+from .services.simulation import (
+    SimulatedDirectionsBackend, SimulatedTrafficBackend, SimulatedUpstreamError, SimulationModel
+)
+from .services.traffic_profile import HistoricalTraffic, hour_of_week
+from .services.travel_matrix import TravelTimeMatrix
+from .services.zones import ZoneIndex
+from .signals import driver_updated, ride_status_changed
+
+# Map services are built against the seeded simulation backends, so no test
+# calls a real map API, routes are planned on the request thread, and no
+# traffic profile thread is started behind a test's back
+OFFLINE_SETTINGS = {
+    'TRAFFIC_BACKEND': 'simulation',
+    'NAVIGATION_BACKEND': 'simulation',
+    'TRAFFIC_PROFILE': None,
+    'RIDE_TRACKING': {'off_route_m': 100, 'window': 50, 'plan_in_background': False},
+}
+
+
+def create_driver(username, location=None):
+    user = User.objects.create(username=username)
+    driver = Driver.objects.create(
+        user=user,
+        firstname=username,
+        lastname='Driver',
+        location=location or {'latitude': 6.5244, 'longitude': 3.3792},
+    )
+    return user, driver
+
+
+def create_passenger(username):
+    user = User.objects.create(username=username)
+    passenger = Passenger.objects.create(user=user, firstname=username, lastname='Passenger')
+    return user, passenger
+
+
+def create_pending_ride(drivers):
+    user = User.objects.create(username='passenger')
+    passenger = Passenger.objects.create(user=user, firstname='Pat', lastname='Passenger')
+    location = {'latitude': 6.5244, 'longitude': 3.3792}
+    ride = Ride.objects.create(
+        driver=drivers[0],
+        passenger=passenger,
+        pickup_location=location,
+        destination={'latitude': 6.4654, 'longitude': 3.4064},
+    )
+    requests = [RideRequest.objects.create(ride=ride, driver=driver) for driver in drivers]
+    return ride, requests
+
+
+class OfflineServicesMixin:
+    """Builds every service afresh for each test, with OFFLINE_SETTINGS"""
+
+    def setUp(self):
+        super().setUp()
+        overrides = self.settings(**OFFLINE_SETTINGS)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        registry.reset()
+        self.addCleanup(registry.reset)
+
+
+class RideRequestRespondTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users, self.drivers = zip(*(create_driver(f'driver{i}') for i in range(3)))
+        self.ride, self.requests = create_pending_ride(self.drivers)
+
+    def respond(self, index, answer):
+        client = APIClient()
+        client.force_authenticate(self.users[index])
+        return client.post(
+            f'/api/rides/ride-requests/{self.requests[index].id}/respond/',
+            {'status': answer},
+            format='json',
+        )
+
+    def test_accept_claims_ride_and_withdraws_siblings(self):
+        response = self.respond(1, 'accepted')
+
+        self.assertEqual(response.status_code, 200)
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.status, 'ACCEPTED')
+        self.assertEqual(self.ride.driver_id, self.drivers[1].id)
+        statuses = dict(RideRequest.objects.values_list('driver_id', 'status'))
+        self.assertEqual(statuses, {
+            self.drivers[0].id: 'WITHDRAWN',
+            self.drivers[1].id: 'ACCEPTED',
+            self.drivers[2].id: 'WITHDRAWN',
+        })
+
+    def test_second_accept_gets_conflict(self):
+        self.assertEqual(self.respond(0, 'ACCEPTED').status_code, 200)
+
+        response = self.respond(2, 'ACCEPTED')
+
+        self.assertEqual(response.status_code, 409)
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.driver_id, self.drivers[0].id)
+
+    def test_reject_is_only_applied_once(self):
+        self.assertEqual(self.respond(0, 'REJECTED').status_code, 200)
+        self.assertEqual(self.respond(0, 'ACCEPTED').status_code, 409)
+        self.ride.refresh_from_db()
+        self.assertEqual(self.ride.status, 'PENDING')
+
+
+class ConcurrentAcceptTests(OfflineServicesMixin, TransactionTestCase):
+    DRIVERS = 8
+
+    def test_exactly_one_concurrent_accept_wins(self):
+        users, drivers = zip(*(create_driver(f'driver{i}') for i in range(self.DRIVERS)))
+        ride, requests = create_pending_ride(drivers)
+        barrier = threading.Barrier(self.DRIVERS)
+        results = [None] * self.DRIVERS
+
+        def accept(index):
+            client = APIClient()
+            client.force_authenticate(users[index])
+            try:
+                barrier.wait()
+                results[index] = client.post(
+                    f'/api/rides/ride-requests/{requests[index].id}/respond/',
+                    {'status': 'ACCEPTED'},
+                    format='json',
+                ).status_code
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=accept, args=(i,)) for i in range(self.DRIVERS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(results.count(200), 1)
+        self.assertEqual(results.count(409), self.DRIVERS - 1)
+        winner = drivers[results.index(200)]
+        ride.refresh_from_db()
+        self.assertEqual(ride.status, 'ACCEPTED')
+        self.assertEqual(ride.driver_id, winner.id)
+        accepted = RideRequest.objects.filter(ride=ride, status='ACCEPTED')
+        self.assertEqual(list(accepted.values_list('driver_id', flat=True)), [winner.id])
+
+
+class RideTrackingTests(OfflineServicesMixin, TestCase):
+    def test_accept_plans_route_and_tracks_driver(self):
+        users, drivers = zip(*(create_driver(f'driver{i}') for i in range(2)))
+        ride, requests = create_pending_ride(drivers)
+        client = APIClient()
+        client.force_authenticate(users[0])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.post(
+                f'/api/rides/ride-requests/{requests[0].id}/respond/', {'status': 'ACCEPTED'}, format='json'
+            )
+        self.assertEqual(response.status_code, 200)
+
+        ride.refresh_from_db()
+        self.assertTrue(ride.route['polyline'])
+        response = client.get(f'/api/rides/rides/{ride.id}/tracking/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(response.data['phase'], ('to_pickup', 'to_destination'))
+
+    def test_background_planning_does_not_hold_up_accept(self):
+        from .services.ride_tracking import RideTracker
+
+        release, planned = threading.Event(), threading.Event()
+
+        class SlowNavigation:
+            def get_optimal_route(self, **kwargs):
+                release.wait(5)
+                planned.set()
+                return []
+
+        tracker = RideTracker(SlowNavigation(), plan_in_background=True)
+        _, driver = create_driver('driver')
+        ride, _ = create_pending_ride([driver])
+
+        tracker.on_ride_accepted(Ride, ride=ride, driver=driver)
+        self.assertFalse(planned.is_set())
+        release.set()
+        self.assertTrue(planned.wait(5))
+
+    def test_tracked_rides_are_bounded(self):
+        from .services.ride_tracking import RideTracker
+
+        tracker = RideTracker(registry.navigation_service, cache_size=2, plan_in_background=False)
+        _, passenger = create_passenger('rider')
+        rides = []
+        for i in range(3):
+            _, driver = create_driver(f'driver{i}')
+            ride = Ride.objects.create(
+                driver=driver, passenger=passenger, pickup_location=PICKUP, destination=DESTINATION
+            )
+            tracker.on_ride_accepted(Ride, ride=ride, driver=driver)
+            tracker.on_driver_updated(Driver, driver=driver)
+            rides.append((ride, driver))
+
+        self.assertEqual(list(tracker.active), [driver.id for _, driver in rides[1:]])
+        self.assertEqual(list(tracker.progress), [ride.id for ride, _ in rides[1:]])
+
+    def test_finished_ride_is_dropped_on_the_next_ping(self):
+        from .services.ride_tracking import RideTracker
+
+        tracker = RideTracker(registry.navigation_service, plan_in_background=False)
+        _, driver = create_driver('driver')
+        ride, _ = create_pending_ride([driver])
+        tracker.on_ride_accepted(Ride, ride=ride, driver=driver)
+        tracker.on_driver_updated(Driver, driver=driver)
+        self.assertIn(ride.id, tracker.progress)
+
+        # The ride ended without this process hearing ride_status_changed for it
+        tracker.active[driver.id].status = 'COMPLETED'
+        tracker.on_driver_updated(Driver, driver=driver)
+
+        self.assertNotIn(driver.id, tracker.active)
+        self.assertNotIn(ride.id, tracker.progress)
+
+
+PICKUP = {'latitude': 6.5244, 'longitude': 3.3792}
+DESTINATION = {'latitude': 6.4654, 'longitude': 3.4064}
+
+
+class DispatchWaveTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.dispatch = DispatchService(policy=DispatchService.SEQUENTIAL, wave_timeout=20)
+        self.drivers = [create_driver(f'driver{i}')[1] for i in range(3)]
+        self.user, self.passenger = create_passenger('rider')
+
+    def lapse(self, ride):
+        RideRequest.objects.filter(ride=ride, status='PENDING').update(expires_at=timezone.now() - timedelta(seconds=1))
+
+    def test_sequential_offer_expires(self):
+        ride, requests = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+
+        self.assertEqual([request.driver_id for request in requests], [self.drivers[0].id])
+        self.assertIsNotNone(requests[0].expires_at)
+
+    def test_advance_waits_for_the_current_wave(self):
+        ride, _ = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+
+        self.assertEqual(self.dispatch.advance(ride), [])
+        self.assertEqual(RideRequest.objects.filter(ride=ride).count(), 1)
+
+    def test_advance_expires_lapsed_wave_and_offers_the_next(self):
+        ride, requests = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+        self.lapse(ride)
+
+        next_requests = self.dispatch.advance(ride)
+
+        self.assertEqual([request.driver_id for request in next_requests], [self.drivers[1].id])
+        requests[0].refresh_from_db()
+        self.assertEqual(requests[0].status, 'EXPIRED')
+        ride.refresh_from_db()
+        self.assertEqual(ride.wave, 2)
+
+    def test_advance_after_all_rejected(self):
+        ride, requests = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+        RideRequest.objects.filter(id=requests[0].id).update(status='REJECTED')
+
+        next_requests = self.dispatch.advance(ride)
+
+        self.assertEqual([request.driver_id for request in next_requests], [self.drivers[1].id])
+
+    def test_offers_taken_by_another_driver_do_not_count_against_the_rate(self):
+        dispatch = DispatchService(policy=DispatchService.BROADCAST, max_requests=2)
+        first, _ = create_pending_ride([self.drivers[1]])
+        RideRequest.objects.filter(ride=first).update(status='REJECTED')
+        before = dispatch.acceptance_rates([self.drivers[1].id])
+        _, requests = dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers[:2])
+        client = APIClient()
+        client.force_authenticate(self.drivers[0].user)
+
+        response = client.post(f'/api/rides/ride-requests/{requests[0].id}/respond/', {'status': 'ACCEPTED'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        requests[1].refresh_from_db()
+        self.assertEqual(requests[1].status, 'WITHDRAWN')
+        self.assertEqual(dispatch.acceptance_rates([self.drivers[1].id]), before)
+        self.assertEqual(before, {self.drivers[1].id: 1 / 3})
+
+    def test_expired_offers_count_as_not_accepted(self):
+        ride, _ = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+        self.lapse(ride)
+        self.dispatch.advance(ride)
+
+        self.assertEqual(self.dispatch.acceptance_rates([self.drivers[0].id]), {self.drivers[0].id: 1 / 3})
+
+    def test_cancelling_a_ride_withdraws_its_offers(self):
+        ride, requests = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post(f'/api/rides/rides/{ride.id}/update_status/', {'status': 'CANCELLED'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        requests[0].refresh_from_db()
+        self.assertEqual(requests[0].status, 'WITHDRAWN')
+
+    def test_ride_is_cancelled_when_its_ranking_runs_out(self):
+        ride, _ = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers[:2])
+        changes = []
+        receiver = lambda sender, ride, previous_status, **kwargs: changes.append((ride.id, previous_status, ride.status))
+        ride_status_changed.connect(receiver, dispatch_uid='tests.exhausted')
+        self.addCleanup(ride_status_changed.disconnect, dispatch_uid='tests.exhausted')
+
+        for _ in range(2):
+            self.lapse(ride)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.dispatch.advance(ride)
+
+        ride.refresh_from_db()
+        self.assertEqual(ride.status, 'CANCELLED')
+        self.assertEqual(changes, [(ride.id, 'PENDING', 'CANCELLED')])
+        self.assertFalse(RideRequest.objects.filter(ride=ride, status='PENDING').exists())
+
+    def test_last_rejection_cancels_the_ride(self):
+        self.addCleanup(registry.register, 'dispatch_service', registry.factories['dispatch_service'])
+        registry.register('dispatch_service', lambda registry: self.dispatch)
+        ride, requests = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers[:1])
+        client = APIClient()
+        client.force_authenticate(self.drivers[0].user)
+
+        response = client.post(f'/api/rides/ride-requests/{requests[0].id}/respond/', {'status': 'REJECTED'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNone(response.data['rematch'])
+        ride.refresh_from_db()
+        self.assertEqual(ride.status, 'CANCELLED')
+
+    def test_expire_sweep_offers_next_wave(self):
+        ride, _ = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+        self.lapse(ride)
+
+        self.assertEqual(self.dispatch.expire_requests(), 1)
+        pending = RideRequest.objects.filter(ride=ride, status='PENDING')
+        self.assertEqual(list(pending.values_list('driver_id', flat=True)), [self.drivers[1].id])
+
+    def test_match_moves_lapsed_open_ride_to_next_wave(self):
+        self.addCleanup(registry.register, 'dispatch_service', registry.factories['dispatch_service'])
+        registry.register('dispatch_service', lambda registry: self.dispatch)
+        ride, _ = registry.dispatch_service.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+        self.lapse(ride)
+        client = APIClient()
+        client.force_authenticate(self.user)
+
+        response = client.post('/api/rides/match/', {
+            'passenger_id': self.passenger.id,
+            'pickup_location': PICKUP,
+            'destination': DESTINATION,
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.data['existing'])
+        self.assertEqual(response.data['ride']['id'], ride.id)
+        self.assertEqual([request['driver'] for request in response.data['ride_requests']], [self.drivers[1].id])
+
+
+def point(latitude, longitude):
+    return {'latitude': latitude, 'longitude': longitude}
+
+
+class CarpoolInsertionTests(TestCase):
+    DRIVER = point(6.50, 3.35)
+    FIRST = [
+        {'passenger': 1, 'kind': 'pickup', 'location': point(6.51, 3.35)},
+        {'passenger': 1, 'kind': 'dropoff', 'location': point(6.60, 3.35)},
+    ]
+
+    def carpool(self, stops, riders, capacity=3, **options):
+        from .services.carpool import CarpoolService, SharedRide
+
+        carpool = CarpoolService(**options)
+        carpool._index(SharedRide(1, 1, capacity, stops, riders, self.DRIVER))
+        carpool.loaded_at = float('inf')
+        return carpool
+
+    def test_cheapest_insertion_picks_up_along_the_way(self):
+        carpool = self.carpool(self.FIRST, [(1, 'WAITING', 5.0, 0.0)])
+
+        insertion = carpool.find_insertion(point(6.52, 3.351), point(6.58, 3.35))
+
+        self.assertEqual((insertion.pickup_after, insertion.dropoff_after), (1, 1))
+        self.assertLess(insertion.added_km, 0.5)
+        self.assertLessEqual(insertion.delays[1], 5.0)
+
+    def test_full_ride_takes_nobody(self):
+        on_board = [(1, 'ON_BOARD', 5.0, 0.0)]
+
+        full = self.carpool(self.FIRST[1:], on_board, capacity=1)
+        self.assertIsNone(full.find_insertion(point(6.52, 3.351), point(6.58, 3.35)))
+
+        roomy = self.carpool(self.FIRST[1:], on_board, capacity=2)
+        self.assertIsNotNone(roomy.find_insertion(point(6.52, 3.351), point(6.58, 3.35)))
+
+    def test_detour_beyond_a_riders_slack_is_refused(self):
+        # Picking up 3 km off the route would delay the first rider too much
+        carpool = self.carpool(self.FIRST, [(1, 'WAITING', 1.0, 0.0)])
+        self.assertIsNone(carpool.find_insertion(point(6.53, 3.38), point(6.57, 3.38)))
+
+        # Unless the new passenger waits until the first one is dropped off
+        carpool = self.carpool(self.FIRST, [(1, 'WAITING', 1.0, 0.0)], max_pickup_km=20)
+        insertion = carpool.find_insertion(point(6.53, 3.38), point(6.57, 3.38))
+        self.assertEqual(insertion.pickup_after, 2)
+        self.assertEqual(insertion.delays, {})
+
+    def test_new_passengers_own_detour_is_bounded(self):
+        # Riding along to the far end of the first trip would take the new
+        # passenger well past their allowance
+        stops = [self.FIRST[0], {'passenger': 1, 'kind': 'dropoff', 'location': point(6.80, 3.35)}]
+        carpool = self.carpool(stops, [(1, 'ON_BOARD', 5.0, 0.0)], capacity=2, max_detour_ratio=0.1)
+
+        insertion = carpool.find_insertion(point(6.52, 3.35), point(6.55, 3.40))
+
+        self.assertIsNone(insertion)
+
+
+class SharedRideTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.driver_user, driver = create_driver('driver', point(6.50, 3.35))
+        self.ride, _ = create_pending_ride([driver])
+        Ride.objects.filter(id=self.ride.id).update(
+            status='ACCEPTED', pickup_location=point(6.51, 3.35), destination=point(6.60, 3.35)
+        )
+        self.ride.refresh_from_db()
+
+    def stop(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client.post(f'/api/rides/rides/{self.ride.id}/complete_stop/', format='json')
+
+    def test_shared_match_joins_active_ride(self):
+        registry.carpool.open(self.ride)
+        user, passenger = create_passenger('rider')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.post('/api/rides/match/', {
+            'passenger_id': passenger.id,
+            'pickup_location': point(6.52, 3.351),
+            'destination': point(6.58, 3.35),
+            'shared': True,
+        }, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['ride']['id'], self.ride.id)
+        self.assertEqual(response.data['ride_requests'], [])
+        self.assertEqual(response.data['rider']['passenger'], passenger.id)
+        self.assertEqual(
+            [(stop['passenger'], stop['kind']) for stop in response.data['ride']['stops']],
+            [(self.ride.passenger_id, 'pickup'), (passenger.id, 'pickup'),
+             (passenger.id, 'dropoff'), (self.ride.passenger_id, 'dropoff')]
+        )
+
+    def test_only_the_driver_completes_stops(self):
+        registry.carpool.open(self.ride)
+        other, _ = create_passenger('other')
+
+        self.assertEqual(self.stop(other).status_code, 403)
+        response = self.stop(self.driver_user)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['completed']['kind'], 'pickup')
+        self.assertEqual(self.ride.riders.get().status, 'ON_BOARD')
+
+    def test_complete_stop_conflicts(self):
+        self.assertEqual(self.stop(self.driver_user).status_code, 409)
+
+        registry.carpool.open(self.ride)
+        self.assertEqual(self.stop(self.driver_user).status_code, 200)
+        self.assertEqual(self.stop(self.driver_user).status_code, 200)
+        self.assertEqual(self.stop(self.driver_user).status_code, 409)
+
+
+class LocationUpdateTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user, self.driver = create_driver('driver')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def ping(self, location):
+        return self.client.post('/api/rides/drivers/update_location/', {'location': location}, format='json')
+
+    def test_rejects_invalid_coordinates(self):
+        for location in (
+            None,
+            {'latitude': 6.5},
+            {'latitude': 'north', 'longitude': 3.4},
+            {'latitude': 95, 'longitude': 3.4},
+            {'latitude': 6.5, 'longitude': -181},
+            {'latitude': 'NaN', 'longitude': 3.4},
+        ):
+            with self.subTest(location=location):
+                self.assertEqual(self.ping(location).status_code, 400)
+
+    def test_writes_numeric_location(self):
+        with self.settings(LOCATION_FLUSH_INTERVAL_MS=0):
+            registry.reset()
+            response = self.ping({'latitude': '6.6', 'longitude': '3.3'})
+
+        self.assertEqual(response.status_code, 200)
+        self.driver.refresh_from_db()
+        self.assertEqual(self.driver.location, {'latitude': 6.6, 'longitude': 3.3})
+        self.assertEqual(self.driver.region, region_for(self.driver.location))
+
+    def test_flush_skips_bad_entries(self):
+        _, other = create_driver('other')
+        coalescer = LocationCoalescer()
+        # Queued straight into the buffer so no background thread flushes it
+        coalescer.pending = {
+            self.driver.id: {'latitude': 'north', 'longitude': None},
+            other.id: {'latitude': 6.6, 'longitude': 3.3},
+        }
+
+        self.assertEqual(coalescer.flush(), 1)
+        self.driver.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(self.driver.location, {'latitude': 6.5244, 'longitude': 3.3792})
+        self.assertEqual(other.location, {'latitude': 6.6, 'longitude': 3.3})
+
+
+class BenchmarkFlowsTests(OfflineServicesMixin, TransactionTestCase):
+    def benchmark(self, *args):
+        out = io.StringIO()
+        with self.settings(ALLOWED_HOSTS=['localhost']):
+            call_command('benchmark_flows', *args, '--concurrency', '2', stdout=out)
+        return out.getvalue()
+
+    def test_navigation_is_not_throttled(self):
+        output = self.benchmark('navigation', '--requests', '30')
+        throttled = self.benchmark('navigation', '--requests', '30', '--throttled')
+
+        self.assertIn('status codes: {200: 30}', output)
+        self.assertIn('429', throttled)
+
+    def test_match_creates_a_ride_per_request(self):
+        for i in range(3):
+            create_driver(f'driver{i}')
+        create_passenger('bench')
+
+        output = self.benchmark('match', '--requests', '6', '--username', 'bench')
+
+        self.assertIn('status codes: {200: 6}', output)
+        self.assertEqual(Ride.objects.filter(status='CANCELLED').count(), 6)
+        self.assertEqual(Ride.objects.values('passenger').distinct().count(), 2)
+
+
+class AdmissionControlTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        # Pings are written as they arrive, so none is left buffered at exit
+        overrides = self.settings(LOCATION_FLUSH_INTERVAL_MS=0)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        registry.reset()
+        self.users, self.drivers = zip(*(create_driver(f'driver{i}') for i in range(2)))
+        self.passenger_user, self.passenger = create_passenger('rider')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def ping(self, user):
+        return self.client_for(user).post(
+            '/api/rides/drivers/update_location/', {'location': PICKUP}, format='json'
+        )
+
+    def saturate_matching(self):
+        limiter = ConcurrencyLimiter('match', limit=1, queue_timeout=0)
+        self.addCleanup(registry.register, 'match_limiter', registry.factories['match_limiter'])
+        registry.register('match_limiter', lambda registry: limiter)
+        self.assertTrue(limiter.acquire())
+        self.addCleanup(limiter.release)
+
+    def match(self):
+        return self.client_for(self.passenger_user).post('/api/rides/match/', {
+            'passenger_id': self.passenger.id, 'pickup_location': PICKUP, 'destination': DESTINATION
+        }, format='json')
+
+    def test_token_bucket_refills_at_its_rate(self):
+        buckets = TokenBuckets()
+
+        self.assertEqual([buckets.take('key', 1, 2) for _ in range(2)], [0, 0])
+        self.assertGreater(buckets.take('key', 1, 2), 0)
+        self.assertEqual(buckets.take('other', 1, 2), 0)
+
+    def test_empty_bucket_gets_429(self):
+        with self.settings(THROTTLE_BUCKETS={'location': {'rate': 0.01, 'burst': 2}}):
+            statuses = [self.ping(self.users[0]).status_code for _ in range(3)]
+            throttled = self.ping(self.users[0])
+            other = self.ping(self.users[1])
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(throttled.status_code, 429)
+        self.assertGreaterEqual(int(throttled['Retry-After']), 1)
+        self.assertEqual(other.status_code, 200)
+
+    def test_limiter_sheds_beyond_its_limit(self):
+        limiter = ConcurrencyLimiter('test', limit=2, queue_timeout=0)
+
+        self.assertEqual([limiter.acquire() for _ in range(3)], [True, True, False])
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.in_flight, 2)
+
+    def test_saturated_matching_gets_503(self):
+        self.saturate_matching()
+
+        response = self.match()
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(Ride.objects.exists())
+
+    def test_respond_is_never_shed(self):
+        ride, requests = create_pending_ride(self.drivers)
+        self.saturate_matching()
+        buckets = {scope: {'rate': 0.01, 'burst': 0} for scope in ('match', 'location', 'navigation', 'heartbeat', 'nearby')}
+
+        with self.settings(THROTTLE_BUCKETS=buckets):
+            self.assertEqual(self.match().status_code, 429)
+            response = self.client_for(self.users[0]).post(
+                f'/api/rides/ride-requests/{requests[0].id}/respond/', {'status': 'ACCEPTED'}, format='json'
+            )
+
+        self.assertEqual(response.status_code, 200)
+        ride.refresh_from_db()
+        self.assertEqual(ride.status, 'ACCEPTED')
+
+
+class DriverStateSyncTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        overrides = self.settings(DRIVER_STATE_PATH=os.path.join(directory.name, 'drivers.state'))
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        registry.reset()
+        # Connected in ready() only when the table is configured at startup
+        driver_updated.connect(
+            registry.receiver('driver_state', 'on_driver_updated'),
+            weak=False, dispatch_uid='tests.driver_state'
+        )
+        self.addCleanup(driver_updated.disconnect, dispatch_uid='tests.driver_state')
+        self.user, self.driver = create_driver('driver')
+        self.staff = User.objects.create(username='staff', is_staff=True)
+        registry.driver_state.ensure_loaded()
+
+    def candidate_ids(self):
+        shard = registry.region_router.shard(region_for(self.driver.location))
+        return [driver.id for driver in shard.candidates_from_state()]
+
+    def test_update_drops_unavailable_driver(self):
+        self.assertEqual(self.candidate_ids(), [self.driver.id])
+        client = APIClient()
+        client.force_authenticate(self.staff)
+
+        response = client.patch(f'/api/rides/drivers/{self.driver.id}/', {'available': False}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.candidate_ids(), [])
+
+    def test_admin_edit_drops_unavailable_driver(self):
+        self.assertEqual(self.candidate_ids(), [self.driver.id])
+        self.driver.available = False
+
+        DriverAdmin(Driver, admin.site).save_model(None, self.driver, None, change=True)
+
+        self.assertEqual(self.candidate_ids(), [])
+
+
+class RegionShardTests(OfflineServicesMixin, TestCase):
+    def test_candidates_wait_for_driver_updates(self):
+        _, driver = create_driver('driver')
+        shard = registry.region_router.shard(region_for(driver.location))
+        shard.load()
+        found = []
+
+        with shard.lock:
+            reader = threading.Thread(target=lambda: found.extend(shard.candidates()))
+            reader.start()
+            reader.join(0.1)
+            self.assertTrue(reader.is_alive())
+        reader.join(5)
+
+        self.assertEqual([candidate.id for candidate in found], [driver.id])
+
+
+class NearbyJitterTests(TestCase):
+    def shown(self, index, driver):
+        index.on_driver_updated(Driver, driver=driver)
+        cell = index.driver_cells[driver.id]
+        return index.cells[cell][driver.id][2:]
+
+    def test_repeated_updates_show_the_same_position(self):
+        # One period for the whole test
+        index = NearbyIndex(jitter_key='secret', jitter_period=10 ** 9)
+        _, driver = create_driver('driver')
+
+        shown = {self.shown(index, driver) for _ in range(20)}
+
+        self.assertEqual(len(shown), 1)
+        latitude, longitude = shown.pop()
+        self.assertNotEqual((latitude, longitude), (6.5244, 3.3792))
+        self.assertLessEqual(calculate_distance(driver.location, point(latitude, longitude)), 0.151)
+
+    def test_offset_depends_on_driver_and_key(self):
+        _, driver = create_driver('driver')
+        _, other = create_driver('other')
+        index = NearbyIndex(jitter_key='secret')
+
+        self.assertNotEqual(self.shown(index, driver), self.shown(index, other))
+        self.assertNotEqual(self.shown(index, driver), self.shown(NearbyIndex(jitter_key='other'), driver))
+
+
+class SlowMatching:
+    """Stands in for the region router; runs a hook mid-match, then finds no one"""
+
+    def __init__(self, during=None, drivers=()):
+        self.during = during
+        self.drivers = list(drivers)
+
+    def find_best_match(self, passenger, budget_ms=None):
+        if self.during is not None:
+            self.during()
+        return self.drivers
+
+
+class AsyncMatchTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        for i in range(2):
+            create_driver(f'driver{i}')
+        self.user, self.passenger = create_passenger('rider')
+
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+
+    def match(self):
+        return self.client_for(self.user).post('/api/rides/match/', {
+            'passenger_id': self.passenger.id, 'pickup_location': PICKUP, 'destination': DESTINATION, 'run_async': True
+        }, format='json')
+
+    def poll(self, user, job_id):
+        return self.client_for(user).get(f'/api/rides/match/jobs/{job_id}/')
+
+    def test_async_match_queues_a_job(self):
+        response = self.match()
+
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.data['status'], 'QUEUED')
+        self.assertEqual(MatchJob.objects.get().id, response.data['id'])
+        self.assertFalse(Ride.objects.exists())
+
+    def test_one_outstanding_job_per_passenger(self):
+        first = self.match()
+        second = self.match()
+
+        self.assertEqual(second.status_code, 202)
+        self.assertEqual(second.data['id'], first.data['id'])
+        self.assertEqual(MatchJob.objects.count(), 1)
+
+    def test_worker_records_the_ride(self):
+        job_id = self.match().data['id']
+
+        job = registry.match_queue.process(registry.match_queue.claim_next('worker-1'))
+
+        self.assertEqual((job.id, job.status), (job_id, 'COMPLETED'))
+        response = self.poll(self.user, job_id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['ride']['id'], Ride.objects.get().id)
+        self.assertEqual(
+            [request['id'] for request in response.data['ride_requests']],
+            list(RideRequest.objects.filter(ride_id=job.ride_id).values_list('id', flat=True))
+        )
+        self.assertTrue(response.data['ride_requests'])
+
+    def test_only_the_passenger_and_staff_can_poll(self):
+        job_id = self.match().data['id']
+        other, _ = create_passenger('other')
+        staff = User.objects.create(username='ops', is_staff=True)
+
+        self.assertEqual(self.poll(other, job_id).status_code, 403)
+        self.assertEqual(self.poll(staff, job_id).status_code, 200)
+        self.assertEqual(self.poll(self.user, job_id + 1).status_code, 404)
+
+
+class MatchQueueLeaseTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        _, self.driver = create_driver('driver')
+        _, self.passenger = create_passenger('rider')
+
+    def queue(self, **kwargs):
+        return MatchQueue(
+            matching_service=SlowMatching(**kwargs),
+            dispatch_service=registry.dispatch_service,
+            lease=timedelta(seconds=30)
+        )
+
+    def test_only_lapsed_leases_are_requeued(self):
+        queue = self.queue()
+        queue.enqueue(self.passenger, PICKUP, DESTINATION)
+        job = queue.claim_next('worker-1')
+
+        self.assertEqual(queue.requeue_stale(), 0)
+        MatchJob.objects.filter(id=job.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(queue.requeue_stale(), 1)
+        self.assertFalse(queue.renew(job))
+
+    def test_run_that_lost_its_lease_records_nothing(self):
+        queue = self.queue(drivers=[self.driver])
+        queue.enqueue(self.passenger, PICKUP, DESTINATION)
+        stalled = queue.claim_next('worker-1')
+        MatchJob.objects.filter(id=stalled.id).update(lease_expires_at=timezone.now() - timedelta(seconds=1))
+        queue.requeue_stale()
+        current = queue.claim_next('worker-2')
+
+        self.assertEqual(queue.process(stalled).status, 'RUNNING')
+        self.assertFalse(Ride.objects.exists())
+        job = queue.process(current)
+
+        self.assertEqual(job.status, 'COMPLETED')
+        self.assertEqual(Ride.objects.get().id, job.ride_id)
+
+
+class MatchQueueHeartbeatTests(OfflineServicesMixin, TransactionTestCase):
+    def test_running_job_keeps_its_lease(self):
+        _, passenger = create_passenger('rider')
+        requeued = []
+        queue = MatchQueue(
+            matching_service=SlowMatching(during=lambda: (time.sleep(0.5), requeued.append(queue.requeue_stale()))),
+            dispatch_service=registry.dispatch_service,
+            lease=timedelta(seconds=0.3)
+        )
+        queue.enqueue(passenger, PICKUP, DESTINATION)
+
+        job = queue.process(queue.claim_next('worker-1'))
+
+        self.assertEqual(requeued, [0])
+        self.assertEqual(job.status, 'FAILED')
+        self.assertEqual(job.error, 'No suitable drivers found')
+
+
+class TrafficProfileTests(TestCase):
+    def setUp(self):
+        _, self.driver = create_driver('driver')
+        _, self.passenger = create_passenger('rider')
+        self.started = timezone.now() - timedelta(hours=2)
+
+    def completed_ride(self, minutes):
+        return Ride.objects.create(
+            driver=self.driver,
+            passenger=self.passenger,
+            pickup_location=PICKUP,
+            destination=DESTINATION,
+            status='COMPLETED',
+            started_at=self.started,
+            completed_at=self.started + timedelta(minutes=minutes),
+        )
+
+    def test_rebuild_counts_each_ride_once(self):
+        rides = [self.completed_ride(10), self.completed_ride(30)]
+        profile = HistoricalTraffic(min_samples=1)
+
+        self.assertEqual(profile.rebuild(rides), (2, 2))
+        first = list(TrafficProfile.objects.order_by('cell').values_list('cell', 'hour', 'score', 'samples'))
+        self.assertEqual(profile.rebuild(rides), (0, 0))
+
+        rows = list(TrafficProfile.objects.order_by('cell').values_list('cell', 'hour', 'score', 'samples'))
+        self.assertEqual(rows, first)
+        self.assertEqual({(hour, samples) for _, hour, _, samples in rows}, {(hour_of_week(self.started), 2)})
+        scores = [profile.ride_score(ride) for ride in rides]
+        self.assertAlmostEqual(rows[0][2], sum(scores) / 2)
+        self.assertEqual(Ride.objects.filter(traffic_counted=True).count(), 2)
+
+    def test_rebuild_keeps_sampled_answers(self):
+        profile = HistoricalTraffic()
+        hour = hour_of_week(self.started)
+        profile.pending = {(profile.cell(PICKUP), hour): [2.7, 3]}
+        profile.flush()
+        ride = self.completed_ride(20)
+
+        self.assertEqual(profile.rebuild([ride]), (1, 2))
+
+        row = TrafficProfile.objects.get(cell=profile.cell(PICKUP))
+        self.assertEqual(row.samples, 4)
+        self.assertAlmostEqual(row.score, (2.7 + profile.ride_score(ride)) / 4)
+
+    def test_observed_rides_are_not_rebuilt_again(self):
+        profile = HistoricalTraffic()
+        ride = self.completed_ride(20)
+        profile.pending_rides = {ride.id: (profile.ride_keys(ride), profile.ride_score(ride))}
+
+        self.assertEqual(profile.flush(), 2)
+        self.assertEqual(profile.rebuild([ride]), (0, 0))
+        self.assertEqual(set(TrafficProfile.objects.values_list('samples', flat=True)), {1})
+
+    def test_flush_merges_samples(self):
+        profile = HistoricalTraffic(max_samples=3)
+        hour = hour_of_week(timezone.now())
+        TrafficProfile.objects.create(cell=profile.cell(PICKUP), hour=hour, score=0.5, samples=2)
+        profile.pending = {(profile.cell(PICKUP), hour): [2.0, 2]}
+
+        self.assertEqual(profile.flush(), 1)
+
+        row = TrafficProfile.objects.get()
+        self.assertAlmostEqual(row.score, 0.75)
+        self.assertEqual(row.samples, 3)
+        self.assertEqual(profile.scores[(row.cell, hour)], (row.score, 3))
+
+
+class RacingTraffic(HistoricalTraffic):
+    """Its first read misses the rows, as if another writer inserted them just after"""
+
+    raced = False
+
+    def locked_rows(self, keys):
+        rows = super().locked_rows(keys)
+        if not self.raced:
+            self.raced = True
+            return {}
+        return rows
+
+
+class TrafficProfileConflictTests(TestCase):
+    def test_concurrent_insert_is_merged(self):
+        profile = RacingTraffic()
+        key = (profile.cell(PICKUP), hour_of_week(timezone.now()))
+        TrafficProfile.objects.create(cell=key[0], hour=key[1], score=0.2, samples=1)
+        profile.pending = {key: [1.6, 2]}
+
+        self.assertEqual(profile.flush(), 1)
+
+        self.assertTrue(profile.raced)
+        row = TrafficProfile.objects.get()
+        self.assertEqual(row.samples, 3)
+        self.assertAlmostEqual(row.score, (0.2 + 1.6) / 3)
+        self.assertEqual(profile.pending, {})
+
+
+class TrafficProfileRefreshTests(TransactionTestCase):
+    def test_lookups_never_query(self):
+        hour = hour_of_week(timezone.now())
+        # Refreshed once; the thread then sleeps past the end of the test run
+        profile = HistoricalTraffic(refresh_interval=3600, sample_rate=1, min_samples=1)
+        TrafficProfile.objects.create(cell=profile.cell(PICKUP), hour=hour, score=0.4, samples=5)
+
+        with self.assertNumQueries(0):
+            profile.lookup(PICKUP, PICKUP)
+            profile.record(PICKUP, DESTINATION, 0.9)
+        deadline = time.monotonic() + 5
+        while profile.loaded_until is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        self.assertEqual(profile.thread.name, 'traffic-profile')
+        # The sample recorded above was written before the rows were loaded
+        self.assertAlmostEqual(profile.lookup(PICKUP, PICKUP), (0.4 * 5 + 0.9) / 6)
+        self.assertEqual(TrafficProfile.objects.count(), 2)
+        self.assertEqual(profile.pending, {})
+
+
+class DriverStateTableTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'drivers.state')
+
+    def table(self, capacity=4):
+        table = DriverStateTable(self.path, capacity)
+        self.addCleanup(table.close)
+        return table
+
+    def test_writes_are_shared_between_mappings(self):
+        writer, reader = self.table(), self.table()
+        writer.write(Driver(id=7, location=point(6.5, 3.4), available=True), last_seen=100)
+
+        state = reader.get(7)
+        self.assertEqual((state.latitude, state.longitude, state.last_seen, state.available), (6.5, 3.4, 100, True))
+
+        writer.write(Driver(id=7, location=point(6.6, 3.4), available=False))
+        self.assertEqual(reader.count, 1)
+        self.assertEqual(reader.get(7).latitude, 6.6)
+        self.assertEqual(reader.available_in(6, 7, 3, 4), [])
+
+    def test_available_in_bounding_box(self):
+        table = self.table()
+        table.write(Driver(id=1, location=point(6.5, 3.4), available=True))
+        table.write(Driver(id=2, location=point(7.5, 3.4), available=True))
+        table.write(Driver(id=3, location=None, available=True))
+
+        self.assertEqual([state.driver_id for state in table.available_in(6, 7, 3, 4)], [1])
+
+    def test_full_table_drops_new_drivers(self):
+        table = self.table(capacity=1)
+        table.write(Driver(id=1, location=point(6.5, 3.4), available=True))
+        table.write(Driver(id=2, location=point(6.5, 3.4), available=True))
+
+        self.assertEqual(table.count, 1)
+        self.assertIsNone(table.get(2))
+
+    def test_snapshot_round_trip(self):
+        table = self.table()
+        table.write(Driver(id=1, location=point(6.5, 3.4), available=True))
+        snapshot = f'{self.path}.snapshot'
+        table.snapshot(snapshot)
+        table.write(Driver(id=2, location=point(6.5, 3.4), available=True))
+
+        table.restore(snapshot)
+
+        self.assertEqual([state.driver_id for state in table], [1])
+        with self.assertRaises(ValueError):
+            self.table(capacity=8).restore(snapshot)
+
+
+ROAD_NETWORK = """<?xml version="1.0" encoding="UTF-8"?>
+<osm version="0.6">
+  <node id="1" lat="6.50" lon="3.35"/>
+  <node id="2" lat="6.51" lon="3.35"/>
+  <node id="3" lat="6.52" lon="3.35"/>
+  <node id="4" lat="6.51" lon="3.36"/>
+  <way id="10"><nd ref="1"/><nd ref="2"/><nd ref="3"/><tag k="highway" v="primary"/></way>
+  <way id="11"><nd ref="2"/><nd ref="4"/><tag k="highway" v="residential"/><tag k="oneway" v="yes"/></way>
+  <way id="12"><nd ref="1"/><nd ref="3"/><tag k="highway" v="footway"/></way>
+</osm>
+"""
+
+
+class LocalRoutingTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        osm_path = os.path.join(directory.name, 'map.osm')
+        with open(osm_path, 'w') as osm:
+            osm.write(ROAD_NETWORK)
+        graph_path = os.path.join(directory.name, 'roads.graph')
+        self.assertEqual(build_road_graph(osm_path, graph_path, landmark_count=2), (4, 5))
+        self.backend = LocalRoutingBackend(graph_path)
+
+    def test_route_follows_the_road(self):
+        route = self.backend.get_optimal_route(point(6.50, 3.35), point(6.52, 3.35))
+
+        leg = route[0]['legs'][0]
+        length = calculate_distance(point(6.50, 3.35), point(6.52, 3.35)) * 1000
+        self.assertAlmostEqual(leg['distance']['value'], length, delta=2)
+        # Primary roads are driven at 60 km/h
+        self.assertAlmostEqual(leg['duration']['value'], length / (60 / 3.6), delta=2)
+        self.assertEqual(route[0]['waypoint_order'], [])
+
+    def test_one_way_streets(self):
+        self.assertTrue(self.backend.get_optimal_route(point(6.50, 3.35), point(6.51, 3.36)))
+        self.assertEqual(self.backend.get_optimal_route(point(6.51, 3.36), point(6.50, 3.35)), [])
+
+    def test_travel_times_to_one_target(self):
+        times = self.backend.travel_times_to(point(6.52, 3.35), [point(6.50, 3.35), point(6.51, 3.36)])
+
+        self.assertIsNone(times[1])
+        route = self.backend.get_optimal_route(point(6.50, 3.35), point(6.52, 3.35))
+        self.assertAlmostEqual(times[0][0], route[0]['legs'][0]['duration']['value'], delta=1)
+
+
+class SimulationBackendTests(TestCase):
+    def test_answers_depend_only_on_seed_and_query(self):
+        first = SimulatedDirectionsBackend(SimulationModel(seed=7, hour=12))
+        second = SimulatedDirectionsBackend(SimulationModel(seed=7, hour=12))
+
+        self.assertEqual(
+            first.get_optimal_route(PICKUP, DESTINATION, [point(6.50, 3.39)]),
+            second.get_optimal_route(PICKUP, DESTINATION, [point(6.50, 3.39)])
+        )
+        self.assertEqual(len(first.get_optimal_route(PICKUP, DESTINATION, [point(6.50, 3.39)])[0]['legs']), 2)
+        self.assertEqual(
+            SimulatedTrafficBackend(SimulationModel(seed=7, hour=12)).get_traffic_conditions(PICKUP, DESTINATION),
+            SimulatedTrafficBackend(SimulationModel(seed=7, hour=12)).get_traffic_conditions(PICKUP, DESTINATION)
+        )
+
+    def test_rush_hour_is_slower(self):
+        rush = SimulatedTrafficBackend(SimulationModel(hour=18)).get_traffic_conditions(PICKUP, DESTINATION)
+        night = SimulatedTrafficBackend(SimulationModel(hour=3)).get_traffic_conditions(PICKUP, DESTINATION)
+
+        self.assertLess(rush, night)
+        self.assertTrue(0 < rush <= 1)
+
+    def test_injected_failures(self):
+        backend = SimulatedTrafficBackend(SimulationModel(failure_rate=1))
+
+        with self.assertRaises(SimulatedUpstreamError):
+            backend.get_traffic_conditions(PICKUP, DESTINATION)
+
+
+class ResilienceTests(TestCase):
+    def test_breaker_opens_and_recovers(self):
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertFalse(breaker.allow())
+
+        time.sleep(0.06)
+        # Half-open: one trial call at a time
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_timeouts_and_errors_fall_back(self):
+        caller = ResilientCaller('test', timeout=0.05, breaker_failures=2)
+        released = threading.Event()
+        self.addCleanup(released.set)
+
+        def fail():
+            raise RuntimeError('upstream down')
+
+        self.assertEqual(caller.call(released.wait, fallback=lambda: 'timeout'), 'timeout')
+        self.assertEqual(caller.call(fail, fallback=lambda: 'error'), 'error')
+        # The breaker is open now, so the call is not even made
+        self.assertEqual(caller.call(lambda: 'answer', fallback=lambda: 'open'), 'open')
+
+    def test_slow_call_is_hedged(self):
+        caller = ResilientCaller('test', timeout=1, hedge_percentile=0.5, hedge_min_samples=1)
+        caller.latency.record(0.01)
+        released = threading.Event()
+        self.addCleanup(released.set)
+        calls = []
+
+        def answer():
+            calls.append(None)
+            if len(calls) == 1:
+                released.wait()
+                return 'first'
+            return 'hedge'
+
+        self.assertEqual(caller.call(answer, fallback=lambda: 'fallback'), 'hedge')
+        self.assertEqual(len(calls), 2)
+
+
+class ScriptedAdapter(BaseAdapter):
+    """Answers each request with the next status code in turn, without any network"""
+
+    def __init__(self, statuses):
+        super().__init__()
+        self.statuses = list(statuses)
+        self.sent = 0
+
+    def send(self, request, **kwargs):
+        self.sent += 1
+        response = requests.Response()
+        response.status_code = self.statuses.pop(0)
+        response.request = request
+        response.url = request.url
+        return response
+
+    def close(self):
+        pass
+
+
+class PooledSessionTests(TestCase):
+    def session(self, statuses, **kwargs):
+        session = PooledSession(**kwargs)
+        adapter = ScriptedAdapter(statuses)
+        session.mount('https://maps.test/', adapter)
+        return session, adapter
+
+    def test_idempotent_requests_are_retried(self):
+        session, adapter = self.session([503, 200])
+
+        self.assertEqual(session.get('https://maps.test/directions').status_code, 200)
+        self.assertEqual(adapter.sent, 2)
+
+    def test_other_requests_are_not_retried(self):
+        session, adapter = self.session([503, 200])
+
+        self.assertEqual(session.post('https://maps.test/directions').status_code, 503)
+        self.assertEqual(adapter.sent, 1)
+
+    def test_retry_budget(self):
+        budget = RetryBudget(ratio=0.5, min_retries=1)
+        budget.record_request()
+        budget.record_request()
+
+        self.assertTrue(budget.try_retry())
+        self.assertTrue(budget.try_retry())
+        self.assertFalse(budget.try_retry())
+
+    def test_per_host_limit(self):
+        session, adapter = self.session([200], per_host_limit=1, acquire_timeout=0.01)
+        session._limit('maps.test').acquire()
+
+        with self.assertRaises(requests.ConnectionError):
+            session.get('https://maps.test/directions')
+        self.assertEqual(adapter.sent, 0)
+
+
+class StubTraffic:
+    """Traffic service whose live answers wait for released (or come at once without one)"""
+
+    def __init__(self, released=None):
+        self.released = released
+
+    def get_traffic_conditions(self, origin, destination):
+        if self.released is not None:
+            self.released.wait()
+        return 1.0
+
+    def known_traffic_conditions(self, origin, destination):
+        return None
+
+    def fallback_traffic_conditions(self, origin, destination):
+        return 0.5
+
+
+class MatchingBudgetTests(TestCase):
+    def setUp(self):
+        self.drivers = [
+            create_driver(f'driver{i}', point(6.5244 + i * 0.01, 3.3792))[1] for i in range(4)
+        ]
+        _, self.passenger = create_passenger('rider')
+        self.passenger.pickup_location = PICKUP
+
+    def test_nearest_driver_ranks_first(self):
+        result = MatchingService(StubTraffic()).find_best_match(self.passenger)
+
+        self.assertTrue(result.complete)
+        self.assertEqual(result[0].id, self.drivers[0].id)
+        self.assertEqual(result.scored, 4)
+        self.assertEqual(result.traffic_fallbacks, 0)
+
+    def test_slow_traffic_falls_back_within_budget(self):
+        released = threading.Event()
+        self.addCleanup(released.set)
+        service = MatchingService(StubTraffic(released), traffic_wait_ms=20)
+
+        result = service.find_best_match(self.passenger, budget_ms=500)
+
+        self.assertTrue(result.complete)
+        self.assertEqual(result.traffic_fallbacks, 4)
+        self.assertLess(result.elapsed_ms, 500)
+
+    def test_spent_budget_returns_partial_result(self):
+        result = MatchingService(StubTraffic()).find_best_match(self.passenger, budget_ms=0)
+
+        self.assertFalse(result.complete)
+        self.assertEqual((result.candidates, result.scored), (4, 0))
+
+
+class ServiceRegistryTests(TestCase):
+    def setUp(self):
+        self.services = ServiceRegistry()
+        self.built = []
+
+        def clock(registry):
+            self.built.append('clock')
+            return object()
+
+        def disabled(registry):
+            self.built.append('disabled')
+            return None
+
+        self.services.register('clock', clock)
+        self.services.register('disabled', disabled)
+        self.services.register('watch', lambda registry: ('watch', registry.clock))
+
+    def test_services_are_built_once_on_first_use(self):
+        self.assertEqual(self.built, [])
+
+        watch = self.services.watch
+        self.assertIs(watch[1], self.services.clock)
+        self.assertIsNone(self.services.disabled)
+        self.assertIsNone(self.services.disabled)
+        self.assertEqual(self.built, ['clock', 'disabled'])
+
+        self.services.reset('clock')
+        self.assertIsNot(self.services.clock, watch[1])
+        with self.assertRaises(AttributeError):
+            self.services.missing
+
+    def test_lazy_receivers_wait_for_the_service(self):
+        calls = []
+        self.services.register('cache', lambda registry: type('Cache', (), {
+            'on_change': lambda self, sender, **kwargs: calls.append(kwargs)
+        })())
+        receive = self.services.receiver('cache', 'on_change', build=False)
+
+        receive(None, value=1)
+        self.assertFalse(self.services.is_built('cache'))
+        self.services.cache
+        receive(None, value=2)
+
+        self.assertEqual(calls, [{'value': 2}])
+
+    def test_warm_up_survives_failing_hooks(self):
+        hooks = []
+
+        @self.services.on_warm_up
+        def failing(registry):
+            raise RuntimeError('unavailable')
+
+        self.services.on_warm_up(lambda registry: hooks.append(registry.is_built('watch')))
+        self.services.warm_up(['watch'])
+
+        self.assertEqual(hooks, [True])
+        self.assertEqual(self.built, ['clock'])
+
+
+class OpenAPIDocumentTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'openapi.json')
+        overrides = self.settings(OPENAPI_SCHEMA_PATH=self.path)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        api_docs._document = None
+        self.addCleanup(setattr, api_docs, '_document', None)
+
+    def test_generated_once_and_revalidated_by_etag(self):
+        call_command('generate_openapi_schema', stdout=io.StringIO())
+        with open(self.path, 'rb') as f:
+            stored = f.read()
+
+        response = self.client.get('/openapi.json')
+        self.assertEqual(response.content, stored)
+        self.assertIn('/match/', json.loads(stored)['paths'])
+        self.assertEqual(self.client.get('/openapi.json', HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+
+        compressed = self.client.get('/openapi.json', HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(compressed['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.content), stored)
+
+    def test_stored_document_is_served_as_is(self):
+        with open(self.path, 'wb') as f:
+            f.write(b'{"openapi": "stored"}')
+
+        self.assertEqual(self.client.get('/openapi.json').content, b'{"openapi": "stored"}')
+        self.assertEqual(self.client.get('/swagger/?format=openapi').content, b'{"openapi": "stored"}')
+
+
+class PreferenceTests(TestCase):
+    def test_encode_and_decode(self):
+        mask, known = preferences.encode({'music': True, 'smoking': False, 'karaoke': True})
+
+        self.assertEqual(mask, preferences.BITS['music'])
+        self.assertEqual(known, preferences.BITS['music'] | preferences.BITS['smoking'])
+        self.assertEqual(preferences.decode(mask, known), {'smoking': False, 'music': True})
+
+    def test_hard_requirements(self):
+        passenger, _ = preferences.encode({'pets': True, 'music': True})
+        required = preferences.required_mask(passenger)
+
+        self.assertEqual(required, preferences.BITS['pets'])
+        self.assertTrue(preferences.compatible(preferences.encode({'pets': True})[0], required))
+        self.assertFalse(preferences.compatible(preferences.encode({'music': True})[0], required))
+
+    def test_batch_scores_match_single_scores(self):
+        passenger = preferences.encode({'music': True, 'quiet': False, 'luggage': True})
+        drivers = [
+            preferences.encode(prefs) for prefs in (
+                {}, {'music': True}, {'music': False, 'quiet': False}, {'music': True, 'quiet': False, 'luggage': True}
+            )
+        ]
+
+        batch = preferences.scores([mask for mask, _ in drivers], [known for _, known in drivers], *passenger)
+
+        self.assertEqual(batch, [preferences.score(*driver, *passenger) for driver in drivers])
+        self.assertEqual(batch, [0, 1 / 3, 1 / 3, 1])
+
+    def test_models_store_masks(self):
+        _, driver = create_driver('driver')
+        driver.preferences = {'pets': True}
+        driver.save(update_fields=['preferences'])
+        driver.refresh_from_db()
+
+        self.assertEqual((driver.preference_mask, driver.preference_known), preferences.encode({'pets': True}))
+
+    def test_buckets_visit_compatible_masks(self):
+        buckets = preferences.PreferenceBuckets()
+        pets = preferences.BITS['pets']
+        buckets.add(1, pets, 'with pets')
+        buckets.add(2, 0, 'plain')
+        buckets.add(3, pets, 'moved')
+        buckets.add(3, 0, 'moved')
+        buckets.remove(2)
+
+        self.assertEqual(list(buckets.compatible(pets)), ['with pets'])
+        self.assertEqual(sorted(buckets.compatible()), ['moved', 'with pets'])
+        self.assertEqual(len(buckets), 2)
+
+
+class CandidateCacheTests(TestCase):
+    def setUp(self):
+        self.cache = CandidateCache(ttl=60)
+        self.near = Driver(id=1, location=PICKUP)
+        self.ranking = [(self.near, 0.0)]
+        self.cache.put(PICKUP, 0, self.ranking)
+
+    def test_hit_per_cell_and_requirements(self):
+        self.assertIs(self.cache.get(point(6.52441, 3.37921)), self.ranking)
+        self.assertIsNone(self.cache.get(PICKUP, preferences.BITS['pets']))
+        self.assertIsNone(self.cache.get(DESTINATION))
+
+    def test_ranked_driver_invalidates(self):
+        self.cache.on_ride_accepted(Ride, ride=None, driver=self.near)
+
+        self.assertIsNone(self.cache.get(PICKUP))
+
+    def test_driver_moving_nearby_invalidates(self):
+        far = Driver(id=2, location=DESTINATION)
+        self.cache.on_driver_updated(Driver, driver=far, previous_location=DESTINATION)
+        self.assertIs(self.cache.get(PICKUP), self.ranking)
+
+        moved = Driver(id=2, location=point(6.5245, 3.3793))
+        self.cache.on_driver_updated(Driver, driver=moved, previous_location=DESTINATION)
+        self.assertIsNone(self.cache.get(PICKUP))
+
+    def test_expiry_and_size_bound(self):
+        cache = CandidateCache(ttl=-1)
+        cache.put(PICKUP, 0, self.ranking)
+        self.assertIsNone(cache.get(PICKUP))
+
+        cache = CandidateCache(ttl=60, max_entries=1)
+        cache.put(PICKUP, 0, self.ranking)
+        cache.put(DESTINATION, 0, [])
+        self.assertIsNone(cache.get(PICKUP))
+        self.assertEqual(cache.get(DESTINATION), [])
+        self.assertEqual(cache.by_driver, {})
+
+
+class IdempotentMatchTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        caches['idempotency'].clear()
+        self.addCleanup(caches['idempotency'].clear)
+        for i in range(2):
+            create_driver(f'driver{i}')
+        self.user, self.passenger = create_passenger('rider')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+        self.body = {'passenger_id': self.passenger.id, 'pickup_location': PICKUP, 'destination': DESTINATION}
+
+    def match(self, body=None, key=None):
+        headers = {'HTTP_IDEMPOTENCY_KEY': key} if key else {}
+        return self.client.post('/api/rides/match/', body or self.body, format='json', **headers)
+
+    def test_retry_replays_the_first_response(self):
+        first = self.match(key='retry-1')
+        second = self.match(key='retry-1')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(second.data['ride']['id'], first.data['ride']['id'])
+        self.assertEqual(Ride.objects.count(), 1)
+
+    def test_key_reused_for_another_request(self):
+        self.match(key='retry-1')
+
+        response = self.match({**self.body, 'destination': point(6.60, 3.35)}, key='retry-1')
+
+        self.assertEqual(response.status_code, 422)
+
+    def test_key_still_in_progress(self):
+        store = registry.idempotency_store
+        store.begin(f'match:{self.user.pk}', 'retry-1', store.fingerprint(self.body))
+
+        response = self.match(key='retry-1')
+
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertFalse(Ride.objects.exists())
+
+    def test_open_ride_is_returned_without_a_key(self):
+        first = self.match()
+        second = self.match()
+
+        self.assertTrue(second.data['existing'])
+        self.assertEqual(second.data['ride']['id'], first.data['ride']['id'])
+        self.assertEqual(Ride.objects.count(), 1)
+
+
+class RematchTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.users, self.drivers = zip(*(
+            create_driver(f'driver{i}', point(6.5244 + i * 0.001, 3.3792)) for i in range(6)
+        ))
+        _, self.passenger = create_passenger('rider')
+        self.dispatch = DispatchService(max_requests=1)
+
+    def test_rematch_skips_drivers_that_can_no_longer_take_the_ride(self):
+        ride, requests = self.dispatch.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers)
+        Driver.objects.filter(id=self.drivers[1].id).update(available=False)
+        create_pending_ride([self.drivers[2]])
+        Ride.objects.filter(driver=self.drivers[2]).exclude(id=ride.id).update(status='ACCEPTED')
+        Driver.objects.filter(id=self.drivers[3].id).update(location=point(6.60, 3.3792))
+        RideRequest.objects.filter(id=requests[0].id).update(status='REJECTED')
+
+        next_requests = self.dispatch.advance(ride)
+
+        self.assertEqual([request.driver_id for request in next_requests], [self.drivers[4].id])
+        ride.refresh_from_db()
+        self.assertEqual((ride.wave, ride.offered), (2, 5))
+
+    def test_last_rejection_reports_the_rematch(self):
+        ride, requests = registry.dispatch_service.create_ride(self.passenger, PICKUP, DESTINATION, self.drivers[:5])
+        self.assertEqual(len(requests), 3)
+
+        for request in requests:
+            client = APIClient()
+            client.force_authenticate(self.users[self.drivers.index(request.driver)])
+            response = client.post(f'/api/rides/ride-requests/{request.id}/respond/', {'status': 'REJECTED'}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['rematch']['wave'], 2)
+        self.assertEqual(response.data['rematch']['drivers'], [self.drivers[3].id, self.drivers[4].id])
+
+
+class PresenceTests(TestCase):
+    def setUp(self):
+        # The flush thread started by beat() sleeps past the end of the test run
+        self.presence = PresenceTracker(ttl=60, interval=3600)
+        _, self.silent = create_driver('silent')
+        _, self.active = create_driver('active')
+        _, self.untracked = create_driver('untracked')
+        now = time.time()
+        self.presence.beat(self.silent.id, at=now - 120)
+        self.presence.beat(self.active.id, at=now - 120)
+        self.assertEqual(self.presence.flush(), 2)
+        self.presence.beat(self.active.id, at=now)
+
+    def test_is_present_within_ttl(self):
+        self.assertFalse(self.presence.is_present(self.silent))
+        self.assertTrue(self.presence.is_present(self.active))
+        self.assertTrue(self.presence.is_present(self.untracked))
+
+    def test_sweep_takes_silent_drivers_offline(self):
+        updates = []
+        receiver = lambda sender, driver, **kwargs: updates.append((driver.id, driver.available))
+        driver_updated.connect(receiver, dispatch_uid='tests.presence')
+        self.addCleanup(driver_updated.disconnect, dispatch_uid='tests.presence')
+
+        self.assertEqual(self.presence.sweep(), [self.silent.id])
+
+        self.assertEqual(updates, [(self.silent.id, False)])
+        self.assertEqual(
+            set(Driver.objects.filter(available=True).values_list('id', flat=True)),
+            {self.active.id, self.untracked.id}
+        )
+
+
+class NearbyIndexTests(TestCase):
+    def setUp(self):
+        self.index = NearbyIndex(jitter_m=0, cache_ttl=60)
+        _, self.driver = create_driver('driver0', location=PICKUP)
+        create_driver('driver1', location=point(6.5250, 3.3800))
+        create_driver('driver2', location=point(6.60, 3.45))
+
+    def test_close_up_returns_positions(self):
+        response = self.index.nearby(6.5244, 3.3792, 2)
+
+        self.assertEqual(response['mode'], 'drivers')
+        self.assertEqual(
+            sorted((driver['latitude'], driver['longitude']) for driver in response['drivers']),
+            [(6.5244, 3.3792), (6.525, 3.38)]
+        )
+
+    def test_wide_view_returns_counts(self):
+        response = self.index.nearby(6.5244, 3.3792, 15)
+
+        self.assertEqual(response['mode'], 'cells')
+        self.assertEqual(sorted(cell['count'] for cell in response['cells']), [1, 2])
+
+    def test_answers_are_cached_per_cell(self):
+        first = self.index.nearby(6.5244, 3.3792, 1)
+        self.driver.available = False
+        self.index.on_driver_updated(Driver, driver=self.driver)
+
+        self.assertIs(self.index.nearby(6.5201, 3.3710, 1), first)
+        self.assertEqual(len(self.index.nearby(6.5244, 3.3792, 2)['drivers']), 1)
+
+
+class NearbyEndpointTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='rider'))
+        create_driver('driver0')
+
+    def test_nearby_drivers(self):
+        response = self.client.get('/api/rides/drivers/nearby/', {'lat': 6.5244, 'lng': 3.3792})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['mode'], 'drivers')
+        self.assertEqual(len(response.data['drivers']), 1)
+
+    def test_invalid_query(self):
+        self.assertEqual(self.client.get('/api/rides/drivers/nearby/', {'lat': 6.5}).status_code, 400)
+        self.assertEqual(
+            self.client.get('/api/rides/drivers/nearby/', {'lat': 6.5, 'lng': 3.3, 'radius': 0}).status_code, 400
+        )
+
+
+def square(name, kind, south, west, north, east):
+    return Zone.objects.create(name=name, kind=kind, polygon=[
+        point(south, west), point(south, east), point(north, east), point(north, west)
+    ])
+
+
+class ZoneIndexTests(TestCase):
+    def setUp(self):
+        self.airport = square('Airport', Zone.AIRPORT_QUEUE, 6.50, 3.35, 6.55, 3.40)
+        self.index = ZoneIndex(cell_degrees=0.01)
+
+    def test_points_inside_and_on_the_edge(self):
+        self.assertEqual(self.index.zones_at(PICKUP), {self.airport.id})
+        self.assertEqual(self.index.zones_at(point(6.5244, 3.3995)), {self.airport.id})
+        self.assertEqual(self.index.zones_at(point(6.5244, 3.4005)), set())
+        self.assertEqual(self.index.zones_at(DESTINATION), set())
+        self.assertEqual(self.index.zones_at(None), set())
+
+    def test_driver_zones_follow_the_driver(self):
+        _, driver = create_driver('queued', location=PICKUP)
+        self.assertEqual(self.index.driver_zones(driver), {self.airport.id})
+
+        driver.location = DESTINATION
+        self.assertEqual(self.index.driver_zones(driver), set())
+
+    def test_airport_queue_serves_only_its_airport(self):
+        queue = self.index.zones_at(PICKUP)
+        outside = self.index.zones_at(DESTINATION)
+
+        self.assertTrue(self.index.can_serve(queue, queue))
+        self.assertTrue(self.index.has_priority(queue, queue))
+        self.assertFalse(self.index.can_serve(queue, outside))
+        self.assertTrue(self.index.can_serve(outside, queue))
+        self.assertFalse(self.index.has_priority(outside, queue))
+
+    def test_zone_changes_reload_the_index(self):
+        self.index.ensure_loaded()
+        self.airport.active = False
+        self.airport.save()
+        self.index.on_zones_changed(Zone)
+
+        self.assertEqual(self.index.zones_at(PICKUP), set())
+
+
+class NoPickupZoneTests(OfflineServicesMixin, TestCase):
+    def test_match_refuses_pickups_in_a_no_pickup_zone(self):
+        square('Terminal kerb', Zone.NO_PICKUP, 6.52, 3.37, 6.53, 3.38)
+        create_driver('driver0')
+        user, passenger = create_passenger('rider')
+        client = APIClient()
+        client.force_authenticate(user)
+
+        response = client.post('/api/rides/match/', {
+            'passenger_id': passenger.id, 'pickup_location': PICKUP, 'destination': DESTINATION
+        }, format='json')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.data['error'], 'Pickups are not allowed in Terminal kerb')
+        self.assertFalse(Ride.objects.exists())
+
+
+class HeatmapTests(TestCase):
+    def setUp(self):
+        self.heatmap = Heatmap(precision=6, half_lives={'5m': 300})
+        self.heatmap.resync()
+        self.pickup = self.heatmap.cell(PICKUP)
+
+    def cells(self):
+        return {cell['cell']: cell for cell in self.heatmap.snapshot()['cells']}
+
+    def test_drivers_follow_location_and_availability(self):
+        _, driver = create_driver('driver0', location=PICKUP)
+        self.heatmap.on_driver_updated(Driver, driver=driver)
+        self.assertEqual(self.cells()[self.pickup]['drivers'], 1)
+
+        driver.location = DESTINATION
+        self.heatmap.on_driver_updated(Driver, driver=driver)
+        self.assertNotIn(self.pickup, self.cells())
+        self.assertEqual(self.cells()[self.heatmap.cell(DESTINATION)]['drivers'], 1)
+
+        driver.available = False
+        self.heatmap.on_driver_updated(Driver, driver=driver)
+        self.assertEqual(self.cells(), {})
+
+    def test_open_rides_and_requests(self):
+        _, driver = create_driver('driver0')
+        ride, _ = create_pending_ride([driver])
+        self.heatmap.on_ride_status_changed(Ride, ride=ride)
+
+        cell = self.cells()[self.pickup]
+        self.assertEqual(cell['open_rides'], 1)
+        self.assertEqual(cell['requests']['5m'], 1)
+        self.assertEqual(cell['demand_ratio'], 1)
+
+        ride.status = 'ACCEPTED'
+        self.heatmap.on_ride_status_changed(Ride, ride=ride, previous_status='PENDING')
+        cell = self.cells()[self.pickup]
+        self.assertEqual(cell['open_rides'], 0)
+        self.assertEqual(cell['requests']['5m'], 1)
+
+    def test_requests_decay_by_half_life(self):
+        now = time.time()
+        self.heatmap.record_request(self.pickup, now=now - 600)
+        self.heatmap.record_request(self.pickup, now=now - 300)
+
+        self.assertAlmostEqual(self.cells()[self.pickup]['requests']['5m'], 0.75, places=2)
+
+        self.heatmap.requests[self.pickup]['5m'] = [1.0, now - 3600]
+        self.assertEqual(self.cells(), {})
+
+    def test_resync_recounts_from_the_database(self):
+        _, driver = create_driver('driver0')
+        create_pending_ride([driver])
+
+        self.heatmap.resync()
+
+        cell = self.cells()[self.pickup]
+        self.assertEqual((cell['drivers'], cell['open_rides']), (1, 1))
+
+
+class HeatmapEndpointTests(OfflineServicesMixin, TestCase):
+    def test_staff_only(self):
+        client = APIClient()
+        client.force_authenticate(User.objects.create(username='rider'))
+        self.assertEqual(client.get('/api/rides/heatmap/').status_code, 403)
+
+        client.force_authenticate(User.objects.create(username='ops', is_staff=True))
+        create_driver('driver0')
+        response = client.get('/api/rides/heatmap/')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([cell['drivers'] for cell in response.data['cells']], [1])
+
+
+class GridMatrixBackend:
+    """One minute and one kilometre per 0.01 degrees of latitude; no route north of 6.6"""
+
+    max_origins = 2
+    max_destinations = 2
+    max_elements = 4
+
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.requests = []
+
+    def travel_times(self, origins, destinations):
+        self.requests.append((len(origins), len(destinations)))
+        if self.fail:
+            raise SimulatedUpstreamError('matrix unavailable')
+        return [
+            [
+                None if destination['latitude'] > 6.6
+                else (abs(destination['latitude'] - origin['latitude']) * 6000, abs(destination['latitude'] - origin['latitude']) * 100000)
+                for destination in destinations
+            ]
+            for origin in origins
+        ]
+
+
+class TravelTimeMatrixTests(TestCase):
+    def setUp(self):
+        self.backend = GridMatrixBackend()
+        self.matrix = TravelTimeMatrix(backend=self.backend, cell_degrees=0.002)
+        self.origins = [point(6.50, 3.38), point(6.51, 3.38), point(6.52, 3.38)]
+        self.destinations = [point(6.551, 3.381), point(6.5515, 3.3815), point(6.70, 3.38)]
+
+    def rows(self, mode=TravelTimeMatrix.LIVE):
+        return dict(self.matrix.rows(self.origins, self.destinations, mode))
+
+    def test_requests_stay_within_the_backend_limits(self):
+        rows = self.rows()
+
+        # Two destinations share a cell, so 3 origins x 2 destinations take two requests
+        self.assertEqual(self.backend.requests, [(2, 2), (1, 2)])
+        self.assertEqual(rows[0][0], {'status': 'OK', 'duration': 306, 'distance': 5100, 'source': 'live'})
+        self.assertEqual(rows[0][1], rows[0][0])
+        self.assertEqual(rows[2][2], {'status': 'ZERO_RESULTS', 'source': 'live'})
+
+    def test_answers_are_cached_per_cell_pair(self):
+        self.rows()
+        rows = self.rows()
+
+        self.assertEqual(len(self.backend.requests), 2)
+        self.assertEqual({element['source'] for row in rows.values() for element in row}, {'cache'})
+
+    def test_failed_requests_fall_back_to_estimates(self):
+        self.backend.fail = True
+        rows = self.rows()
+
+        self.assertEqual({element['source'] for row in rows.values() for element in row}, {'estimate'})
+        self.assertEqual({element['status'] for row in rows.values() for element in row}, {'OK'})
+
+    def test_estimate_mode_never_calls_the_backend(self):
+        rows = self.rows(TravelTimeMatrix.ESTIMATE)
+
+        self.assertEqual(self.backend.requests, [])
+        self.assertEqual(sorted(rows), [0, 1, 2])
+
+
+class TravelMatrixEndpointTests(OfflineServicesMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(User.objects.create(username='planner'))
+        self.body = {'origins': [PICKUP, DESTINATION], 'destinations': [DESTINATION]}
+
+    def test_rows_are_streamed_as_ndjson(self):
+        response = self.client.post('/api/rides/navigation/matrix/', self.body, format='json')
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+        self.assertEqual(lines[0], {'origins': 2, 'destinations': 1, 'mode': 'live'})
+        self.assertEqual(sorted(line['origin'] for line in lines[1:]), [0, 1])
+
+    def test_unstreamed_response(self):
+        response = self.client.post('/api/rides/navigation/matrix/', {**self.body, 'stream': False}, format='json')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['origin'] for row in response.data['rows']], [0, 1])
+        self.assertEqual(response.data['rows'][1]['elements'][0]['distance'], 0)
+
+    def test_too_many_elements(self):
+        with self.settings(TRAVEL_MATRIX_MAX_ELEMENTS=1):
+            response = self.client.post('/api/rides/navigation/matrix/', self.body, format='json')
+
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalid_points(self):
+        for origin in ({'latitude': 'x', 'longitude': 1}, {'latitude': 91, 'longitude': 1}, {'latitude': 6.5}):
+            response = self.client.post(
+                '/api/rides/navigation/matrix/', {**self.body, 'origins': [origin]}, format='json'
+            )
+
+            self.assertEqual(response.status_code, 400)
+            self.assertIn('origins', response.data)
+
+    def test_live_mode_requires_authentication(self):
+        client = APIClient()
+
+        self.assertEqual(client.post('/api/rides/navigation/matrix/', self.body, format='json').status_code, 401)
+        response = client.post(
+            '/api/rides/navigation/matrix/', {**self.body, 'mode': 'estimate', 'stream': False}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
@@ -0,0 +1,44 @@
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from .services.metrics import metrics
+from .services.registry import registry
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Per-user token-bucket rate limit for each endpoint class.
+
+    A view names its endpoint class with throttle_scope, or per action with
+    throttle_scopes ({'update_location': 'location'}). Rates and burst sizes
+    come from the THROTTLE_BUCKETS setting; views or actions without a
+    configured class (such as respond) are never throttled.
+    """
+
+    def __init__(self):
+        self.delay = 0
+
+    def get_scope(self, view):
+        scopes = getattr(view, 'throttle_scopes', {})
+        action = getattr(view, 'action', None)
+        if action in scopes:
+            return scopes[action]
+        return getattr(view, 'throttle_scope', None)
+
+    def allow_request(self, request, view):
+        scope = self.get_scope(view)
+        bucket = settings.THROTTLE_BUCKETS.get(scope) if scope else None
+        if bucket is None:
+            return True
+        if request.user and request.user.is_authenticated:
+            client = f"user:{request.user.pk}"
+        else:
+            client = f"ip:{self.get_ident(request)}"
+        self.delay = registry.rate_limiter.take((scope, client), bucket['rate'], bucket['burst'])
+        if self.delay:
+            metrics.inc('rate_limited_total', scope=scope)
+            return False
+        return True
+
+    def wait(self):
+        return self.delay
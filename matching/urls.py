@@ -11,6 +11,8 @@ router.register(r'rides', views.RideViewSet)
 router.register(r'match', views.RideMatchingViewSet, basename='match')
 router.register(r'navigation', views.NavigationViewSet, basename='navigation')
 router.register(r'ride-requests', views.RideRequestViewSet, basename='ride-requests')
+router.register(r'heatmap', views.HeatmapViewSet, basename='heatmap')
+router.register(r'metrics', views.MetricsViewSet, basename='metrics')
 
 urlpatterns = [
     path('', include(router.urls)),
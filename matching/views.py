@@ -1,29 +1,32 @@
+import json
+from django.http import StreamingHttpResponse
 from django.shortcuts import render
 from rest_framework import viewsets, status
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
 from drf_yasg.utils import swagger_auto_schema
 from drf_yasg import openapi
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 
-from .models import Driver, Passenger, Ride, RideRequest
+from .models import Driver, Passenger, Ride, RidePassenger, RideRequest, MatchJob
 from .serializers import (
     DriverSerializer, 
     PassengerSerializer,
     RideSerializer,
     RideMatchRequestSerializer,
     RouteRequestSerializer,
-    RideRequestSerializer
+    TravelMatrixRequestSerializer,
+    RideRequestSerializer,
+    RidePassengerSerializer,
+    MatchJobSerializer
 )
-from .services.matching_service import MatchingService
-from .services.navigation_service import NavigationService
-from .services.traffic_service import TrafficService
-
-# Initialize services
-traffic_service = TrafficService(api_key=settings.GOOGLE_MAPS_API_KEY)
-matching_service = MatchingService(traffic_service=traffic_service)
-navigation_service = NavigationService(api_key=settings.GOOGLE_MAPS_API_KEY)
+from .services.registry import registry
+from .services.metrics import metrics
+from .signals import driver_updated, ride_accepted, ride_status_changed
 
 class DriverViewSet(viewsets.ModelViewSet):
     """
@@ -31,14 +34,28 @@ class DriverViewSet(viewsets.ModelViewSet):
     """
     queryset = Driver.objects.all()
     serializer_class = DriverSerializer
+    throttle_scopes = {'update_location': 'location', 'heartbeat': 'heartbeat', 'nearby': 'nearby'}
     
     def get_queryset(self):
+        # Schema generation has no user to filter by
+        if getattr(self, 'swagger_fake_view', False):
+            return Driver.objects.none()
         # If user is staff, return all drivers
         if self.request.user.is_staff:
             return Driver.objects.all()
         # Otherwise, return only the driver associated with the current user
         return Driver.objects.filter(user=self.request.user)
     
+    def perform_update(self, serializer):
+        previous_location, previous_available = serializer.instance.location, serializer.instance.available
+        driver = serializer.save()
+        driver_updated.send(
+            sender=Driver,
+            driver=driver,
+            previous_location=previous_location,
+            previous_available=previous_available
+        )
+    
     @action(detail=False, methods=['get'])
     def me(self, request):
         """Get the current user's driver profile"""
@@ -57,9 +74,16 @@ class DriverViewSet(viewsets.ModelViewSet):
         """Update the current user's driver profile"""
         try:
             driver = Driver.objects.get(user=request.user)
+            previous_location, previous_available = driver.location, driver.available
             serializer = self.get_serializer(driver, data=request.data, partial=True)
             if serializer.is_valid():
                 serializer.save()
+                driver_updated.send(
+                    sender=Driver,
+                    driver=driver,
+                    previous_location=previous_location,
+                    previous_available=previous_available
+                )
                 return Response(serializer.data)
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         except Driver.DoesNotExist:
@@ -74,7 +98,17 @@ class DriverViewSet(viewsets.ModelViewSet):
         try:
             driver = Driver.objects.get(user=request.user)
             driver.available = not driver.available
+            # Going online counts as a heartbeat, or the presence sweep would take them straight back offline
+            driver.last_seen = timezone.now()
             driver.save()
+            if registry.presence is not None:
+                registry.presence.beat(driver.id)
+            driver_updated.send(
+                sender=Driver,
+                driver=driver,
+                previous_location=driver.location,
+                previous_available=not driver.available
+            )
             return Response({
                 'available': driver.available,
                 'message': f'Availability set to {driver.available}'
@@ -85,20 +119,99 @@ class DriverViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_404_NOT_FOUND
             )
     
+    @swagger_auto_schema(
+        operation_description="Available drivers around a point for the passenger map. Positions are "
+                              "approximate; wide radii return driver counts per area instead",
+        manual_parameters=[
+            openapi.Parameter('lat', openapi.IN_QUERY, type=openapi.TYPE_NUMBER, required=True),
+            openapi.Parameter('lng', openapi.IN_QUERY, type=openapi.TYPE_NUMBER, required=True),
+            openapi.Parameter('radius', openapi.IN_QUERY, type=openapi.TYPE_NUMBER,
+                              description='Radius in km (default 2)')
+        ],
+        responses={
+            200: openapi.Response('mode is "drivers" with positions or "cells" with counts'),
+            400: openapi.Response('Invalid coordinates or radius')
+        }
+    )
+    @action(detail=False, methods=['get'])
+    def nearby(self, request):
+        """Approximate positions (or per-area counts) of available drivers near a point"""
+        try:
+            latitude = float(request.query_params['lat'])
+            longitude = float(request.query_params['lng'])
+            radius = float(request.query_params.get('radius', 2))
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'lat and lng are required and must be numbers'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180) or radius <= 0:
+            return Response(
+                {'error': 'Invalid coordinates or radius'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(registry.nearby_index.nearby(latitude, longitude, radius))
+    
+    @action(detail=False, methods=['post'])
+    def heartbeat(self, request):
+        """Report that the driver's app is running; silent drivers are taken offline"""
+        try:
+            driver = Driver.objects.get(user=request.user)
+            presence = registry.presence
+            if presence is not None:
+                presence.beat(driver.id)
+            return Response({
+                'available': driver.available,
+                'ttl': presence.ttl if presence is not None else None
+            })
+        except Driver.DoesNotExist:
+            return Response(
+                {'error': 'Driver profile not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+    
     @action(detail=False, methods=['post'])
     def update_location(self, request):
         """Update the driver's current location"""
         try:
             driver = Driver.objects.get(user=request.user)
             location = request.data.get('location')
-            if not location or 'latitude' not in location or 'longitude' not in location:
+            try:
+                latitude = float(location['latitude'])
+                longitude = float(location['longitude'])
+            except (TypeError, KeyError, ValueError):
                 return Response(
                     {'error': 'Invalid location data'}, 
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            # Also rejects NaN, which fails every comparison
+            if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+                return Response(
+                    {'error': 'Coordinates out of range'}, 
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            location = {**location, 'latitude': latitude, 'longitude': longitude}
+            if registry.presence is not None:
+                registry.presence.beat(driver.id)
+            
+            # Pings are coalesced per driver and written in batches when enabled
+            coalescer = registry.location_coalescer
+            if coalescer is not None:
+                coalescer.submit(driver.id, location)
+                return Response({
+                    'location': location,
+                    'message': 'Location updated successfully'
+                })
             
+            previous_location = driver.location
             driver.location = location
             driver.save()
+            driver_updated.send(
+                sender=Driver,
+                driver=driver,
+                previous_location=previous_location,
+                previous_available=driver.available
+            )
             return Response({
                 'location': driver.location,
                 'message': 'Location updated successfully'
@@ -117,6 +230,9 @@ class PassengerViewSet(viewsets.ModelViewSet):
     serializer_class = PassengerSerializer
     
     def get_queryset(self):
+        # Schema generation has no user to filter by
+        if getattr(self, 'swagger_fake_view', False):
+            return Passenger.objects.none()
         # If user is staff, return all passengers
         if self.request.user.is_staff:
             return Passenger.objects.all()
@@ -156,7 +272,7 @@ class RideViewSet(viewsets.ModelViewSet):
     """
     API endpoint for managing rides
     """
-    queryset = Ride.objects.all()
+    queryset = Ride.objects.prefetch_related('riders')
     serializer_class = RideSerializer
 
     @swagger_auto_schema(
@@ -181,19 +297,83 @@ class RideViewSet(viewsets.ModelViewSet):
         ride = self.get_object()
         new_status = request.data.get('status')
         if new_status in [s[0] for s in Ride._meta.get_field('status').choices]:
+            previous_status = ride.status
             ride.status = new_status
+            if new_status == 'IN_PROGRESS' and ride.started_at is None:
+                ride.started_at = timezone.now()
+            elif new_status == 'COMPLETED' and ride.completed_at is None:
+                ride.completed_at = timezone.now()
             ride.save()
+            if new_status == 'CANCELLED':
+                ride.requests.filter(status='PENDING').update(status='WITHDRAWN', updated_at=timezone.now())
+            ride_status_changed.send(sender=Ride, ride=ride, previous_status=previous_status)
             return Response({'status': 'ride status updated'})
         return Response(
             {'error': 'Invalid status'}, 
             status=status.HTTP_400_BAD_REQUEST
         )
 
+    @swagger_auto_schema(
+        operation_description="Progress, remaining distance and ETAs of an accepted ride, from its "
+                              "stored route and the driver's latest location (no routing calls)",
+        responses={
+            200: openapi.Response('Ride progress'),
+            404: openapi.Response('Ride not found or has no stored route'),
+            409: openapi.Response('Ride is not accepted or in progress')
+        }
+    )
+    @action(detail=True, methods=['get'])
+    def tracking(self, request, pk=None):
+        ride = self.get_object()
+        if ride.status not in ('ACCEPTED', 'IN_PROGRESS'):
+            return Response(
+                {'error': f'Ride is {ride.status.lower()}, not under way'}, 
+                status=status.HTTP_409_CONFLICT
+            )
+        progress = registry.ride_tracker.track(ride, ride.driver.location)
+        if progress is None:
+            return Response(
+                {'error': 'No route stored for this ride'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return Response({**progress, 'polyline': ride.route['polyline']})
+
+    @swagger_auto_schema(
+        operation_description="Mark the next stop of a shared ride (a pickup or a dropoff) as done",
+        responses={
+            200: openapi.Response('The completed stop and the stops left'),
+            403: openapi.Response('Only the ride\'s driver can complete its stops'),
+            409: openapi.Response('Ride is not shared, not under way or has no stops left')
+        }
+    )
+    @action(detail=True, methods=['post'])
+    def complete_stop(self, request, pk=None):
+        ride = self.get_object()
+        if ride.driver.user_id != request.user.id:
+            return Response(
+                {'error': 'Only the ride\'s driver can complete its stops'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        if not ride.shared or ride.status not in ('ACCEPTED', 'IN_PROGRESS'):
+            return Response(
+                {'error': 'Only shared rides under way have stops'}, 
+                status=status.HTTP_409_CONFLICT
+            )
+        stop = registry.carpool.complete_stop(ride)
+        if stop is None:
+            return Response(
+                {'error': 'Ride has no stops left'}, 
+                status=status.HTTP_409_CONFLICT
+            )
+        ride.refresh_from_db(fields=['stops'])
+        return Response({'completed': stop, 'stops': ride.stops})
+
 class RideMatchingViewSet(viewsets.ViewSet):
     """
     API endpoint for matching passengers with drivers
     """
     permission_classes = [IsAuthenticated]
+    throttle_scopes = {'create': 'match'}
     
     @swagger_auto_schema(
         operation_description="Find best matching drivers for a passenger",
@@ -208,15 +388,86 @@ class RideMatchingViewSet(viewsets.ViewSet):
                         'ride_requests': openapi.Schema(
                             type=openapi.TYPE_ARRAY,
                             items=openapi.Schema(type=openapi.TYPE_OBJECT, ref='#/components/schemas/RideRequest')
+                        ),
+                        'match': openapi.Schema(
+                            type=openapi.TYPE_OBJECT,
+                            description='Whether every candidate was scored within the latency budget',
+                            properties={
+                                'complete': openapi.Schema(type=openapi.TYPE_BOOLEAN),
+                                'candidates': openapi.Schema(type=openapi.TYPE_INTEGER),
+                                'scored': openapi.Schema(type=openapi.TYPE_INTEGER),
+                                'traffic_fallbacks': openapi.Schema(type=openapi.TYPE_INTEGER),
+                                'elapsed_ms': openapi.Schema(type=openapi.TYPE_NUMBER),
+                                'cached': openapi.Schema(type=openapi.TYPE_BOOLEAN)
+                            }
+                        ),
+                        'existing': openapi.Schema(
+                            type=openapi.TYPE_BOOLEAN,
+                            description='The passenger already had an open PENDING ride, which is returned instead of a new match'
+                        ),
+                        'rider': openapi.Schema(
+                            type=openapi.TYPE_OBJECT,
+                            description='With shared=true, the passenger\'s place on the shared ride they joined '
+                                        '(ride_requests is then empty) or that was created for them',
+                            ref='#/components/schemas/RidePassenger'
                         )
                     }
                 )
             ),
+            202: openapi.Response('Match job queued (run_async=true)', MatchJobSerializer),
             404: openapi.Response('No drivers found or passenger not found'),
-            400: openapi.Response('Invalid request data')
-        }
+            400: openapi.Response('Invalid request data'),
+            409: openapi.Response('A request with the same Idempotency-Key is still in progress'),
+            422: openapi.Response('The Idempotency-Key was already used for a different request')
+        },
+        manual_parameters=[
+            openapi.Parameter(
+                'Idempotency-Key', openapi.IN_HEADER, type=openapi.TYPE_STRING, required=False,
+                description='Retries with the same key get the first response back instead of a new match'
+            )
+        ]
     )
     def create(self, request):
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if not idempotency_key:
+            return self.find_match(request)
+        if len(idempotency_key) > 255:
+            return Response(
+                {'error': 'Idempotency-Key must be at most 255 characters'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        store = registry.idempotency_store
+        scope = f"match:{request.user.pk}"
+        fingerprint = store.fingerprint(request.data)
+        state, record = store.begin(scope, idempotency_key, fingerprint)
+        if state == store.REPLAY:
+            return Response(record['data'], status=record['status'], headers={'Idempotent-Replayed': 'true'})
+        if state == store.IN_PROGRESS:
+            return Response(
+                {'error': 'A request with this Idempotency-Key is still in progress'}, 
+                status=status.HTTP_409_CONFLICT,
+                headers={'Retry-After': '1'}
+            )
+        if state == store.MISMATCH:
+            return Response(
+                {'error': 'This Idempotency-Key was already used for a different request'}, 
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY
+            )
+        
+        try:
+            response = self.find_match(request)
+        except Exception:
+            store.release(scope, idempotency_key)
+            raise
+        # Server errors are not recorded, so a retry gets another attempt
+        if response.status_code >= 500:
+            store.release(scope, idempotency_key)
+        else:
+            store.complete(scope, idempotency_key, fingerprint, response.status_code, response.data)
+        return response
+    
+    def find_match(self, request):
         serializer = RideMatchRequestSerializer(data=request.data)
         if serializer.is_valid():
             try:
@@ -248,11 +499,70 @@ class RideMatchingViewSet(viewsets.ViewSet):
                             status=status.HTTP_404_NOT_FOUND
                         )
                 
+                # A passenger whose ride is still waiting for a driver gets it back
+                # (e.g. a client retrying after a timeout) rather than a second ride
+                open_ride = Ride.objects.filter(
+                    passenger=passenger,
+                    status='PENDING',
+                    requests__status='PENDING'
+                ).order_by('-created_at').first()
+                if open_ride is not None:
+                    # Requests whose wave timed out are expired and the ride offered to its
+                    # next wave; a ride with no drivers left is cancelled and matched afresh
+                    registry.dispatch_service.advance(open_ride)
+                    if not open_ride.requests.filter(status='PENDING').exists():
+                        open_ride = None
+                if open_ride is not None:
+                    metrics.inc('match_open_ride_returned_total')
+                    return Response({
+                        'ride': RideSerializer(open_ride).data,
+                        'ride_requests': RideRequestSerializer(
+                            open_ride.requests.filter(status='PENDING'), many=True
+                        ).data,
+                        'existing': True
+                    })
+                
+                no_pickup = registry.zone_index.no_pickup_zone(serializer.validated_data['pickup_location'])
+                if no_pickup is not None:
+                    return Response(
+                        {'error': f'Pickups are not allowed in {no_pickup.name}'}, 
+                        status=status.HTTP_400_BAD_REQUEST
+                    )
+                
                 # Update passenger's pickup_location and destination
                 passenger.pickup_location = serializer.validated_data['pickup_location']
                 passenger.destination = serializer.validated_data['destination']
                 passenger.save()
                 
+                # Shared rides: join one already under way if it can take the
+                # passenger within the detour limits (no driver has to accept)
+                shared = serializer.validated_data.get('shared')
+                if shared:
+                    rider = RidePassenger.objects.filter(
+                        passenger=passenger,
+                        status__in=[RidePassenger.WAITING, RidePassenger.ON_BOARD],
+                        ride__status__in=['ACCEPTED', 'IN_PROGRESS']
+                    ).select_related('ride').first()
+                    if rider is not None:
+                        return Response({
+                            'ride': RideSerializer(rider.ride).data,
+                            'ride_requests': [],
+                            'rider': RidePassengerSerializer(rider).data,
+                            'existing': True
+                        })
+                    joined = registry.carpool.join(
+                        passenger,
+                        serializer.validated_data['pickup_location'],
+                        serializer.validated_data['destination']
+                    )
+                    if joined is not None:
+                        ride, rider = joined
+                        return Response({
+                            'ride': RideSerializer(ride).data,
+                            'ride_requests': [],
+                            'rider': RidePassengerSerializer(rider).data
+                        })
+                
                 # Check if there are available drivers
                 available_drivers = Driver.objects.filter(available=True)
                 if not available_drivers.exists():
@@ -269,42 +579,63 @@ class RideMatchingViewSet(viewsets.ViewSet):
                         status=status.HTTP_404_NOT_FOUND
                     )
                 
+                # In async mode hand the matching to the worker pool and return at once
+                # (rides created by match jobs are not shared)
+                if serializer.validated_data.get('run_async'):
+                    # One outstanding match job per passenger
+                    job = MatchJob.objects.filter(
+                        passenger=passenger,
+                        status__in=['QUEUED', 'RUNNING']
+                    ).order_by('-created_at').first()
+                    if job is not None:
+                        return Response(
+                            MatchJobSerializer(job).data,
+                            status=status.HTTP_202_ACCEPTED
+                        )
+                    job = registry.match_queue.enqueue(
+                        passenger,
+                        serializer.validated_data['pickup_location'],
+                        serializer.validated_data['destination']
+                    )
+                    return Response(
+                        MatchJobSerializer(job).data,
+                        status=status.HTTP_202_ACCEPTED
+                    )
+                
+                # Shed load rather than queueing without bound when matching is saturated
+                limiter = registry.match_limiter
+                if not limiter.acquire():
+                    return Response(
+                        {'error': 'Matching is overloaded, please retry shortly'}, 
+                        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                        headers={'Retry-After': str(limiter.retry_after)}
+                    )
+                
                 # Find best matching drivers
                 try:
-                    matched_drivers = matching_service.find_best_match(passenger)
+                    matched_drivers = registry.region_router.find_best_match(
+                        passenger, budget_ms=settings.MATCHING_LATENCY_BUDGET_MS
+                    )
                     
                     if matched_drivers:
-                        # Create a ride with the first matched driver (required by model)
-                        # but it will remain PENDING until a driver accepts
-                        ride = Ride.objects.create(
-                            driver=matched_drivers[0],  # Assign first driver temporarily
-                            passenger=passenger,
-                            pickup_location=serializer.validated_data['pickup_location'],
-                            destination=serializer.validated_data['destination'],
-                            status='PENDING'
+                        ride, ride_requests = registry.dispatch_service.create_ride(
+                            passenger,
+                            serializer.validated_data['pickup_location'],
+                            serializer.validated_data['destination'],
+                            matched_drivers
                         )
+                        rider = registry.carpool.open(ride) if shared else None
                         
-                        # Create ride requests for top 3 drivers (or fewer if not enough matches)
-                        max_requests = min(3, len(matched_drivers))
-                        ride_requests = []
-                        
-                        for i in range(max_requests):
-                            ride_request = RideRequest.objects.create(
-                                ride=ride,
-                                driver=matched_drivers[i],
-                                status='PENDING'
-                            )
-                            ride_requests.append(ride_request)
-                        
-                        # Here you would typically send notifications to drivers
-                        # This could be implemented with WebSockets, push notifications, etc.
-                        
-                        return Response({
+                        data = {
                             'ride': RideSerializer(ride).data,
-                            'ride_requests': RideRequestSerializer(ride_requests, many=True).data
-                        })
+                            'ride_requests': RideRequestSerializer(ride_requests, many=True).data,
+                            'match': matched_drivers.summary()
+                        }
+                        if rider is not None:
+                            data['rider'] = RidePassengerSerializer(rider).data
+                        return Response(data)
                     return Response(
-                        {'error': 'No suitable drivers found'}, 
+                        {'error': 'No suitable drivers found', 'match': matched_drivers.summary()}, 
                         status=status.HTTP_404_NOT_FOUND
                     )
                 except Exception as e:
@@ -315,6 +646,8 @@ class RideMatchingViewSet(viewsets.ViewSet):
                         {'error': f'Error in matching service: {str(e)}'}, 
                         status=status.HTTP_500_INTERNAL_SERVER_ERROR
                     )
+                finally:
+                    limiter.release()
             except Exception as e:
                 import logging
                 logger = logging.getLogger('matching')
@@ -324,12 +657,43 @@ class RideMatchingViewSet(viewsets.ViewSet):
                     status=status.HTTP_500_INTERNAL_SERVER_ERROR
                 )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    
+    @swagger_auto_schema(
+        operation_description="Poll the result of an asynchronous match job",
+        responses={
+            200: openapi.Response('Match job status, with the ride once completed', MatchJobSerializer),
+            404: openapi.Response('Match job not found')
+        }
+    )
+    @action(detail=False, methods=['get'], url_path=r'jobs/(?P<job_id>[0-9]+)')
+    def job(self, request, job_id=None):
+        """Get the status of a queued match job"""
+        try:
+            job = MatchJob.objects.select_related('passenger', 'ride').get(id=job_id)
+        except MatchJob.DoesNotExist:
+            return Response(
+                {'error': 'Match job not found'}, 
+                status=status.HTTP_404_NOT_FOUND
+            )
+        if job.passenger.user != request.user and not request.user.is_staff:
+            return Response(
+                {'error': 'You do not have permission to view this match job'}, 
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        data = MatchJobSerializer(job).data
+        if job.ride:
+            data['ride'] = RideSerializer(job.ride).data
+            data['ride_requests'] = RideRequestSerializer(job.ride.requests.all(), many=True).data
+        return Response(data)
 
 class NavigationViewSet(viewsets.ViewSet):
     """
     API endpoint for route navigation and travel time estimation
     """
     permission_classes = []
+    throttle_scope = 'navigation'
+    throttle_scopes = {'matrix': 'matrix'}
     
     @swagger_auto_schema(
         operation_description="Get optimal route between two points with estimated travel time",
@@ -367,7 +731,7 @@ class NavigationViewSet(viewsets.ViewSet):
         serializer = RouteRequestSerializer(data=request.data)
         if serializer.is_valid():
             # Get route information from navigation service
-            route_data = navigation_service.get_optimal_route(
+            route_data = registry.navigation_service.get_optimal_route(
                 origin=serializer.validated_data['origin'],
                 destination=serializer.validated_data['destination'],
                 waypoints=serializer.validated_data.get('waypoints')
@@ -472,7 +836,7 @@ class NavigationViewSet(viewsets.ViewSet):
         serializer = RouteRequestSerializer(data=request.data)
         if serializer.is_valid():
             # Get route information from navigation service
-            route_data = navigation_service.get_optimal_route(
+            route_data = registry.navigation_service.get_optimal_route(
                 origin=serializer.validated_data['origin'],
                 destination=serializer.validated_data['destination'],
                 waypoints=serializer.validated_data.get('waypoints')
@@ -530,6 +894,52 @@ class NavigationViewSet(viewsets.ViewSet):
             )
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+    @swagger_auto_schema(
+        operation_description="Travel times from every origin to every destination. Rows are streamed "
+                              "as NDJSON as they complete (a header line, then one line per origin) "
+                              "unless stream is false. mode 'estimate' answers from distances and "
+                              "typical speeds without calling the routing upstream; mode 'live' "
+                              "requires authentication",
+        request_body=TravelMatrixRequestSerializer,
+        responses={
+            200: openapi.Response('Rows of elements with status, duration (s), distance (m) and source'),
+            400: openapi.Response('Invalid request data or too many elements'),
+            401: openapi.Response('Live mode requested without authentication')
+        }
+    )
+    @action(detail=False, methods=['post'])
+    def matrix(self, request):
+        serializer = TravelMatrixRequestSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        origins = serializer.validated_data['origins']
+        destinations = serializer.validated_data['destinations']
+        mode = serializer.validated_data['mode']
+        if mode == 'live' and not request.user.is_authenticated:
+            # Live answers are paid upstream requests; anonymous clients get estimates only
+            self.permission_denied(request, message="Live travel times require authentication; use mode 'estimate'")
+        if len(origins) * len(destinations) > settings.TRAVEL_MATRIX_MAX_ELEMENTS:
+            return Response(
+                {'error': f'At most {settings.TRAVEL_MATRIX_MAX_ELEMENTS} origin/destination pairs per request'}, 
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        rows = registry.travel_matrix.rows(origins, destinations, mode)
+        if not serializer.validated_data['stream']:
+            return Response({
+                'mode': mode,
+                'rows': [
+                    {'origin': index, 'elements': elements}
+                    for index, elements in sorted(rows, key=lambda row: row[0])
+                ]
+            })
+        
+        def lines():
+            yield json.dumps({'origins': len(origins), 'destinations': len(destinations), 'mode': mode}) + '\n'
+            for index, elements in rows:
+                yield json.dumps({'origin': index, 'elements': elements}) + '\n'
+        return StreamingHttpResponse(lines(), content_type='application/x-ndjson')
+
 class RideRequestViewSet(viewsets.ModelViewSet):
     """
     API endpoint for managing ride requests
@@ -539,6 +949,9 @@ class RideRequestViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     
     def get_queryset(self):
+        # Schema generation has no user to filter by
+        if getattr(self, 'swagger_fake_view', False):
+            return RideRequest.objects.none()
         # If user is staff, return all ride requests
         if self.request.user.is_staff:
             return RideRequest.objects.all()
@@ -568,10 +981,12 @@ class RideRequestViewSet(viewsets.ModelViewSet):
             }
         ),
         responses={
-            200: openapi.Response('Request status updated successfully'),
+            200: openapi.Response('Request status updated successfully; rematch lists the drivers '
+                                  'the ride was offered to next if this rejection was the last pending one'),
             400: openapi.Response('Invalid status'),
             403: openapi.Response('Not authorized to update this request'),
-            404: openapi.Response('Request not found')
+            404: openapi.Response('Request not found'),
+            409: openapi.Response('Ride already taken, or request no longer pending or expired')
         }
     )
     @action(detail=True, methods=['post'])
@@ -583,7 +998,7 @@ class RideRequestViewSet(viewsets.ModelViewSet):
             # Verify the request belongs to the current driver
             try:
                 driver = Driver.objects.get(user=request.user)
-                if ride_request.driver != driver:
+                if ride_request.driver_id != driver.id:
                     return Response(
                         {'error': 'You are not authorized to update this request'}, 
                         status=status.HTTP_403_FORBIDDEN
@@ -602,27 +1017,77 @@ class RideRequestViewSet(viewsets.ModelViewSet):
                     status=status.HTTP_400_BAD_REQUEST
                 )
             
-            ride_request.status = new_status
-            ride_request.save()
-            
-            # If accepted, update the ride and reject other requests
-            if new_status == 'ACCEPTED':
-                ride = ride_request.ride
-                ride.driver = ride_request.driver
-                ride.status = 'ACCEPTED'
-                ride.save()
+            # Both transitions are conditional updates (compare-and-set on
+            # status='PENDING'), so concurrent responders never overwrite each
+            # other and no row has to be locked or re-read.
+            now = timezone.now()
+            with transaction.atomic():
+                if new_status == 'ACCEPTED':
+                    # Claim the ride first: only one driver can move it out of PENDING
+                    claimed = Ride.objects.filter(
+                        id=ride_request.ride_id,
+                        status='PENDING'
+                    ).update(driver_id=driver.id, status='ACCEPTED')
+                    if not claimed:
+                        return Response(
+                            {'error': 'Ride has already been taken by another driver'}, 
+                            status=status.HTTP_409_CONFLICT
+                        )
                 
-                # Reject other pending requests for this ride
-                RideRequest.objects.filter(
-                    ride=ride, 
+                updated = RideRequest.objects.filter(
+                    Q(expires_at__isnull=True) | Q(expires_at__gt=now),
+                    id=ride_request.id,
                     status='PENDING'
-                ).exclude(
-                    id=ride_request.id
-                ).update(status='REJECTED')
+                ).update(status=new_status, updated_at=now)
+                if not updated:
+                    # Undo the ride claim, the request was answered or expired meanwhile
+                    transaction.set_rollback(True)
+                    if ride_request.expires_at and ride_request.expires_at <= now:
+                        return Response(
+                            {'error': 'Ride request has expired'}, 
+                            status=status.HTTP_409_CONFLICT
+                        )
+                    return Response(
+                        {'error': 'Ride request is no longer pending'}, 
+                        status=status.HTTP_409_CONFLICT
+                    )
+                
+                # If accepted, withdraw the other pending requests for this ride
+                if new_status == 'ACCEPTED':
+                    RideRequest.objects.filter(
+                        ride_id=ride_request.ride_id, 
+                        status='PENDING'
+                    ).exclude(
+                        id=ride_request.id
+                    ).update(status='WITHDRAWN', updated_at=now)
+                    def send_accepted():
+                        ride = Ride.objects.get(id=ride_request.ride_id)
+                        ride_accepted.send(sender=Ride, ride=ride, driver=driver)
+                        ride_status_changed.send(sender=Ride, ride=ride, previous_status='PENDING')
+                    transaction.on_commit(send_accepted)
+            
+            # Once every driver offered the ride turned it down, rematch it from
+            # the ranking stored at match time instead of matching again
+            rematch = None
+            if new_status == 'REJECTED':
+                try:
+                    next_requests = registry.dispatch_service.advance(ride_request.ride)
+                    if next_requests:
+                        rematch = {
+                            'wave': next_requests[0].wave,
+                            'drivers': [next_request.driver_id for next_request in next_requests]
+                        }
+                except Exception as e:
+                    import logging
+                    logger = logging.getLogger('matching')
+                    logger.error(f"Error rematching ride {ride_request.ride_id}: {str(e)}")
             
+            ride_request.status = new_status
+            ride_request.updated_at = now
             return Response({
                 'status': 'Request updated successfully',
-                'ride_request': RideRequestSerializer(ride_request).data
+                'ride_request': RideRequestSerializer(ride_request).data,
+                'rematch': rematch
             })
             
         except RideRequest.DoesNotExist:
@@ -630,3 +1095,31 @@ class RideRequestViewSet(viewsets.ModelViewSet):
                 {'error': 'Ride request not found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
+
+class HeatmapViewSet(viewsets.ViewSet):
+    """
+    API endpoint for the live supply and demand map (staff only)
+    """
+    permission_classes = [IsAdminUser]
+    
+    @swagger_auto_schema(
+        operation_description="Available drivers, open rides and recent (time-decayed) ride requests "
+                              "per geohash cell, for surge pricing and pre-positioning drivers",
+        responses={200: openapi.Response('Counts for every cell with supply or demand')}
+    )
+    def list(self, request):
+        return Response(registry.heatmap.snapshot())
+
+class MetricsViewSet(viewsets.ViewSet):
+    """
+    API endpoint exposing this worker's service metrics (staff only)
+    """
+    permission_classes = [IsAdminUser]
+    
+    @swagger_auto_schema(
+        operation_description="Counters and gauges of this worker process, such as upstream "
+                              "circuit breaker states and fallback counts",
+        responses={200: openapi.Response('Metric values keyed by name and labels')}
+    )
+    def list(self, request):
+        return Response(metrics.snapshot())
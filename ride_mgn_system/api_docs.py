@@ -0,0 +1,144 @@
+"""
+API documentation views.
+
+The OpenAPI document is generated once (by the generate_openapi_schema
+command at build time, or on the first request), stored on disk and served
+as a static, gzip-compressed document with an ETag. The Swagger and ReDoc
+pages are cached and load the schema from that document, so no request walks
+the viewsets to rebuild it.
+"""
+import gzip
+import hashlib
+import os
+import tempfile
+import threading
+from functools import lru_cache
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control, patch_vary_headers
+from django.utils.http import parse_etags
+from rest_framework import permissions
+
+
+def api_info():
+    from drf_yasg import openapi
+
+    return openapi.Info(
+        title="Ride Matching API",
+        default_version="v1",
+        description="API documentation for the ride-matching system",
+        terms_of_service="https://www.example.com/terms/",
+        contact=openapi.Contact(email="support@example.com"),
+        license=openapi.License(name="MIT License"),
+    )
+
+
+@lru_cache(maxsize=None)
+def schema_view():
+    """
+    Build the drf_yasg schema view on first use. Its renderers pull in jsonschema
+    and the spec validator, which every worker would otherwise import at startup.
+    """
+    from drf_yasg.views import get_schema_view
+
+    return get_schema_view(
+        api_info(),
+        public=True,
+        permission_classes=(permissions.AllowAny,),
+    )
+
+
+class SchemaDocument:
+    """An encoded OpenAPI document with its gzip form and ETag"""
+
+    def __init__(self, content: bytes):
+        self.content = content
+        # mtime=0 keeps the compressed bytes identical across processes
+        self.gzipped = gzip.compress(content, compresslevel=9, mtime=0)
+        self.etag = '"%s"' % hashlib.sha256(content).hexdigest()[:32]
+
+
+def generate_schema() -> bytes:
+    """Walk the URL conf and encode the public OpenAPI document as JSON"""
+    from drf_yasg.codecs import OpenAPICodecJson
+
+    view = schema_view()
+    generator = view.generator_class(api_info())
+    schema = generator.get_schema(request=None, public=True)
+    return OpenAPICodecJson(validators=[]).encode(schema)
+
+
+def write_schema(path=None) -> SchemaDocument:
+    """Generate the document and store it atomically at OPENAPI_SCHEMA_PATH (or path)"""
+    path = str(path or settings.OPENAPI_SCHEMA_PATH)
+    document = SchemaDocument(generate_schema())
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.openapi-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(document.content)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return document
+
+
+_document = None
+_document_lock = threading.Lock()
+
+
+def stored_schema() -> SchemaDocument:
+    """
+    The document for this process: read from OPENAPI_SCHEMA_PATH, or generated
+    and stored there if missing. In DEBUG it is regenerated once per process so
+    the docs follow code changes.
+    """
+    global _document
+    if _document is None:
+        with _document_lock:
+            if _document is None:
+                path = str(settings.OPENAPI_SCHEMA_PATH)
+                if settings.DEBUG or not os.path.exists(path):
+                    _document = write_schema(path)
+                else:
+                    with open(path, 'rb') as f:
+                        _document = SchemaDocument(f.read())
+    return _document
+
+
+def openapi_schema(request):
+    """Serve the stored OpenAPI document, compressed when the client accepts gzip"""
+    document = stored_schema()
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match and (document.etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        response = HttpResponseNotModified()
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        response = HttpResponse(document.gzipped, content_type='application/json')
+        response['Content-Encoding'] = 'gzip'
+    else:
+        response = HttpResponse(document.content, content_type='application/json')
+    response['ETag'] = document.etag
+    patch_vary_headers(response, ('Accept-Encoding',))
+    patch_cache_control(response, public=True, max_age=settings.API_DOCS_CACHE_TIMEOUT)
+    return response
+
+
+@lru_cache(maxsize=None)
+def schema_ui_view(renderer: str):
+    return schema_view().with_ui(renderer, cache_timeout=settings.API_DOCS_CACHE_TIMEOUT)
+
+
+def swagger_ui(request, *args, **kwargs):
+    # Older clients fetch the spec from the UI URL itself
+    if request.GET.get('format') == 'openapi':
+        return openapi_schema(request)
+    return schema_ui_view('swagger')(request, *args, **kwargs)
+
+
+def redoc_ui(request, *args, **kwargs):
+    if request.GET.get('format') == 'openapi':
+        return openapi_schema(request)
+    return schema_ui_view('redoc')(request, *args, **kwargs)
@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'ride_mgn_system.settings')
 
 application = get_asgi_application()
+
+# Build the services listed in SERVICE_WARMUP before the first request
+from django.conf import settings
+from matching.services.registry import registry
+
+registry.warm_up(settings.SERVICE_WARMUP)
@@ -84,6 +84,17 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            # Wait for concurrent writers instead of failing with "database is locked",
+            # and take the write lock up front so conditional updates serialize cleanly
+            'timeout': 20,
+            'transaction_mode': 'IMMEDIATE',
+        },
+        'TEST': {
+            # File-backed test DB: the in-memory shared cache uses table locks
+            # that fail immediately under concurrent access
+            'NAME': BASE_DIR / 'test_db.sqlite3',
+        },
     }
 }
 
@@ -124,6 +135,20 @@ USE_TZ = True
 
 STATIC_URL = 'static/'
 
+# API documentation: the OpenAPI document is generated once and stored here
+# (run `manage.py generate_openapi_schema` at build time), and the Swagger and
+# ReDoc pages load it instead of regenerating the schema on every hit
+OPENAPI_SCHEMA_PATH = os.environ.get('OPENAPI_SCHEMA_PATH', BASE_DIR / 'openapi.json')
+# Seconds clients and the page cache may keep the docs pages and document
+API_DOCS_CACHE_TIMEOUT = 300
+
+SWAGGER_SETTINGS = {
+    'SPEC_URL': 'openapi-schema',
+}
+REDOC_SETTINGS = {
+    'SPEC_URL': 'openapi-schema',
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.1/ref/settings/#default-auto-field
 
@@ -132,6 +157,92 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 # Add your Google Maps API key
 GOOGLE_MAPS_API_KEY = os.environ.get('GOOGLE_MAPS_API_KEY', 'your_api_key_here')
 
+# Routing backend for navigation: 'google' (Directions API), 'local' (offline
+# road graph built with the build_road_graph command, memory-mapped from ROAD_GRAPH_PATH)
+# or 'simulation' (seeded model, see MAP_SIMULATION)
+NAVIGATION_BACKEND = os.environ.get('NAVIGATION_BACKEND', 'google')
+ROAD_GRAPH_PATH = os.environ.get('ROAD_GRAPH_PATH')
+
+# Traffic score backend: 'google' (Distance Matrix API) or 'simulation'
+TRAFFIC_BACKEND = os.environ.get('TRAFFIC_BACKEND', 'google')
+# Typical traffic per geohash cell and hour of the week, learned from completed
+# rides and a sample_rate share of live answers; used instead of a live lookup
+# for candidates beyond the nearest MATCHING_LIVE_TRAFFIC_CANDIDATES. Set to
+# None to disable
+TRAFFIC_PROFILE = {
+    'precision': 5,
+    'refresh_interval': 300,
+    'sample_rate': 0.1,
+    'max_samples': 1000,
+    'min_samples': 3,
+    'free_flow_kmh': 45,
+}
+MATCHING_LIVE_TRAFFIC_CANDIDATES = 5
+
+# Simulation backends: deterministic answers for a given seed, with injected
+# upstream latency (median ms, lognormal spread) and failure rate
+MAP_SIMULATION = {
+    'seed': int(os.environ.get('MAP_SIMULATION_SEED', 42)),
+    'latency_ms': float(os.environ.get('MAP_SIMULATION_LATENCY_MS', 0)),
+    'latency_sigma': 0.5,
+    'failure_rate': float(os.environ.get('MAP_SIMULATION_FAILURE_RATE', 0)),
+    'hour': None,  # Fix the simulated hour of day; None follows the clock
+}
+
+# Resilience for remote map APIs (traffic and directions): per-call deadline in
+# seconds, circuit breaker (consecutive failures to open, seconds before a trial
+# call) and hedging (send a duplicate request once a call is slower than this
+# percentile of recent calls; None disables hedging)
+MAP_UPSTREAM = {
+    'timeout': 2.0,
+    'breaker_failures': 5,
+    'breaker_reset_seconds': 30,
+    'hedge_percentile': None,
+    'hedge_min_samples': 20,
+    'max_workers': 16,
+}
+
+# Shared keep-alive HTTP transport for map API clients: connection pool size,
+# concurrent requests per upstream host, retries per request, and the share of
+# recent requests that retries may add
+MAP_TRANSPORT = {
+    'pool_maxsize': 32,
+    'per_host_limit': 16,
+    'max_retries': 2,
+    'retry_budget_ratio': 0.1,
+}
+
+# Region sharding for matching: drivers and rides are partitioned by a geohash
+# prefix of this length (4 is roughly 39 km x 20 km)
+MATCHING_REGION_PRECISION = 4
+# Also search neighbouring regions whose edge is within this distance of the pickup
+MATCHING_REGION_BORDER_KM = 5
+# Widen the search to all neighbouring regions when fewer candidates are found
+MATCHING_REGION_MIN_CANDIDATES = 3
+# Seconds before a region's in-memory candidate set is reloaded from the database
+MATCHING_REGION_SHARD_TTL = 30
+# Seconds a pickup cell's candidate ranking is reused by later requests from the
+# same cell (0 disables); cells are geohashes of this length (7 is ~150 m)
+MATCHING_CANDIDATE_CACHE_TTL = 5
+MATCHING_CANDIDATE_CACHE_PRECISION = 7
+# Latency budget for synchronous /match/ requests in milliseconds: candidates are
+# scored nearest first and the ranking so far is returned when it runs out.
+# None scores every candidate however long it takes.
+MATCHING_LATENCY_BUDGET_MS = float(os.environ.get('MATCHING_LATENCY_BUDGET_MS', 150)) or None
+
+# Services are built on first use; these are built up front by the WSGI/ASGI
+# entry points and match workers, so the first requests do not pay for them
+# (e.g. ['region_router', 'navigation_service'])
+SERVICE_WARMUP = [
+    name.strip() for name in os.environ.get('SERVICE_WARMUP', '').split(',') if name.strip()
+]
+
+# Memory-mapped driver state table shared by all worker processes. Unset keeps
+# each process on its own database-loaded view; point it at a tmpfs file such
+# as /dev/shm/ride_share_drivers.bin in production.
+DRIVER_STATE_PATH = os.environ.get('DRIVER_STATE_PATH')
+DRIVER_STATE_CAPACITY = 65536
+
 
 # Add CORS settings to allow all origins
 CORS_ALLOW_ALL_ORIGINS = True
@@ -158,7 +269,120 @@ CORS_ALLOW_HEADERS = [
     'x-requested-with',
 ]
 
+# Idempotency-Key records for /match/ live in their own bounded cache, so other
+# cache users cannot evict them. Use a shared backend (e.g. Redis) when running
+# several worker processes, so retries landing on another worker are recognised.
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'idempotency': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'idempotency',
+        'TIMEOUT': IDEMPOTENCY_KEY_TTL,
+        'OPTIONS': {'MAX_ENTRIES': 10000},
+    },
+}
+
+# Admission control. Token-bucket rate limits per user for each endpoint class:
+# rate is sustained requests per second, burst the bucket size. Endpoints
+# without a class (such as responding to ride requests) are never limited.
+THROTTLE_BUCKETS = {
+    'match': {'rate': 0.5, 'burst': 5},
+    'location': {'rate': 2, 'burst': 10},
+    'navigation': {'rate': 1, 'burst': 10},
+    # Travel time matrices, which can fan out to many upstream elements each
+    'matrix': {'rate': 0.2, 'burst': 5},
+    'heartbeat': {'rate': 0.5, 'burst': 5},
+    'nearby': {'rate': 2, 'burst': 10},
+}
+# Synchronous matches running at once per worker process; more wait up to the
+# queue timeout for a slot, then get 503 with Retry-After
+MATCHING_CONCURRENCY_LIMIT = 8
+MATCHING_QUEUE_TIMEOUT_MS = 250
+# Queued (run_async) match jobs: a worker's claim on a job lapses unless it
+# renews it within this many seconds, after which the job is requeued
+MATCH_JOB_LEASE_SECONDS = 30
+# How a matched ride is offered to drivers: 'broadcast' to the top max_requests
+# at once, 'sequential' to one driver at a time, or 'wave' to small waves sized
+# from each driver's acceptance rate. Sequential and wave offers expire after
+# wave_timeout seconds (swept by the expire_ride_requests command, and checked
+# whenever the ride is next answered or requested again), then the next
+# drivers in the stored ranking get the offer (as do the next drivers of any
+# ride whose requests were all rejected), skipping drivers who moved more than
+# max_drift_km since the match.
+DISPATCH = {
+    'policy': os.environ.get('DISPATCH_POLICY', 'wave'),
+    'max_requests': 3,
+    'wave_timeout': 20,
+    'max_wave_size': 3,
+    'target_acceptance': 0.8,
+    'ranking_size': 20,
+    'max_drift_km': 2.0,
+}
+# Driver location pings are buffered and written in batches at this interval,
+# keeping only the latest ping per driver (0 writes every ping immediately)
+LOCATION_FLUSH_INTERVAL_MS = 500
+# Drivers that sent a heartbeat or location ping are taken offline after this
+# many seconds without one (0 disables presence tracking); heartbeats are
+# written to the database at the flush interval
+PRESENCE_TTL_SECONDS = int(os.environ.get('PRESENCE_TTL_SECONDS', 60))
+PRESENCE_FLUSH_INTERVAL_SECONDS = 5
+# Geofenced zones are indexed on a grid of this cell size (degrees) and
+# reloaded at this interval to pick up edits made in other processes
+ZONE_CELL_DEGREES = 0.01
+ZONE_RELOAD_INTERVAL = 60
+# Largest origins x destinations travel time matrix accepted per request
+TRAVEL_MATRIX_MAX_ELEMENTS = 2500
+# Ride progress tracking: pings further than off_route_m from the stored route
+# are off route; routes of accepted rides are planned off the request thread
+RIDE_TRACKING = {
+    'off_route_m': 100,
+    'window': 50,
+    'plan_in_background': True,
+}
+# Supply/demand heatmap (GET /heatmap/): geohash precision of its cells,
+# half-lives (seconds) of the decayed ride request counts, and how often the
+# driver and open ride counts are recounted from the database
+HEATMAP = {
+    'precision': 6,
+    'half_lives': {'5m': 300, '1h': 3600},
+    'resync_interval': 60,
+}
+# Map of available drivers for passengers (GET /drivers/nearby/): positions are
+# jittered by up to jitter_m metres (an offset fixed per driver for
+# jitter_period seconds, derived with SECRET_KEY), queries wider than
+# aggregate_radius_km get counts per block of cells, and answers are shared
+# for cache_ttl seconds
+NEARBY_DRIVERS = {
+    'cell_degrees': 0.01,
+    'reload_interval': 30,
+    'cache_ttl': 1.5,
+    'jitter_m': 150,
+    'jitter_period': 900,
+    'aggregate_radius_km': 3,
+    'aggregate_cells': 5,
+    'max_radius_km': 20,
+}
+# Shared rides (POST /match/ with shared=true): a passenger joins an active
+# shared ride when the car covers at most max_pickup_km before picking them up
+# and nobody's trip grows by more than max_detour_ratio of its direct length
+# (and max_detour_km); otherwise a new shared ride is created for them
+CARPOOL = {
+    'capacity': 3,
+    'max_detour_ratio': 0.5,
+    'max_detour_km': 5,
+    'max_pickup_km': 4,
+    'cell_degrees': 0.01,
+    'reload_interval': 30,
+}
+
 REST_FRAMEWORK = {
+    'DEFAULT_THROTTLE_CLASSES': [
+        'matching.throttling.TokenBucketThrottle',
+    ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'rest_framework.authentication.TokenAuthentication',
         'rest_framework.authentication.SessionAuthentication',
@@ -18,29 +18,17 @@ from django.contrib import admin
 #from django.urls import path
 
 from django.urls import path, include, re_path
-from rest_framework import permissions
-from drf_yasg.views import get_schema_view
-from drf_yasg import openapi
-
-schema_view = get_schema_view(
-    openapi.Info(
-        title="Ride Matching API",
-        default_version="v1",
-        description="API documentation for the ride-matching system",
-        terms_of_service="https://www.example.com/terms/",
-        contact=openapi.Contact(email="support@example.com"),
-        license=openapi.License(name="MIT License"),
-    ),
-    public=True,
-    permission_classes=(permissions.AllowAny,),
-)
+from .api_docs import openapi_schema, swagger_ui, redoc_ui
 
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/rides/', include('matching.urls')),
+    # OpenAPI document, generated once and served as a static file
+    path('openapi.json', openapi_schema, name='openapi-schema'),
+
     # Swagger UI
-    re_path(r'^swagger/$', schema_view.with_ui('swagger', cache_timeout=0), name='swagger-ui'),
+    re_path(r'^swagger/$', swagger_ui, name='swagger-ui'),
     
     # Redoc UI (alternative)
-    re_path(r'^redoc/$', schema_view.with_ui('redoc', cache_timeout=0), name='redoc-ui'),
+    re_path(r'^redoc/$', redoc_ui, name='redoc-ui'),
 ]